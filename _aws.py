@@ -1,25 +1,223 @@
 import json
 import logging
 import os
-from asyncio import sleep
+import time
+from asyncio import Lock, gather, sleep, to_thread
+from functools import partial
 
 from aiobotocore.session import get_session
 from aiolimiter import AsyncLimiter
 from botocore.config import Config
 from botocore.exceptions import ClientError
+from pydantic import BaseModel
+
+import _budgets
+import _hedging
+import _ratelimiters
+import _schemas
+import _tokens
 
 AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
 
-CONFIG = Config(retries={"max_attempts": 1, "mode": "standard"})
+CONFIG = Config(
+    retries={"max_attempts": 1, "mode": "standard"},
+    max_pool_connections=_ratelimiters.MAX_CONNECTIONS,
+)
 
 SESSION = get_session()
 
+# Regions each model's traffic is spread over. Bedrock quotas are per region, so
+# every region gets its own client and limiters. The first region uses the
+# limiters passed to the adapters; override with `set_regions`.
+REGIONS = {
+    "anthropic": ["us-east-1"],
+    "mistral": ["us-east-1"],
+    "meta": ["us-west-2"],
+}
+
+# In structured mode, Claude 3 models are forced to answer with this tool, and
+# the other models' responses are started with the prefill
+TOOL = "record_response"
+PREFILL = "{"
+
+################################################################################
+# Region routing
+
+
+class _Region:
+    """A Bedrock region serving one model, with its own limiters."""
+
+    def __init__(
+        self, name: str, request_limiter: AsyncLimiter, token_limiter: AsyncLimiter
+    ):
+        self.name = name
+        self.request_limiter = request_limiter
+        self.token_limiter = token_limiter
+        self.in_flight = 0
+        self.throttled_until = 0.0
+
+    def load(self) -> float:
+        """Return the in-flight requests relative to the region's request quota."""
+        return self.in_flight / self.request_limiter.max_rate
+
+
+_CLIENTS = {}
+_CLIENTS_LOCK = Lock()
+_ROUTES = {}
+
+
+def set_regions(model: str, regions: list[str]) -> None:
+    """Spread the given model's traffic over the given regions."""
+    REGIONS[model] = regions
+    _ROUTES.pop(model, None)
+
+
+def _regions(
+    model: str, request_limiter: AsyncLimiter, token_limiter: AsyncLimiter
+) -> list[_Region]:
+    """Return the regions serving the given model."""
+    if model not in _ROUTES:
+        names = REGIONS.get(model, REGIONS[model.split(".")[0]])
+        _ROUTES[model] = [_Region(names[0], request_limiter, token_limiter)] + [
+            _Region(name, *_ratelimiters.region_limiters(model, name))
+            for name in names[1:]
+        ]
+    return _ROUTES[model]
+
+
+async def _pick(regions: list[_Region]) -> _Region:
+    """Pick the least-loaded region, waiting out throttling if every region is."""
+    now = time.monotonic()
+    available = [region for region in regions if region.throttled_until <= now]
+    if not available:
+        region = min(regions, key=lambda region: region.throttled_until)
+        await sleep(region.throttled_until - now)
+        return region
+    return min(
+        available,
+        key=lambda region: (not region.request_limiter.has_capacity(), region.load()),
+    )
+
+
+async def _client(region: str):
+    """Return the shared Bedrock runtime client for the given region."""
+    async with _CLIENTS_LOCK:
+        if region not in _CLIENTS:
+            _CLIENTS[region] = await SESSION.create_client(
+                "bedrock-runtime",
+                region_name=region,
+                aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                aws_access_key_id=AWS_ACCESS_KEY_ID,
+                config=CONFIG,
+            ).__aenter__()
+    return _CLIENTS[region]
+
+
+async def close() -> None:
+    """Close the shared Bedrock clients."""
+    async with _CLIENTS_LOCK:
+        for client in _CLIENTS.values():
+            await client.close()
+        _CLIENTS.clear()
+
+
+async def _request(client, model: str, payload: dict) -> dict:
+    """Send one request to the model and decode its response."""
+    # Pass payload as JSON bytes, serializing the long prompt off the event loop
+    raw_response = await client.invoke_model(
+        body=await to_thread(json.dumps, payload), modelId=model
+    )
+
+    # Read the response as a string
+    async with raw_response["body"] as stream:
+        str_response = await stream.read()
+
+    # Convert the response to a JSON object
+    return await to_thread(json.loads, str_response)
+
+
+async def _invoke(
+    model: str,
+    payload: dict,
+    n_tokens: int,
+    request_limiter: AsyncLimiter,
+    token_limiter: AsyncLimiter,
+    max_retries: int = 4,
+) -> dict | None:
+    """Invoke the given model, failing over to another region when throttled."""
+    retries = 0
+    wait_time = 1
+    regions = _regions(model, request_limiter, token_limiter)
+    while retries < max_retries:
+        region = await _pick(regions)
+        region.in_flight += 1
+        try:
+            client = await _client(region.name)
+            await region.token_limiter.acquire(n_tokens)
+            async with region.request_limiter:
+                return await _hedging.call(
+                    model,
+                    partial(_request, client, model, payload),
+                    [(region.token_limiter, n_tokens), (region.request_limiter, 1)],
+                )
+
+        except (ClientError, TimeoutError) as e:
+            logging.error("AWS error in %s: %s", region.name, e)
+            if retries >= max_retries:
+                raise e
+            retries += 1
+            # Rest a throttled region and retry immediately elsewhere if we can
+            if (
+                isinstance(e, ClientError)
+                and e.response.get("Error", {}).get("Code") == "ThrottlingException"
+            ):
+                region.throttled_until = time.monotonic() + wait_time
+                if len(regions) == 1:
+                    await sleep(wait_time)
+            else:
+                await sleep(wait_time)
+            wait_time *= 2
+
+        finally:
+            region.in_flight -= 1
+
+    return None
+
+
+async def _invoke_n(
+    model: str,
+    payload: dict,
+    n_tokens: int,
+    request_limiter: AsyncLimiter,
+    token_limiter: AsyncLimiter,
+    max_retries: int = 4,
+    n: int = 1,
+) -> list[dict | None]:
+    """Invoke the given model n times concurrently, since Bedrock has no `n`."""
+    return await gather(
+        *(
+            _invoke(
+                model, payload, n_tokens, request_limiter, token_limiter, max_retries
+            )
+            for _ in range(n)
+        )
+    )
+
+
 ################################################################################
 
 
-def _claude_payload(model: str, system_message: str, prompt: str) -> dict:
+def _claude_payload(
+    model: str,
+    system_message: str,
+    prompt: str,
+    max_tokens: int = _budgets.DEFAULT_MAX_TOKENS,
+    stop: list[str] | None = None,
+    schema: type[BaseModel] | None = None,
+) -> dict:
     """Create a payload for the given Claude model, system_message, and prompt."""
+    stop_sequences = {"stop_sequences": stop} if stop else {}
     if model == "anthropic.claude-v2:1":
         return {
             "prompt": "\n\nHuman:"
@@ -28,13 +226,29 @@ def _claude_payload(model: str, system_message: str, prompt: str) -> dict:
             + prompt
             + "\n\n"
             + "#" * 80
-            + "\n\nAssistant:",
-            "max_tokens_to_sample": 500,
+            + "\n\nAssistant:"
+            + (PREFILL if schema is not None else ""),
+            "max_tokens_to_sample": max_tokens,
+            **stop_sequences,
         }
     else:
+        tools = (
+            {
+                "tools": [
+                    {
+                        "name": TOOL,
+                        "description": "Record your response.",
+                        "input_schema": _schemas.json_schema(schema),
+                    }
+                ],
+                "tool_choice": {"type": "tool", "name": TOOL},
+            }
+            if schema is not None
+            else {}
+        )
         return {
             "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 500,
+            "max_tokens": max_tokens,
             "messages": [
                 {
                     "role": "user",
@@ -42,22 +256,46 @@ def _claude_payload(model: str, system_message: str, prompt: str) -> dict:
                 },
             ],
             "system": system_message,
+            **stop_sequences,
+            **tools,
         }
 
 
-def _parse_claude(model: str, response: dict) -> str:
+def _parse_claude(
+    model: str, response: dict, schema: type[BaseModel] | None = None
+) -> _budgets.Completion:
     """Parse the response from the given Claude model."""
     if model == "anthropic.claude-v2:1":
-        return response.get("completion", "").strip()
+        completion = response.get("completion", "").strip()
+        if schema is not None:
+            completion = _schemas.complete_prefill(PREFILL, completion)
+        return _budgets.Completion(
+            completion,
+            None,
+            response.get("stop_reason") == "max_tokens",
+        )
     else:
         contents = response.get("content", [])
-        return " ".join(
-            [
-                content.get("text", "")
-                for content in contents
-                if content.get("type") == "text"
-            ]
-        ).strip()
+        tool_uses = [
+            content for content in contents if content.get("type") == "tool_use"
+        ]
+        if tool_uses:
+            return _budgets.Completion(
+                json.dumps(tool_uses[0].get("input", {})),
+                response.get("usage", {}).get("output_tokens"),
+                response.get("stop_reason") == "max_tokens",
+            )
+        return _budgets.Completion(
+            " ".join(
+                [
+                    content.get("text", "")
+                    for content in contents
+                    if content.get("type") == "text"
+                ]
+            ).strip(),
+            response.get("usage", {}).get("output_tokens"),
+            response.get("stop_reason") == "max_tokens",
+        )
 
 
 async def _chat_claude(
@@ -67,47 +305,31 @@ async def _chat_claude(
     request_limiter: AsyncLimiter,
     token_limiter: AsyncLimiter,
     max_retries: int = 4,
-) -> str | None:
+    n_tokens: int | None = None,
+    max_tokens: int = _budgets.DEFAULT_MAX_TOKENS,
+    stop: list[str] | None = None,
+    schema: type[BaseModel] | None = None,
+    n: int = 1,
+) -> list[_budgets.Completion | None]:
     """Call the given Anthropic model with the given prompt and system_message."""
-    retries = 0
-    wait_time = 1
     # Create the payload
-    payload = _claude_payload(model, system_message, prompt)
-    n_tokens = (len(prompt) + len(system_message)) // 4
-    async with SESSION.create_client(
-        "bedrock-runtime",
-        region_name="us-east-1",
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        config=CONFIG,
-    ) as client:
-        while retries < max_retries:
-            try:
-                await token_limiter.acquire(n_tokens)
-                async with request_limiter:
-                    # Pass payload as JSON bytes
-                    raw_response = await client.invoke_model(
-                        body=json.dumps(payload), modelId=model
-                    )
-
-                    # Read the response as a string
-                    async with raw_response["body"] as stream:
-                        str_response = await stream.read()
-
-                    # Convert the response to a JSON object
-                    response = json.loads(str_response)
-
-                    return _parse_claude(model, response)
-
-            except ClientError as e:
-                logging.error("AWS error: %s", e)
-                if retries >= max_retries:
-                    raise e
-                retries += 1
-                await sleep(wait_time)
-                wait_time *= 2
-
-        return None
+    payload = _claude_payload(model, system_message, prompt, max_tokens, stop, schema)
+    if n_tokens is None:
+        n_tokens = _tokens.count_prompt(model, system_message, prompt)
+    _tokens.check_context(model, n_tokens, max_tokens)
+    responses = await _invoke_n(
+        model,
+        payload,
+        n_tokens + max_tokens,
+        request_limiter,
+        token_limiter,
+        max_retries,
+        n,
+    )
+    return [
+        _parse_claude(model, response, schema) if response is not None else None
+        for response in responses
+    ]
 
 
 ################################################################################
@@ -120,59 +342,69 @@ async def _chat_mistral(
     request_limiter: AsyncLimiter,
     token_limiter: AsyncLimiter,
     max_retries: int = 4,
-) -> str | None:
+    n_tokens: int | None = None,
+    max_tokens: int = _budgets.DEFAULT_MAX_TOKENS,
+    stop: list[str] | None = None,
+    schema: type[BaseModel] | None = None,
+    n: int = 1,
+) -> list[_budgets.Completion | None]:
     """Call the given Mistral model with the given prompt and system_message."""
-    retries = 0
-    wait_time = 1
-    n_tokens = (len(prompt) + len(system_message)) // 4
+    if n_tokens is None:
+        n_tokens = _tokens.count_prompt(model, system_message, prompt)
+    _tokens.check_context(model, n_tokens, max_tokens)
     # Create the payload
     payload = {
         "prompt": system_message + "\n\n" + prompt + "\n\n" + "#" * 80,
-        "max_tokens": 500,
+        "max_tokens": max_tokens,
     }
-    async with SESSION.create_client(
-        "bedrock-runtime",
-        region_name="us-east-1",
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        config=CONFIG,
-    ) as client:
-        while retries < max_retries:
-            try:
-                await token_limiter.acquire(n_tokens)
-                async with request_limiter:
-                    # Pass payload as JSON bytes
-                    raw_response = await client.invoke_model(
-                        body=json.dumps(payload), modelId=model
-                    )
-
-                    # Read the response as a string
-                    async with raw_response["body"] as stream:
-                        str_response = await stream.read()
-
-                    # Convert the response to a JSON object
-                    response = json.loads(str_response)
-
-                    # Get the output from the response
-                    outputs = response.get("outputs", [])
-                    return outputs[0].get("text", "").strip() if outputs else ""
-
-            except ClientError as e:
-                logging.error("AWS error: %s", e)
-                if retries >= max_retries:
-                    raise e
-                retries += 1
-                await sleep(wait_time)
-                wait_time *= 2
-
-        return None
+    if schema is not None:
+        payload["prompt"] += "\n\n" + PREFILL
+    if stop:
+        payload["stop"] = stop
+    responses = await _invoke_n(
+        model,
+        payload,
+        n_tokens + max_tokens,
+        request_limiter,
+        token_limiter,
+        max_retries,
+        n,
+    )
+    return [
+        _parse_mistral(response, schema) if response is not None else None
+        for response in responses
+    ]
+
+
+def _parse_mistral(
+    response: dict, schema: type[BaseModel] | None = None
+) -> _budgets.Completion:
+    """Parse the response from a Mistral model."""
+    outputs = response.get("outputs", [])
+    text = outputs[0].get("text", "").strip() if outputs else ""
+    if schema is not None:
+        text = _schemas.complete_prefill(PREFILL, text)
+    return _budgets.Completion(
+        text,
+        None,
+        outputs[0].get("stop_reason") == "length" if outputs else False,
+    )
 
 
 ################################################################################
 
 
-def _llama_payload(model: str, system_message: str, prompt: str) -> dict:
-    """Create a payload for the given LLaMa model, system_message, and prompt."""
+def _llama_payload(
+    model: str,
+    system_message: str,
+    prompt: str,
+    max_tokens: int = _budgets.DEFAULT_MAX_TOKENS,
+    schema: type[BaseModel] | None = None,
+) -> dict:
+    """Create a payload for the given LLaMa model, system_message, and prompt.
+
+    Bedrock's Llama models do not support stop sequences.
+    """
     return {
         "prompt": (
             "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n"
@@ -180,8 +412,9 @@ def _llama_payload(model: str, system_message: str, prompt: str) -> dict:
             "<|eot_id|><start_header_id|>user<|end_header_id|>\n\n"
             f"{prompt}"
             "<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
+            + ("\n\n" + PREFILL if schema is not None else "")
         ),
-        "max_gen_len": 500,
+        "max_gen_len": max_tokens,
     }
 
 
@@ -192,45 +425,42 @@ async def _chat_llama(
     request_limiter: AsyncLimiter,
     token_limiter: AsyncLimiter,
     max_retries: int = 4,
-) -> str | None:
+    n_tokens: int | None = None,
+    max_tokens: int = _budgets.DEFAULT_MAX_TOKENS,
+    stop: list[str] | None = None,
+    schema: type[BaseModel] | None = None,
+    n: int = 1,
+) -> list[_budgets.Completion | None]:
     """Call the given LLaMa model with the given prompt and system_message."""
-    retries = 0
-    wait_time = 1
-    n_tokens = (len(prompt) + len(system_message)) // 4
+    if n_tokens is None:
+        n_tokens = _tokens.count_prompt(model, system_message, prompt)
+    _tokens.check_context(model, n_tokens, max_tokens)
     # Create the payload
-    payload = _llama_payload(model, system_message, prompt)
-    async with SESSION.create_client(
-        "bedrock-runtime",
-        region_name="us-west-2",
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        config=CONFIG,
-    ) as client:
-        while retries < max_retries:
-            try:
-                await token_limiter.acquire(n_tokens)
-                async with request_limiter:
-                    # Pass payload as JSON bytes
-                    raw_response = await client.invoke_model(
-                        body=json.dumps(payload), modelId=model
-                    )
-
-                    # Read the response as a string
-                    async with raw_response["body"] as stream:
-                        str_response = await stream.read()
-
-                    # Convert the response to a JSON object
-                    response = json.loads(str_response)
-
-                    # Get the output from the response
-                    return response.get("generation", "").strip()
-
-            except ClientError as e:
-                logging.error("AWS error: %s", e)
-                if retries >= max_retries:
-                    raise e
-                retries += 1
-                await sleep(wait_time)
-                wait_time *= 2
-
-        return None
+    payload = _llama_payload(model, system_message, prompt, max_tokens, schema)
+    responses = await _invoke_n(
+        model,
+        payload,
+        n_tokens + max_tokens,
+        request_limiter,
+        token_limiter,
+        max_retries,
+        n,
+    )
+    return [
+        _parse_llama(response, schema) if response is not None else None
+        for response in responses
+    ]
+
+
+def _parse_llama(
+    response: dict, schema: type[BaseModel] | None = None
+) -> _budgets.Completion:
+    """Parse the response from a LLaMa model."""
+    text = response.get("generation", "").strip()
+    if schema is not None:
+        text = _schemas.complete_prefill(PREFILL, text)
+    return _budgets.Completion(
+        text,
+        response.get("generation_token_count"),
+        response.get("stop_reason") == "length",
+    )
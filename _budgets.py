@@ -0,0 +1,34 @@
+import json
+import os
+from typing import NamedTuple
+
+# The output cap every adapter used before budgets were profiled
+DEFAULT_MAX_TOKENS = 500
+
+# Per-experiment budgets written by lengths.py --write, e.g.,
+# {"no_scratch": {"max_tokens": 120, "stop": []}}
+BUDGETS_PATH = "budgets.json"
+
+################################################################################
+
+
+class Completion(NamedTuple):
+    """A model's response with its output length."""
+
+    text: str
+    output_tokens: int | None = None
+    truncated: bool = False
+
+
+def load(path: str = BUDGETS_PATH) -> dict:
+    """Load the per-experiment budgets, if any have been written."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def budget(experiment: str, path: str = BUDGETS_PATH) -> tuple[int, list[str]]:
+    """Return the output token budget and stop sequences for the experiment."""
+    budget_ = load(path).get(experiment, {})
+    return budget_.get("max_tokens", DEFAULT_MAX_TOKENS), budget_.get("stop", [])
@@ -0,0 +1,80 @@
+import sqlite3
+
+import zstandard
+
+# Text columns stored compressed once a dictionary has been trained for them
+COLUMNS = {
+    "requests": ["raw_response"],
+    "prompts": ["system_message", "prompt"],
+}
+
+# Compression level for new values; decompression speed does not depend on it
+LEVEL = 9
+
+################################################################################
+
+
+class Codec:
+    """Compress text columns with the dictionaries stored in the database.
+
+    Compressed values are zstd frames stored as BLOBs, and the frame header names
+    the dictionary it needs, so values compressed with a since-retrained
+    dictionary still decompress. Values stored as TEXT are returned unchanged.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.dictionaries = {}
+        self.active = {}
+        self.compressors = {}
+        self.decompressors = {}
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'dictionaries'"
+        ).fetchone()
+        if exists is None:
+            return
+
+        # The most recently trained dictionary for a column compresses new values
+        for dictionary_id, column, dictionary in conn.execute(
+            """
+            SELECT dictionary_id, column_name, dictionary
+            FROM dictionaries
+            ORDER BY timestamp, rowid
+            """
+        ):
+            self.dictionaries[dictionary_id] = zstandard.ZstdCompressionDict(dictionary)
+            self.active[column] = dictionary_id
+
+    def compress(self, column: str, text: str | None) -> str | bytes | None:
+        """Compress text bound for the given column, e.g., "prompts.prompt"."""
+        if text is None or column not in self.active:
+            return text
+        dictionary_id = self.active[column]
+        if dictionary_id not in self.compressors:
+            self.compressors[dictionary_id] = zstandard.ZstdCompressor(
+                level=LEVEL, dict_data=self.dictionaries[dictionary_id]
+            )
+        return self.compressors[dictionary_id].compress(text.encode())
+
+    def decompress(self, value: str | bytes | None) -> str | None:
+        """Return the text of a stored value, compressed or not."""
+        if not isinstance(value, bytes):
+            return value
+        dictionary_id = zstandard.get_frame_parameters(value).dict_id
+        if dictionary_id not in self.decompressors:
+            self.decompressors[dictionary_id] = (
+                zstandard.ZstdDecompressor(dict_data=self.dictionaries[dictionary_id])
+                if dictionary_id
+                else zstandard.ZstdDecompressor()
+            )
+        return self.decompressors[dictionary_id].decompress(value).decode()
+
+    def register(self, conn: sqlite3.Connection) -> None:
+        """Make decompress() available to the connection's queries."""
+        conn.create_function("decompress", 1, self.decompress, deterministic=True)
+
+
+def register(conn: sqlite3.Connection) -> Codec:
+    """Load the connection's dictionaries and register decompress() with it."""
+    codec = Codec(conn)
+    codec.register(conn)
+    return codec
@@ -0,0 +1,97 @@
+import glob
+import json
+import mmap
+import os
+from functools import cache
+
+# Each corpus directory holds one document per interview (resumes) or several
+# named <interview_id>_<question_id>.txt (questions). pack.py concatenates a
+# directory into <directory>.pack with an index of every document's offset and
+# length, in the order glob returned them, at <directory>.index.json.
+CORPORA = [
+    os.path.join("resumes", "redacted"),
+    os.path.join("resumes", "unredacted"),
+    os.path.join("resumes", "raw"),
+    os.path.join("questions", "redacted"),
+    os.path.join("questions", "unredacted"),
+    os.path.join("questions", "modified"),
+]
+
+################################################################################
+
+
+class Archive:
+    """A packed corpus directory, memory-mapped and indexed by interview."""
+
+    def __init__(self, directory: str):
+        with open(directory + ".index.json", "r") as f:
+            self.index = json.load(f)
+        self.file = open(directory + ".pack", "rb")
+        self.data = (
+            mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if os.fstat(self.file.fileno()).st_size
+            else b""
+        )
+
+    def documents(self, interview_id: int | str) -> list[tuple[str, str]]:
+        """Return the (name, text) of every document for the given interview."""
+        return [
+            (name, self.data[offset : offset + length].decode())
+            for name, offset, length in self.index.get(str(interview_id), [])
+        ]
+
+
+@cache
+def archive(directory: str) -> Archive | None:
+    """Open the packed archive of the directory once, if it has been packed."""
+    if not os.path.exists(directory + ".pack"):
+        return None
+    return Archive(directory)
+
+
+def documents(directory: str, interview_id: int | str) -> list[tuple[str, str]]:
+    """Return the (name, text) of every document for the interview, in glob order.
+
+    Falls back to reading the directory when it has not been packed.
+    """
+    archive_ = archive(directory)
+    if archive_ is not None:
+        return archive_.documents(interview_id)
+
+    paths = [os.path.join(directory, f"{interview_id}.txt")]
+    if not os.path.exists(paths[0]):
+        paths = glob.glob(os.path.join(directory, f"{interview_id}_*.txt"))
+    documents_ = []
+    for path in paths:
+        with open(path, "r") as f:
+            documents_.append((name(path), f.read()))
+    return documents_
+
+
+def name(path: str) -> str:
+    """Return a document's name within its interview, e.g., the question id."""
+    stem = os.path.basename(path)[: -len(".txt")]
+    return stem.split("_", 1)[1] if "_" in stem else ""
+
+
+def resume(variant: str, interview_id: int | str) -> str:
+    """Return the interview's resume from the given variant."""
+    documents_ = documents(os.path.join("resumes", variant), interview_id)
+    if not documents_:
+        raise FileNotFoundError(f"No {variant} resume for interview {interview_id}")
+    return documents_[0][1]
+
+
+def questions(variant: str, interview_id: int | str) -> list[str]:
+    """Return the interview's question transcripts from the given variant."""
+    return [
+        text for _, text in documents(os.path.join("questions", variant), interview_id)
+    ]
+
+
+def question_ids(variant: str, interview_id: int | str) -> list[str]:
+    """Return the ids of the interview's questions in the given variant."""
+    return [
+        name_
+        for name_, _ in documents(os.path.join("questions", variant), interview_id)
+    ]
@@ -0,0 +1,48 @@
+import asyncio
+
+import openai
+from aiolimiter import AsyncLimiter
+from botocore.exceptions import ClientError
+
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+# Failures of a prompt or extraction before it is given up on, even if every
+# failure looked transient
+MAX_ATTEMPTS = 3
+
+# Bedrock error codes worth retrying later
+TRANSIENT_CODES = {
+    "ThrottlingException",
+    "ServiceUnavailableException",
+    "ModelTimeoutException",
+    "ModelNotReadyException",
+    "InternalServerException",
+}
+
+################################################################################
+
+
+def classify(error: BaseException) -> str:
+    """Classify a failure as transient (worth re-driving) or permanent."""
+    if isinstance(error, (TimeoutError, ConnectionError, openai.APIConnectionError)):
+        return TRANSIENT
+    if isinstance(error, openai.APIStatusError):
+        transient = error.status_code in (408, 409, 429) or error.status_code >= 500
+        return TRANSIENT if transient else PERMANENT
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        return TRANSIENT if code in TRANSIENT_CODES else PERMANENT
+
+    # E.g., a prompt that overflows the context window
+    if isinstance(error, (ValueError, TypeError, KeyError)):
+        return PERMANENT
+    return TRANSIENT
+
+
+async def spare_capacity(
+    limits: list[tuple[AsyncLimiter, float]], interval: float = 1.0
+) -> None:
+    """Wait until every limiter has room, so that re-driven work yields to new work."""
+    while not all(limiter.has_capacity(amount) for limiter, amount in limits):
+        await asyncio.sleep(interval)
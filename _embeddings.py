@@ -0,0 +1,58 @@
+import sqlite3
+
+import numpy as np
+
+import _corpus
+
+MODEL = "text-embedding-3-large"
+
+# The model's native dimensionality. Shorter embeddings are the leading
+# dimensions renormalized, which is what the API returns for `dimensions`.
+DIMENSIONS = 3072
+
+################################################################################
+
+
+def document(interview_id: int | str, redacted: bool, use_resume: bool) -> str:
+    """Return the text embedded for the interview's resume or questions."""
+    folder = "redacted" if redacted else "unredacted"
+    if use_resume:
+        return _corpus.resume(folder, interview_id)
+    return "".join(
+        "\n\n" + question for question in _corpus.questions(folder, interview_id)
+    )
+
+
+def to_blob(vector: list[float]) -> bytes:
+    """Serialize an embedding as float32 bytes."""
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def truncate(X: np.ndarray, dimensions: int) -> np.ndarray:
+    """Keep the leading dimensions of each row and rescale it to unit length."""
+    if dimensions > X.shape[-1]:
+        raise ValueError(f"Cannot extend {X.shape[-1]} dimensions to {dimensions}")
+    X = X[..., :dimensions].astype(np.float64)
+    return X / np.linalg.norm(X, axis=-1, keepdims=True).clip(min=1e-12)
+
+
+def load(conn: sqlite3.Connection, dimensions: int = DIMENSIONS) -> dict:
+    """Load every stored embedding, truncated to the given dimensionality."""
+    rows = conn.execute(
+        """
+        SELECT interview_id, redacted, resume, vector
+        FROM embedding_vectors
+        ORDER BY interview_id, redacted, resume
+        """
+    ).fetchall()
+    X = (
+        np.stack([np.frombuffer(row[3], dtype=np.float32) for row in rows])
+        if rows
+        else np.empty((0, DIMENSIONS), dtype=np.float32)
+    )
+    return {
+        "interview_id": np.array([row[0] for row in rows], dtype=np.int64),
+        "redacted": np.array([row[1] for row in rows], dtype=bool),
+        "resume": np.array([row[2] for row in rows], dtype=bool),
+        "X": truncate(X, dimensions),
+    }
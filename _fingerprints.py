@@ -0,0 +1,46 @@
+import glob
+import hashlib
+import sqlite3
+
+################################################################################
+
+
+def digest(*parts: str | bytes | int | None) -> str:
+    """Hash the parts, so that no two different lists of parts collide."""
+    h = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode()
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def files(*patterns: str) -> str:
+    """Hash the paths and contents of every file matching the patterns."""
+    parts = []
+    for path in sorted({path for pattern in patterns for path in glob.glob(pattern)}):
+        with open(path, "rb") as f:
+            parts += [path, f.read()]
+    return digest(*parts)
+
+
+def rows(conn: sqlite3.Connection, query: str) -> str:
+    """Hash every row the query returns, in order."""
+    return digest(*(repr(tuple(row)) for row in conn.execute(query)))
+
+
+def load(conn: sqlite3.Connection, kind: str) -> dict[str, str]:
+    """Return the stored fingerprints of the given kind, by key."""
+    return dict(
+        conn.execute(
+            "SELECT key, fingerprint FROM fingerprints WHERE kind = ?", (kind,)
+        )
+    )
+
+
+def store(conn: sqlite3.Connection, kind: str, fingerprints: dict) -> None:
+    """Store fingerprints by key, replacing any stored for the same keys."""
+    conn.executemany(
+        "INSERT OR REPLACE INTO fingerprints (kind, key, fingerprint) VALUES (?, ?, ?)",
+        [(kind, str(key), fingerprint) for key, fingerprint in fingerprints.items()],
+    )
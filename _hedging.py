@@ -0,0 +1,139 @@
+import asyncio
+import bisect
+import contextvars
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+from aiolimiter import AsyncLimiter
+
+# Seconds a single provider call may take, not counting time spent waiting on
+# the rate limiters. None disables the deadline.
+DEADLINE = 120.0
+
+# Whether to send a duplicate of a call that runs longer than the model's p95
+HEDGE = False
+
+# Calls to observe before a model's p95 is trusted
+MIN_SAMPLES = 50
+
+# The hedges of the request being sent, which chat.py records with it
+HEDGES = contextvars.ContextVar("HEDGES", default=None)
+
+################################################################################
+
+
+class Latencies:
+    """A model's recent call latencies."""
+
+    def __init__(self, window: int = 1000):
+        self.window = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        self.window.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        """Return the q-th percentile, or None until there are enough samples."""
+        if len(self.window) < MIN_SAMPLES:
+            return None
+        ordered = sorted(self.window)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+    def residual(self, elapsed: float) -> float:
+        """Estimate how much longer a call that has run this long would take."""
+        ordered = sorted(self.window)
+        longer = ordered[bisect.bisect_right(ordered, elapsed) :]
+        return sum(longer) / len(longer) - elapsed if longer else 0.0
+
+
+LATENCIES = {}
+
+
+def configure(deadline: float | None, hedge: bool) -> None:
+    """Set the deadline and hedging for every later call."""
+    global DEADLINE, HEDGE
+    DEADLINE, HEDGE = deadline, hedge
+
+
+async def _limited(
+    make_call: Callable[[], Awaitable], limits: list[tuple[AsyncLimiter, float]]
+):
+    for limiter, amount in limits:
+        await limiter.acquire(amount)
+    return await make_call()
+
+
+async def call(
+    model: str,
+    make_call: Callable[[], Awaitable],
+    limits: list[tuple[AsyncLimiter, float]] | None = None,
+):
+    """Make a provider call under the deadline, hedging it if it runs long.
+
+    A hedge is only sent if every limiter in `limits` has room for its amount,
+    and it is charged to them. The first call to succeed wins and the other is
+    cancelled; a TimeoutError is raised if neither answers by the deadline.
+    """
+    latencies = LATENCIES.setdefault(model, Latencies())
+    start = time.monotonic()
+    deadline = None if DEADLINE is None else start + DEADLINE
+    hedge_at = latencies.percentile(95) if HEDGE else None
+    hedge_delay = None
+    tasks = {asyncio.create_task(make_call()): "primary"}
+    try:
+        while True:
+            # Wake up at the deadline or, until a hedge is considered, the p95
+            wake = [] if deadline is None else [deadline]
+            if hedge_at is not None:
+                wake.append(start + hedge_at)
+            done, _ = await asyncio.wait(
+                tasks,
+                timeout=max(min(wake) - time.monotonic(), 0) if wake else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+
+            # The first call to succeed wins; a failure waits for the other
+            for task in done:
+                winner = tasks.pop(task)
+                if task.exception() is not None and tasks:
+                    continue
+                result = task.result()
+                elapsed = time.monotonic() - start
+                hedges = HEDGES.get()
+                if hedge_delay is not None and hedges is not None:
+                    hedges.append(
+                        {
+                            "hedge_delay": hedge_delay,
+                            "latency": elapsed,
+                            "winner": winner,
+                            "saved": (
+                                latencies.residual(elapsed)
+                                if winner == "hedge"
+                                else 0.0
+                            ),
+                        }
+                    )
+                latencies.record(elapsed)
+                return result
+            if done:
+                continue
+
+            # A call that times out took at least the deadline
+            if deadline is not None and time.monotonic() >= deadline:
+                latencies.record(DEADLINE)
+                raise TimeoutError(f"No response within {DEADLINE} seconds")
+
+            # The call has outlived the model's p95, so hedge it if there is room
+            # in the rate budget
+            if hedge_at is not None and time.monotonic() >= start + hedge_at:
+                hedge_at = None
+                if all(
+                    limiter.has_capacity(amount) for limiter, amount in limits or []
+                ):
+                    hedge_delay = time.monotonic() - start
+                    tasks[
+                        asyncio.create_task(_limited(make_call, limits or []))
+                    ] = "hedge"
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+import time
+
+import httpx
+import openai
+
+import _ratelimiters
+
+# Idle keep-alive connections are closed after this many seconds
+KEEPALIVE_EXPIRY = 60.0
+
+# Generations can take minutes to start returning; the per-call deadline in
+# _hedging is what bounds a call. The pool timeout only trips if far more calls
+# are in flight than MAX_CONNECTIONS allows for.
+TIMEOUT = httpx.Timeout(600.0, connect=10.0, pool=60.0)
+
+################################################################################
+
+
+class Transport(httpx.AsyncHTTPTransport):
+    """An HTTP/2 connection pool that counts how much of it is in use."""
+
+    def __init__(self, max_connections: int):
+        super().__init__(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+        )
+        self.max_connections = max_connections
+        self.requests = 0
+        self.http2 = 0
+        self.connections = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+        # Integral of in_flight over time, for the time-weighted mean
+        self.start = None
+        self.changed = None
+        self.area = 0.0
+
+    def _count(self, change: int) -> None:
+        now = time.monotonic()
+        if self.start is None:
+            self.start = self.changed = now
+        self.area += self.in_flight * (now - self.changed)
+        self.changed = now
+        self.in_flight += change
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    async def _trace(self, event: str, info: dict) -> None:
+        if event == "connection.connect_tcp.complete":
+            self.connections += 1
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request.extensions = {**request.extensions, "trace": self._trace}
+        self.requests += 1
+        self._count(1)
+        try:
+            response = await super().handle_async_request(request)
+        finally:
+            self._count(-1)
+        if response.extensions.get("http_version") == b"HTTP/2":
+            self.http2 += 1
+        return response
+
+    def report(self) -> str:
+        """Summarize how many requests shared how many connections."""
+        if not self.requests:
+            return "HTTP pool: no requests."
+        elapsed = time.monotonic() - self.start
+        mean = (self.area + self.in_flight * (time.monotonic() - self.changed)) / (
+            elapsed or 1
+        )
+        return (
+            f"HTTP pool: {self.requests} requests over {self.connections} new "
+            f"connections ({self.http2 / self.requests:.0%} HTTP/2). Requests "
+            f"waiting for a connection or response: mean {mean:.1f}, peak "
+            f"{self.peak_in_flight}, with {self.max_connections} connections "
+            f"allowed."
+        )
+
+
+TRANSPORT = Transport(_ratelimiters.MAX_CONNECTIONS)
+HTTP = httpx.AsyncClient(transport=TRANSPORT, timeout=TIMEOUT, follow_redirects=True)
+
+# The one OpenAI client, so that chat, extraction, and embedding calls made by
+# the same process share keep-alive connections
+OPENAI = openai.AsyncOpenAI(
+    api_key=os.environ["OPENAI_API_KEY"],
+    organization=os.environ.get("OPENAI_API_ORG"),
+    http_client=HTTP,
+)
+
+
+async def prewarm(n_connections: int = 1) -> None:
+    """Open connections to the API before a run, so the first calls skip the
+    TCP and TLS handshakes.
+
+    Over HTTP/2 one connection carries every call, so more are only useful if
+    the API falls back to HTTP/1.1.
+    """
+    n_connections = min(n_connections, TRANSPORT.max_connections)
+    results = await asyncio.gather(
+        *(HTTP.head(str(OPENAI.base_url)) for _ in range(n_connections)),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logging.warning(f"Could not pre-warm a connection: {result!r}")
+
+
+async def close() -> None:
+    """Close the pool's connections."""
+    await HTTP.aclose()
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import re
+import time
+
+import numpy as np
+
+# asyncio's debug mode logs every callback that holds the loop for longer than
+# loop.slow_callback_duration, e.g., "Executing <Task ...> took 0.123 seconds"
+SLOW_CALLBACK = re.compile(
+    r"Executing (?P<callback>.*) took (?P<seconds>[\d.]+) seconds"
+)
+
+################################################################################
+
+
+class _SlowCallbacks(logging.Handler):
+    """Collect the slow callbacks asyncio reports in debug mode."""
+
+    def __init__(self):
+        super().__init__(level=logging.WARNING)
+        self.callbacks = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        match = SLOW_CALLBACK.search(record.getMessage())
+        if match:
+            self.callbacks.append(
+                (float(match.group("seconds")), match.group("callback"))
+            )
+
+
+class LoopMonitor:
+    """Measure event loop lag and collect the slowest blocking callbacks.
+
+    Lag is how late a sleep of `interval` seconds wakes up, i.e., how long
+    ready callbacks waited behind whatever was blocking the loop.
+    """
+
+    def __init__(self, interval: float = 0.1, slow_callback: float = 0.05):
+        self.interval = interval
+        self.slow_callback = slow_callback
+        self.lags = []
+        self.handler = _SlowCallbacks()
+        self.task = None
+
+    async def _sample(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.perf_counter() - start - self.interval)
+
+    def start(self) -> None:
+        """Start sampling the running loop's lag and collecting slow callbacks."""
+        loop = asyncio.get_running_loop()
+        loop.set_debug(True)
+        loop.slow_callback_duration = self.slow_callback
+        logging.getLogger("asyncio").addHandler(self.handler)
+        self.task = asyncio.create_task(self._sample())
+
+    async def stop(self) -> None:
+        """Stop monitoring and restore the loop's settings."""
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        logging.getLogger("asyncio").removeHandler(self.handler)
+        asyncio.get_running_loop().set_debug(False)
+
+    def report(self, n_slowest: int = 10) -> str:
+        """Summarize the lag and list the slowest callbacks."""
+        if not self.lags:
+            return "Event loop lag: no samples."
+        lags = np.array(self.lags) * 1000
+        lines = [
+            f"Event loop lag over {len(lags)} samples: "
+            f"p50 {np.percentile(lags, 50):.1f} ms, "
+            f"p99 {np.percentile(lags, 99):.1f} ms, max {lags.max():.1f} ms.",
+            f"{len(self.handler.callbacks)} callbacks blocked the loop for over "
+            f"{self.slow_callback * 1000:.0f} ms.",
+        ]
+        for seconds, callback in sorted(self.handler.callbacks, reverse=True)[
+            :n_slowest
+        ]:
+            lines.append(f"  {seconds * 1000:.1f} ms: {callback[:200]}")
+        return "\n".join(lines)
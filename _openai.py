@@ -1,15 +1,22 @@
 import logging
-import os
-from asyncio import sleep
+from asyncio import sleep, to_thread
+from functools import partial
 
 import openai
-import tiktoken
 from aiolimiter import AsyncLimiter
+from pydantic import BaseModel
 
-CLIENT = openai.AsyncOpenAI(
-    api_key=os.environ["OPENAI_API_KEY"],
-    organization=os.environ.get("OPENAI_API_ORG"),
-)
+import _budgets
+import _hedging
+import _http
+import _schemas
+import _tokens
+
+CLIENT = _http.OPENAI
+
+# Models that accept a JSON schema as the response format. The others are
+# limited to JSON mode.
+STRUCTURED_MODELS = ["gpt-4o-mini-2024-07-18"]
 
 ################################################################################
 
@@ -21,26 +28,64 @@ async def _chat_gpt(
     request_limiter: AsyncLimiter,
     token_limiter: AsyncLimiter,
     max_retries: int = 4,
-) -> str | None:
-    """Call the given OpenAI model with the given prompt and system_message."""
+    n_tokens: int | None = None,
+    max_tokens: int = _budgets.DEFAULT_MAX_TOKENS,
+    stop: list[str] | None = None,
+    schema: type[BaseModel] | None = None,
+    n: int = 1,
+) -> list[_budgets.Completion] | None:
+    """Call the given OpenAI model with the given prompt and system_message.
+
+    With n > 1, the n samples share a single call, so the prompt is only sent
+    (and paid for) once.
+    """
+    response_format = {"type": "json_object"}
+    if schema is not None and model in STRUCTURED_MODELS:
+        response_format = {
+            "type": "json_schema",
+            "json_schema": {
+                "name": schema.__name__,
+                "schema": _schemas.json_schema(schema),
+                "strict": True,
+            },
+        }
     retries = 0
     wait_time = 1
-    encoding = tiktoken.encoding_for_model(model)
-    n_tokens = len(encoding.encode(prompt)) + len(encoding.encode(system_message))
+    if n_tokens is None:
+        # Tokenizing a long prompt would block the event loop
+        n_tokens = await to_thread(_tokens.count_prompt, model, system_message, prompt)
+    _tokens.check_context(model, n_tokens, max_tokens)
     while retries < max_retries:
         try:
-            await token_limiter.acquire(n_tokens)
+            # OpenAI counts the output budget against the token limit up front
+            await token_limiter.acquire(n_tokens + n * max_tokens)
             async with request_limiter:
-                response = await CLIENT.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "system", "content": system_message},
-                        {"role": "user", "content": prompt},
-                    ],
-                    response_format={"type": "json_object"},
+                response = await _hedging.call(
+                    model,
+                    partial(
+                        CLIENT.chat.completions.create,
+                        model=model,
+                        messages=[
+                            {"role": "system", "content": system_message},
+                            {"role": "user", "content": prompt},
+                        ],
+                        response_format=response_format,
+                        max_tokens=max_tokens,
+                        stop=stop or None,
+                        n=n,
+                    ),
+                    [(token_limiter, n_tokens + n * max_tokens), (request_limiter, 1)],
+                )
+            # Usage is only reported for all the samples together
+            return [
+                _budgets.Completion(
+                    choice.message.content,
+                    response.usage.completion_tokens if n == 1 else None,
+                    choice.finish_reason == "length",
                 )
-            return response.choices[0].message.content
-        except openai.OpenAIError as e:
+                for choice in response.choices
+            ]
+        except (openai.OpenAIError, TimeoutError) as e:
             logging.error("OpenAI error: %s", e)
             if retries >= max_retries:
                 raise e
@@ -0,0 +1,162 @@
+import sqlite3
+
+# Both queries read text through decompress(), which _compress.register() adds
+
+# Prompts a model has yet to answer the given number of times. The answered
+# prompts come from the main database and, when writing to one, the shard.
+# Requests that failed transiently do not count, so their prompts are re-driven
+# until they have failed :max_attempts times, after everything else. A failed
+# call is recorded as one request, so each counts as one attempt. A permanent
+# failure retires the prompt.
+PENDING_PROMPTS = """
+SELECT
+    prompts.prompt_id,
+    decompress(prompts.system_message) AS system_message,
+    decompress(prompts.prompt) AS prompt,
+    prompts.interview_id,
+    personas.race,
+    personas.gender,
+    (
+        SELECT COUNT(*)
+        FROM prompts AS interview_prompts
+        WHERE interview_prompts.interview_id = prompts.interview_id
+        AND interview_prompts.experiment_type = :experiment
+    ) AS n_interview,
+    prompt_tokens.n_tokens,
+    COALESCE(model_requests.n_done, 0) AS n_done,
+    COALESCE(model_requests.n_failed, 0) AS n_failed
+FROM prompts
+LEFT JOIN personas ON prompts.persona_id = personas.persona_id
+LEFT JOIN prompt_tokens
+ON prompts.prompt_id = prompt_tokens.prompt_id
+AND prompt_tokens.family = :family
+LEFT JOIN (
+    SELECT
+        prompt_id,
+        SUM(NOT error) AS n_done,
+        SUM(error AND failure IS 'transient') AS n_failed,
+        SUM(error AND failure IS NOT 'transient') AS n_permanent
+    FROM (
+        {main_attempts}
+        {shard_attempts}
+    )
+    GROUP BY prompt_id
+) AS model_requests ON prompts.prompt_id = model_requests.prompt_id
+WHERE COALESCE(model_requests.n_done, 0) < :replicates
+AND COALESCE(model_requests.n_failed, 0) < :max_attempts
+AND COALESCE(model_requests.n_permanent, 0) = 0
+AND prompts.experiment_type = :experiment
+AND {partition} % :n_workers = :worker
+ORDER BY COALESCE(model_requests.n_failed, 0) > 0
+LIMIT :n_max
+"""
+
+# Every request for the model, with how it failed, if it did
+ATTEMPTS = """
+SELECT requests.prompt_id, requests.error, dead_letters.failure
+FROM {schema}.requests AS requests
+LEFT JOIN {schema}.dead_letters AS dead_letters
+ON requests.request_id = dead_letters.request_id
+AND dead_letters.stage = 'chat'
+WHERE requests.model = :model
+"""
+
+# Successful responses of the given kind that have yet to be extracted. Failed
+# extractions are re-driven, after everything else, until they fail permanently
+# or :max_attempts times.
+PENDING_EXTRACTIONS = """
+SELECT
+    requests.request_id,
+    requests.prompt_id,
+    requests.model,
+    decompress(requests.raw_response) AS raw_response,
+    COALESCE(dead_letters.attempts, 0) AS n_failed
+FROM {schema}.requests AS requests
+LEFT JOIN prompts
+ON requests.prompt_id = prompts.prompt_id
+LEFT JOIN {schema}.{kind} AS {kind}
+ON requests.request_id = {kind}.request_id
+LEFT JOIN {schema}.dead_letters AS dead_letters
+ON requests.request_id = dead_letters.request_id
+AND dead_letters.stage = '{kind}'
+WHERE {operator} prompts.experiment_type = 'manipulation_check'
+AND {kind}.request_id IS NULL
+AND NOT requests.error
+AND (
+    dead_letters.request_id IS NULL
+    OR dead_letters.failure = 'transient'
+    AND dead_letters.attempts < :max_attempts
+)
+ORDER BY dead_letters.request_id IS NOT NULL
+LIMIT :n_max
+"""
+
+################################################################################
+
+
+def pending_prompts(schema: str, balanced: bool) -> str:
+    """Return the pending prompts query for the schema written to."""
+    return PENDING_PROMPTS.format(
+        main_attempts=ATTEMPTS.format(schema="main"),
+        shard_attempts=(
+            "" if schema == "main" else "UNION ALL" + ATTEMPTS.format(schema="shard")
+        ),
+        partition="prompts.interview_id" if balanced else "prompts.prompt_id",
+    )
+
+
+def pending_extractions(schema: str, kind: str) -> str:
+    """Return the pending extractions query for the schema written to."""
+    return PENDING_EXTRACTIONS.format(
+        schema=schema,
+        kind=kind,
+        operator="" if kind == "checks" else "NOT",
+    )
+
+
+def cases(schema: str) -> list[tuple[str, str, dict, set[str]]]:
+    """List the hot queries as (name, query, parameters, tables they may scan).
+
+    Extraction walks every request it has not yet seen, so its driving scan of
+    requests is expected; every other table should be searched by an index.
+    """
+    prompt_parameters = {
+        "experiment": "hiring",
+        "model": "gpt-4o-mini-2024-07-18",
+        "family": "o200k_base",
+        "worker": 0,
+        "n_workers": 1,
+        "n_max": -1,
+        "replicates": 1,
+        "max_attempts": 3,
+    }
+    return [
+        (
+            f"pending prompts ({schema}, {order})",
+            pending_prompts(schema, order == "balanced"),
+            prompt_parameters,
+            set(),
+        )
+        for order in ["any", "balanced"]
+    ] + [
+        (
+            f"pending {kind} ({schema})",
+            pending_extractions(schema, kind),
+            {"n_max": -1, "max_attempts": 3},
+            {"requests"},
+        )
+        for kind in ["ratings", "checks"]
+    ]
+
+
+def scans(conn: sqlite3.Connection, query: str, parameters: dict) -> list[str]:
+    """Return the full scans of tables and indexes in the query's plan.
+
+    Scans of a subquery's results, e.g., "SCAN (subquery-1)", are not counted.
+    """
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {query}", parameters).fetchall()
+    return [
+        detail
+        for _, _, _, detail in plan
+        if detail.startswith("SCAN ") and not detail.startswith("SCAN (")
+    ]
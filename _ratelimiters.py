@@ -1,37 +1,259 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
 from asyncio import Semaphore
+from functools import cache
 
 from aiolimiter import AsyncLimiter
 
-CONNECTION_LIMITER = Semaphore(100)
+# Provider calls in flight at once per process, and the size of the HTTP pools
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", 100))
+
+CONNECTION_LIMITER = Semaphore(MAX_CONNECTIONS)
+
+# Where the request and token buckets live: "memory" (each process has its
+# own), "sqlite" (a ledger file shared by every process on the host), or
+# "server" (a ratelimit_server.py shared by every host)
+BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+LEDGER = os.environ.get("RATE_LIMIT_LEDGER", "ratelimits.db")
+SERVER = os.environ.get("RATE_LIMIT_SERVER", "localhost:8765")
+
+################################################################################
+# Shared buckets
+
+
+class Ledger:
+    """Leaky buckets kept in a SQLite file, so that their levels are shared and
+    survive restarts."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(
+                self.path, isolation_level=None, timeout=60, check_same_thread=False
+            )
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS buckets (
+                    name TEXT PRIMARY KEY,
+                    level REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+                """
+            )
+        return self.conn
+
+    def reserve(
+        self, name: str, amount: float, max_rate: float, time_period: float
+    ) -> tuple[float, float]:
+        """Add the amount to the bucket if it fits, returning (wait, level).
+
+        The wait is zero if the amount was added, and otherwise how long the
+        bucket needs to drain before it fits. The level is the bucket's level
+        afterwards.
+        """
+        with self.lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT level, updated FROM buckets WHERE name = ?", (name,)
+                ).fetchone()
+                now = time.time()
+                rate = max_rate / time_period
+                level = 0.0 if row is None else max(0.0, row[0] - (now - row[1]) * rate)
+                if level + amount <= max_rate:
+                    level += amount
+                    wait = 0.0
+                    conn.execute(
+                        """
+                        INSERT INTO buckets (name, level, updated) VALUES (?, ?, ?)
+                        ON CONFLICT (name)
+                        DO UPDATE SET level = excluded.level, updated = excluded.updated
+                        """,
+                        (name, level, now),
+                    )
+                else:
+                    wait = (level + amount - max_rate) / rate
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+        return wait, level
+
+
+class _Client:
+    """A connection to a ratelimit_server.py, shared by the process's limiters."""
+
+    def __init__(self, address: str):
+        self.host, port = address.rsplit(":", 1)
+        self.port = int(port)
+        self.streams = None
+        self.lock = None
+
+    async def reserve(
+        self, name: str, amount: float, max_rate: float, time_period: float
+    ) -> tuple[float, float]:
+        """Ask the server to add the amount to the bucket, returning (wait, level)."""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.streams is None:
+                self.streams = await asyncio.open_connection(self.host, self.port)
+            reader, writer = self.streams
+            try:
+                writer.write(
+                    json.dumps(
+                        {
+                            "name": name,
+                            "amount": amount,
+                            "max_rate": max_rate,
+                            "time_period": time_period,
+                        }
+                    ).encode()
+                    + b"\n"
+                )
+                await writer.drain()
+                response = json.loads(await reader.readline())
+            except (OSError, ValueError):
+                # Reconnect on the next call
+                writer.close()
+                self.streams = None
+                raise
+        return response["wait"], response["level"]
+
+
+class SharedLimiter:
+    """A drop-in replacement for AsyncLimiter whose bucket lives outside the
+    process, named so that every process using the same quota shares it."""
+
+    def __init__(
+        self, name: str, max_rate: float, time_period: float, backend: Ledger | _Client
+    ):
+        self.name = name
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self.backend = backend
+        self.level = 0.0
+        self.updated = 0.0
+
+    async def _reserve(self, amount: float) -> float:
+        if isinstance(self.backend, Ledger):
+            wait, level = await asyncio.to_thread(
+                self.backend.reserve,
+                self.name,
+                amount,
+                self.max_rate,
+                self.time_period,
+            )
+        else:
+            wait, level = await self.backend.reserve(
+                self.name, amount, self.max_rate, self.time_period
+            )
+        self.level, self.updated = level, time.time()
+        return wait
+
+    def has_capacity(self, amount: float = 1) -> bool:
+        """Estimate, from the last reservation, whether the amount would fit."""
+        rate = self.max_rate / self.time_period
+        level = max(0.0, self.level - (time.time() - self.updated) * rate)
+        return level + amount <= self.max_rate
+
+    async def acquire(self, amount: float = 1) -> None:
+        """Wait until the amount fits in the shared bucket, then add it."""
+        if amount > self.max_rate:
+            raise ValueError("Can't acquire more than the maximum capacity")
+        while (wait := await self._reserve(amount)) > 0:
+            await asyncio.sleep(wait)
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        return None
+
+
+@cache
+def _backend() -> Ledger | _Client:
+    return Ledger(LEDGER) if BACKEND == "sqlite" else _Client(SERVER)
+
+
+def limiter(
+    name: str, max_rate: float, time_period: float = 60
+) -> AsyncLimiter | SharedLimiter:
+    """Return a limiter for the named quota on the configured backend."""
+    if BACKEND == "memory":
+        return AsyncLimiter(max_rate, time_period)
+    if BACKEND not in ("sqlite", "server"):
+        raise ValueError(f"Unknown rate limit backend: {BACKEND}")
+    return SharedLimiter(name, max_rate, time_period, _backend())
+
+
+################################################################################
+# Quotas
+
+REQUEST_LIMITS = {
+    "gpt-3.5-turbo-0125": (500, 3),
+    "gpt-4-0125-preview": (250, 3),
+    "gpt-4o-mini-2024-07-18": (500, 3),
+    "gpt-4o-2024-05-13": (250, 3),
+    "anthropic.claude-v2:1": (5, 4),
+    "anthropic.claude-3-5-sonnet-20240620-v1:0": (5, 6),
+    "anthropic.claude-3-sonnet-20240229-v1:0": (5, 4),
+    "anthropic.claude-3-haiku-20240307-v1:0": (15, 5),
+    "anthropic.claude-instant-v1": (15, 5),
+    "mistral.mistral-7b-instruct-v0:2": (30, 5),
+    "mistral.mixtral-8x7b-instruct-v0:1": (15, 5),
+    "meta.llama3-1-8b-instruct-v1:0": (20, 3),
+    "meta.llama3-1-70b-instruct-v1:0": (10, 3),
+}
+
+TOKEN_LIMITS = {
+    "gpt-3.5-turbo-0125": (500_000, 15),
+    "gpt-4-0125-preview": (150_000, 15),
+    "gpt-4o-mini-2024-07-18": (500_000, 15),
+    "gpt-4o-2024-05-13": (500_000, 15),
+    "anthropic.claude-v2:1": (12_500, 5),
+    "anthropic.claude-3-5-sonnet-20240620-v1:0": (25_000, 5),
+    "anthropic.claude-3-sonnet-20240229-v1:0": (12_500, 5),
+    "anthropic.claude-3-haiku-20240307-v1:0": (18_750, 5),
+    "anthropic.claude-instant-v1": (18_750, 5),
+    "mistral.mistral-7b-instruct-v0:2": (18_750, 5),
+    "mistral.mixtral-8x7b-instruct-v0:1": (18_750, 5),
+    "meta.llama3-1-8b-instruct-v1:0": (12_000, 3),
+    "meta.llama3-1-70b-instruct-v1:0": (12_000, 3),
+}
 
 REQUEST_LIMITER = {
-    "gpt-3.5-turbo-0125": AsyncLimiter(500, 3),
-    "gpt-4-0125-preview": AsyncLimiter(250, 3),
-    "gpt-4o-mini-2024-07-18": AsyncLimiter(500, 3),
-    "gpt-4o-2024-05-13": AsyncLimiter(250, 3),
-    "anthropic.claude-v2:1": AsyncLimiter(5, 4),
-    "anthropic.claude-3-5-sonnet-20240620-v1:0": AsyncLimiter(5, 6),
-    "anthropic.claude-3-sonnet-20240229-v1:0": AsyncLimiter(5, 4),
-    "anthropic.claude-3-haiku-20240307-v1:0": AsyncLimiter(15, 5),
-    "anthropic.claude-instant-v1": AsyncLimiter(15, 5),
-    "mistral.mistral-7b-instruct-v0:2": AsyncLimiter(30, 5),
-    "mistral.mixtral-8x7b-instruct-v0:1": AsyncLimiter(15, 5),
-    "meta.llama3-1-8b-instruct-v1:0": AsyncLimiter(20, 3),
-    "meta.llama3-1-70b-instruct-v1:0": AsyncLimiter(10, 3),
+    model: limiter(f"requests:{model}", *limits)
+    for model, limits in REQUEST_LIMITS.items()
 }
 
 TOKEN_LIMITER = {
-    "gpt-3.5-turbo-0125": AsyncLimiter(500_000, 15),
-    "gpt-4-0125-preview": AsyncLimiter(150_000, 15),
-    "gpt-4o-mini-2024-07-18": AsyncLimiter(500_000, 15),
-    "gpt-4o-2024-05-13": AsyncLimiter(500_000, 15),
-    "anthropic.claude-v2:1": AsyncLimiter(12_500, 5),
-    "anthropic.claude-3-5-sonnet-20240620-v1:0": AsyncLimiter(25_000, 5),
-    "anthropic.claude-3-sonnet-20240229-v1:0": AsyncLimiter(12_500, 5),
-    "anthropic.claude-3-haiku-20240307-v1:0": AsyncLimiter(18_750, 5),
-    "anthropic.claude-instant-v1": AsyncLimiter(18_750, 5),
-    "mistral.mistral-7b-instruct-v0:2": AsyncLimiter(18_750, 5),
-    "mistral.mixtral-8x7b-instruct-v0:1": AsyncLimiter(18_750, 5),
-    "meta.llama3-1-8b-instruct-v1:0": AsyncLimiter(12_000, 3),
-    "meta.llama3-1-70b-instruct-v1:0": AsyncLimiter(12_000, 3),
+    model: limiter(f"tokens:{model}", *limits) for model, limits in TOKEN_LIMITS.items()
 }
+
+# Limiters for the additional Bedrock regions a model is spread over, keyed by
+# (model, region). Bedrock quotas are per region, so each region gets the same
+# limits as the model's home region.
+REGION_LIMITERS = {}
+
+
+def region_limiters(
+    model: str, region: str
+) -> tuple[AsyncLimiter | SharedLimiter, AsyncLimiter | SharedLimiter]:
+    """Return the request and token limiters for the given model and region."""
+    if (model, region) not in REGION_LIMITERS:
+        REGION_LIMITERS[(model, region)] = (
+            limiter(f"requests:{model}@{region}", *REQUEST_LIMITS[model]),
+            limiter(f"tokens:{model}@{region}", *TOKEN_LIMITS[model]),
+        )
+    return REGION_LIMITERS[(model, region)]
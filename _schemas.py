@@ -0,0 +1,107 @@
+from typing import Annotated, Optional
+
+from pydantic import BaseModel, Field, conint, field_validator
+
+
+class RatingResponse(BaseModel):
+    """A rating response from the model."""
+
+    summary: Optional[str] = None
+    professionalism: conint(ge=1, le=5)
+    experience: conint(ge=1, le=5)
+    fit: conint(ge=1, le=5)
+    hire: conint(ge=1, le=5)
+
+
+class NoScratchRatingResponse(BaseModel):
+    """A rating response without the summary, which no_scratch leaves out."""
+
+    professionalism: conint(ge=1, le=5)
+    experience: conint(ge=1, le=5)
+    fit: conint(ge=1, le=5)
+    hire: conint(ge=1, le=5)
+
+
+class HiringRatingResponse(RatingResponse):
+    """A rating response whose hire rating is keyed "hiring", as variant_2 asks."""
+
+    hire: conint(ge=1, le=5) = Field(alias="hiring")
+
+
+class CheckResponse(BaseModel):
+    """A demographic response from the model."""
+
+    name: Optional[str] = None
+    race: Annotated[str, Field(pattern=r"(?i)^(Asian|Black|Hispanic|White|NA)$")]
+    gender: Annotated[str, Field(pattern=r"(?i)^(male|female|NA)$")]
+
+    @field_validator("race")
+    @classmethod
+    def upper_case_race(cls, value):
+        return value.capitalize()
+
+    @field_validator("gender")
+    @classmethod
+    def lower_case_gender(cls, value):
+        return value.lower()
+
+
+class Error(BaseModel):
+    """An error response from the model."""
+
+    error: bool = True
+    error_message: str
+
+
+# The response each experiment asks for
+SCHEMAS = {"ratings": RatingResponse, "checks": CheckResponse}
+
+# Experiments whose system message asks for other keys than their kind's schema.
+# Enforcing the kind's schema on them would override the treatment.
+EXPERIMENT_SCHEMAS = {
+    "no_scratch": NoScratchRatingResponse,
+    "variant_2": HiringRatingResponse,
+}
+
+# JSON Schema keywords that providers' structured output modes reject. The
+# responses are still validated against the full schema afterwards.
+UNSUPPORTED = {"title", "default", "minimum", "maximum", "pattern"}
+
+################################################################################
+
+
+def kind(experiment: str) -> str:
+    """Return the kind of response the given experiment asks for."""
+    return "checks" if experiment == "manipulation_check" else "ratings"
+
+
+def for_experiment(experiment: str) -> type[BaseModel]:
+    """Return the response schema the given experiment's system message asks for."""
+    return EXPERIMENT_SCHEMAS.get(experiment, SCHEMAS[kind(experiment)])
+
+
+def json_schema(schema: type[BaseModel]) -> dict:
+    """Return a strict JSON Schema for the model that providers accept."""
+
+    def simplify(node):
+        if isinstance(node, dict):
+            return {
+                key: simplify(value)
+                for key, value in node.items()
+                if key not in UNSUPPORTED
+            }
+        if isinstance(node, list):
+            return [simplify(value) for value in node]
+        return node
+
+    schema_ = simplify(schema.model_json_schema())
+    schema_["required"] = list(schema_["properties"])
+    schema_["additionalProperties"] = False
+    return schema_
+
+
+def complete_prefill(prefill: str, text: str) -> str:
+    """Restore a prefilled opening and drop anything after the closing brace."""
+    text = prefill + text
+    end = text.rfind("}")
+    return text[: end + 1] if end >= 0 else text
@@ -0,0 +1,53 @@
+import os
+import sqlite3
+
+# Tables that chat.py and extract.py write, and so the only tables in a shard
+RESULT_TABLES = [
+    "requests",
+    "completions",
+    "replicates",
+    "hedges",
+    "dead_letters",
+    "ratings",
+    "checks",
+]
+
+################################################################################
+
+
+def create(path: str, source: str = "data.db") -> None:
+    """Create a shard with the same result tables and indexes as the source."""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with sqlite3.connect(source) as conn:
+        statements = conn.execute(
+            f"""
+            SELECT name, sql FROM sqlite_master
+            WHERE tbl_name IN ({",".join("?" * len(RESULT_TABLES))})
+            AND type IN ('table', 'index')
+            AND sql IS NOT NULL
+            ORDER BY type DESC
+            """,
+            RESULT_TABLES,
+        ).fetchall()
+
+    with sqlite3.connect(path) as conn:
+        existing = {name for (name,) in conn.execute("SELECT name FROM sqlite_master")}
+        for name, statement in statements:
+            if name not in existing:
+                conn.execute(statement)
+
+
+def attach(conn: sqlite3.Connection, path: str) -> str:
+    """Attach the shard at the given path and return the schema to write to."""
+    if os.path.abspath(path) == os.path.abspath("data.db"):
+        return "main"
+    create(path)
+    conn.execute("ATTACH DATABASE ? AS shard", (path,))
+    return "shard"
+
+
+def columns(conn: sqlite3.Connection, schema: str, table: str) -> list[str]:
+    """Return the column names of the given table."""
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
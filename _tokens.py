@@ -0,0 +1,97 @@
+import threading
+from functools import cache
+
+import tiktoken
+from tiktoken.model import encoding_name_for_model
+
+# Bedrock does not expose tokenizers for its models, so their token counts are
+# approximated as four characters per token
+APPROXIMATE = "approximate"
+
+CONTEXT_WINDOW = {
+    "gpt-3.5-turbo-0125": 16_385,
+    "gpt-4-0125-preview": 128_000,
+    "gpt-4o-mini-2024-07-18": 128_000,
+    "gpt-4o-2024-05-13": 128_000,
+    "anthropic.claude-v2:1": 200_000,
+    "anthropic.claude-3-5-sonnet-20240620-v1:0": 200_000,
+    "anthropic.claude-3-sonnet-20240229-v1:0": 200_000,
+    "anthropic.claude-3-haiku-20240307-v1:0": 200_000,
+    "anthropic.claude-instant-v1": 100_000,
+    "mistral.mistral-7b-instruct-v0:2": 32_000,
+    "mistral.mixtral-8x7b-instruct-v0:1": 32_000,
+    "meta.llama3-1-8b-instruct-v1:0": 128_000,
+    "meta.llama3-1-70b-instruct-v1:0": 128_000,
+}
+
+# Memoized counts, keyed by (family, text). Counting runs in worker threads, so
+# the cache is guarded by a lock.
+_COUNTS = {}
+_MAX_COUNTS = 2**16
+_LOCK = threading.Lock()
+
+################################################################################
+
+
+def family(model: str) -> str:
+    """Return the tokenizer family used to count tokens for the given model."""
+    if "gpt" in model:
+        return encoding_name_for_model(model)
+    return APPROXIMATE
+
+
+FAMILIES = sorted({family(model) for model in CONTEXT_WINDOW})
+
+
+@cache
+def encoding(name: str) -> tiktoken.Encoding:
+    """Load the tiktoken encoding with the given name once per process."""
+    return tiktoken.get_encoding(name)
+
+
+def _remember(family_: str, text: str, n_tokens: int) -> None:
+    """Store a token count, evicting the oldest count if the cache is full."""
+    with _LOCK:
+        if len(_COUNTS) >= _MAX_COUNTS:
+            del _COUNTS[next(iter(_COUNTS))]
+        _COUNTS[(family_, text)] = n_tokens
+
+
+def count_batch(family_: str, texts: list[str]) -> list[int]:
+    """Count the tokens in each text, encoding only texts not seen before."""
+    if family_ == APPROXIMATE:
+        return [len(text) // 4 for text in texts]
+
+    with _LOCK:
+        counts = {
+            text: _COUNTS[(family_, text)]
+            for text in texts
+            if (family_, text) in _COUNTS
+        }
+    missing = list({text for text in texts if text not in counts})
+    if missing:
+        encoded = encoding(family_).encode_batch(missing, disallowed_special=())
+        for text, tokens in zip(missing, encoded):
+            counts[text] = len(tokens)
+            _remember(family_, text, len(tokens))
+
+    return [counts[text] for text in texts]
+
+
+def count_tokens(model: str, text: str) -> int:
+    """Count the tokens in the text for the given model."""
+    return count_batch(family(model), [text])[0]
+
+
+def count_prompt(model: str, system_message: str, prompt: str) -> int:
+    """Count the input tokens of a system message and prompt for the given model."""
+    return sum(count_batch(family(model), [system_message, prompt]))
+
+
+def check_context(model: str, n_tokens: int, max_tokens: int = 0) -> None:
+    """Raise an error if the prompt and output budget overflow the context window."""
+    if n_tokens + max_tokens > CONTEXT_WINDOW[model]:
+        raise ValueError(
+            f"Prompt of {n_tokens} tokens plus {max_tokens} output tokens exceeds "
+            f"the {CONTEXT_WINDOW[model]} token context window of {model}"
+        )
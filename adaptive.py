@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""Audit a model in interview blocks, stopping once the disparities are precise."""
+import argparse
+import sqlite3
+import subprocess
+import sys
+
+import numpy as np
+
+import disparities
+from chat import MODELS
+
+################################################################################
+
+
+def run(*args: str) -> None:
+    """Run one of the pipeline scripts, stopping if it fails."""
+    subprocess.run([sys.executable, *args], check=True)
+
+
+def update(
+    conn: sqlite3.Connection,
+    accumulator: disparities.Accumulator,
+    model: str,
+    experiment: str,
+    last_id: int,
+) -> tuple[int, int]:
+    """Add the ratings that arrived since last_id, returning the new last_id."""
+    data = disparities.load(
+        conn,
+        """
+        AND ratings.parsed_id > :last_id
+        AND requests.model = :model
+        AND prompts.experiment_type = :experiment
+        AND prompts.persona_id IS NOT NULL
+        """,
+        {"last_id": last_id, "model": model, "experiment": experiment},
+    )
+    if len(data["hire"]) == 0:
+        return last_id, 0
+    accumulator.update(
+        disparities.design(data["race"], data["gender"]),
+        data["hire"],
+        data["interview_id"],
+    )
+    return int(data["parsed_id"].max()), len(data["hire"])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--interviews",
+        type=int,
+        default=25,
+        help="Interviews (i.e., complete persona blocks) to run in each round",
+    )
+    parser.add_argument(
+        "--target",
+        type=float,
+        default=0.1,
+        help="Stop once every contrast is known to within this many hire points",
+    )
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument(
+        "--n-opt",
+        type=int,
+        default=100,
+        help="Number of interviews at which the confidence sequence is tightest",
+    )
+    parser.add_argument("--max-rounds", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=7140466)
+    parser.add_argument("--out", type=str, default="adaptive.csv")
+    parser.add_argument(
+        "model", type=str, choices=[model["short-name"] for model in MODELS]
+    )
+    parser.add_argument("experiment", type=str)
+    args = parser.parse_args()
+
+    model = next(model for model in MODELS if model["short-name"] == args.model)[
+        "full-name"
+    ]
+
+    # Start from whatever ratings the model already has
+    accumulator = disparities.Accumulator()
+    with sqlite3.connect("data.db") as conn:
+        last_id, _ = update(conn, accumulator, model, args.experiment, 0)
+
+    trace = []
+    for round_ in range(args.max_rounds):
+        fit = accumulator.fit()
+        half_width = disparities.confidence_sequence(
+            fit["std_error"], fit["n_clusters"], args.alpha, args.n_opt
+        )
+        for k, term in enumerate(disparities.TERMS):
+            trace.append(
+                {
+                    "model": model,
+                    "experiment_type": args.experiment,
+                    "round": round_,
+                    "term": term,
+                    "estimate": fit["estimate"][k],
+                    "std_error": fit["std_error"][k],
+                    "lwr": fit["estimate"][k] - half_width[k],
+                    "upr": fit["estimate"][k] + half_width[k],
+                    "n": fit["n"],
+                    "n_clusters": fit["n_clusters"],
+                }
+            )
+        # Only the race and gender contrasts decide when to stop, not the intercept
+        widest = np.max(half_width[1:]) if fit["n_clusters"] > 1 else np.inf
+        print(
+            f"Round {round_}: {fit['n']} ratings from {fit['n_clusters']} "
+            f"interviews, widest half-width {widest:.3f}."
+        )
+        if widest <= args.target:
+            print("Target precision reached.")
+            break
+
+        # Run the next complete persona blocks, extracting the ratings of just
+        # these responses as they arrive
+        run(
+            "chat.py",
+            "--extract",
+            "--order",
+            "balanced",
+            "--seed",
+            str(args.seed),
+            "--n_max",
+            str(8 * args.interviews),
+            args.model,
+            args.experiment,
+        )
+
+        with sqlite3.connect("data.db") as conn:
+            last_id, n_new = update(conn, accumulator, model, args.experiment, last_id)
+        if n_new == 0:
+            print("No new ratings; every prompt may have been answered.")
+            break
+
+    disparities.write_csv(args.out, trace)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""Benchmark the pipeline's CPU hot paths on synthetic data against a baseline."""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import timeit
+from typing import Callable
+
+import _aws
+import _schemas
+import _tokens
+import prompts
+
+BASELINE = "bench_baseline.json"
+
+# Synthetic application materials, with the placeholders the real ones use
+N_INTERVIEWS = 20
+N_QUESTIONS = 10
+RESUME_WORDS = 600
+QUESTION_WORDS = 400
+
+# Rows per bulk insert
+N_ROWS = 1000
+
+WORDS = (
+    "classroom students lesson curriculum {first_name} {last_name} {nominative} "
+    "{genitive} {oblique} teaching district assessment parents reading math "
+    "science collaboration differentiated instruction behavior management"
+).split()
+
+PERSONA = {
+    "first_name": "Jordan",
+    "last_name": "Rivera",
+    "race": "Hispanic",
+    "gender": "female",
+    "title": "Ms.",
+    "college": "University of Houston",
+    "city": "Houston",
+    "state": "TX",
+    "nominative": "she",
+    "genitive": "her",
+    "oblique": "her",
+}
+
+################################################################################
+# Synthetic data
+
+
+def text(n_words: int, rng: random.Random) -> str:
+    """Return synthetic text of the given length, with persona placeholders."""
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def corpus(directory: str, rng: random.Random) -> None:
+    """Write synthetic resumes and questions, and copy the real templates."""
+    for folder in ["prompts", "system_messages"]:
+        shutil.copytree(folder, os.path.join(directory, folder))
+    for variant in ["redacted", "unredacted", "raw"]:
+        os.makedirs(os.path.join(directory, "resumes", variant))
+        for interview_id in range(N_INTERVIEWS):
+            path = os.path.join(directory, "resumes", variant, f"{interview_id}.txt")
+            with open(path, "w") as f:
+                f.write(text(RESUME_WORDS, rng))
+    for variant in ["redacted", "unredacted", "modified"]:
+        os.makedirs(os.path.join(directory, "questions", variant))
+        for interview_id in range(N_INTERVIEWS):
+            for question in range(N_QUESTIONS):
+                path = os.path.join(
+                    directory, "questions", variant, f"{interview_id}_{question}.txt"
+                )
+                with open(path, "w") as f:
+                    f.write(text(QUESTION_WORDS, rng))
+
+
+def value(column_type: str, i: int):
+    """Return a synthetic value of the given SQLite column type, unique by row."""
+    column_type = column_type.upper()
+    if column_type == "BLOB":
+        return i.to_bytes(8, "little") * 16
+    if column_type == "REAL":
+        return i / N_ROWS
+    if column_type in ("INTEGER", "BOOLEAN"):
+        return i
+    return f"value {i} " + "x" * 40
+
+
+################################################################################
+# Benchmarks
+
+
+def rendering(rng: random.Random) -> dict[str, Callable[[], object]]:
+    personas = [
+        {**PERSONA, "persona_id": i, "interview_id": i % N_INTERVIEWS}
+        for i in range(N_INTERVIEWS)
+    ]
+    return {
+        f"render:{experiment}": lambda generator=generator: [
+            generator(persona) for persona in personas
+        ]
+        for experiment, generator in prompts.PERSONA_PROMPT_GENERATORS.items()
+    }
+
+
+def validation(rng: random.Random) -> dict[str, Callable[[], object]]:
+    ratings = [
+        json.dumps(
+            {
+                "summary": text(60, rng),
+                **{
+                    key: rng.randint(1, 5)
+                    for key in ["professionalism", "experience", "fit", "hire"]
+                },
+            }
+        )
+        for _ in range(100)
+    ]
+    checks = [
+        json.dumps(
+            {
+                "name": "Jordan Rivera",
+                "race": rng.choice(["asian", "Black", "HISPANIC", "White", "NA"]),
+                "gender": rng.choice(["Male", "female", "NA"]),
+            }
+        )
+        for _ in range(100)
+    ]
+    return {
+        "validate:ratings": lambda: [
+            _schemas.RatingResponse.model_validate_json(rating) for rating in ratings
+        ],
+        "validate:checks": lambda: [
+            _schemas.CheckResponse.model_validate_json(check) for check in checks
+        ],
+    }
+
+
+def tokens(rng: random.Random) -> dict[str, Callable[[], object]]:
+    texts = [text(RESUME_WORDS + N_QUESTIONS * QUESTION_WORDS, rng) for _ in range(5)]
+    benchmarks = {}
+    for family in _tokens.FAMILIES:
+        # The first count of a text encodes it; later counts hit the cache
+        def cold(family=family):
+            _tokens._COUNTS.clear()
+            return _tokens.count_batch(family, texts)
+
+        benchmarks[f"tokens:{family}"] = cold
+        if family == _tokens.APPROXIMATE:
+            continue
+        benchmarks[f"tokens:{family}:cached"] = lambda family=family: (
+            _tokens.count_batch(family, texts)
+        )
+    return benchmarks
+
+
+def payloads(rng: random.Random) -> dict[str, Callable[[], object]]:
+    system_message, prompt = text(200, rng), text(5000, rng)
+    benchmarks = {}
+    for model in [
+        "anthropic.claude-v2:1",
+        "anthropic.claude-3-5-sonnet-20240620-v1:0",
+    ]:
+        for name, schema in [("text", None), ("schema", _schemas.RatingResponse)]:
+            benchmarks[f"payload:{model}:{name}"] = lambda model=model, schema=schema: (
+                json.dumps(
+                    _aws._claude_payload(
+                        model, system_message, prompt, stop=["###"], schema=schema
+                    )
+                )
+            )
+    benchmarks["payload:meta.llama3-1-70b-instruct-v1:0"] = lambda: json.dumps(
+        _aws._llama_payload(
+            "meta.llama3-1-70b-instruct-v1:0",
+            system_message,
+            prompt,
+            schema=_schemas.RatingResponse,
+        )
+    )
+    return benchmarks
+
+
+def inserts(rng: random.Random) -> dict[str, Callable[[], object]]:
+    # The full schema, with the columns removed for public release
+    conn = sqlite3.connect(":memory:")
+    with open("schema.sql", "r") as f:
+        conn.executescript(
+            re.sub(
+                r"/\*\s*NOTE: Removed for public release\s*(.*?)\s*\*/",
+                r"\1",
+                f.read(),
+                flags=re.S,
+            )
+        )
+    tables = [
+        row[0]
+        for row in conn.execute(
+            """
+            SELECT name FROM sqlite_master
+            WHERE type = 'table' AND name NOT LIKE 'sqlite_%'
+            ORDER BY name
+            """
+        )
+    ]
+
+    benchmarks = {}
+    for table in tables:
+        # Every column but defaulted ones, as the scripts insert them
+        columns = [
+            (name, column_type)
+            for _, name, column_type, _, default, _ in conn.execute(
+                f"PRAGMA table_info({table})"
+            )
+            if default is None
+        ]
+        query = (
+            f"INSERT INTO {table} ({', '.join(name for name, _ in columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))})"
+        )
+        rows = [
+            tuple(value(column_type, i) for _, column_type in columns)
+            for i in range(N_ROWS)
+        ]
+
+        def insert(query=query, rows=rows):
+            conn.executemany(query, rows)
+            conn.rollback()
+
+        benchmarks[f"insert:{table}"] = insert
+    return benchmarks
+
+
+SUITES = [rendering, validation, tokens, payloads, inserts]
+
+################################################################################
+
+
+def measure(benchmark: Callable[[], object], repeat: int) -> float:
+    """Return the fastest of several timings of a call, in seconds."""
+    timer = timeit.Timer(benchmark)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run(pattern: str | None, repeat: int) -> dict[str, float]:
+    """Run the benchmarks whose names contain the pattern, in a synthetic corpus."""
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        rng = random.Random(0)
+        corpus(directory, rng)
+        shutil.copy("schema.sql", directory)
+        os.chdir(directory)
+        try:
+            for suite in SUITES:
+                for name, benchmark in suite(rng).items():
+                    if pattern is not None and pattern not in name:
+                        continue
+                    try:
+                        results[name] = measure(benchmark, repeat)
+                    except Exception as e:
+                        # E.g., a tokenizer that cannot be downloaded
+                        print(f"{name:60} skipped ({type(e).__name__})")
+                        continue
+                    print(f"{name:60} {results[name] * 1e3:12.3f} ms")
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def compare(
+    results: dict[str, float], baseline: dict[str, float], threshold: float
+) -> list[str]:
+    """Print each benchmark against the baseline and return the regressions."""
+    regressions = []
+    print(f"\n{'benchmark':60} {'baseline':>12} {'now':>12} {'change':>8}")
+    for name, seconds in results.items():
+        if name not in baseline:
+            print(f"{name:60} {'':>12} {seconds * 1e3:9.3f} ms {'new':>8}")
+            continue
+        change = seconds / baseline[name] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:60} {baseline[name] * 1e3:9.3f} ms {seconds * 1e3:9.3f} ms "
+            f"{change:+8.1%}{flag}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--save",
+        action="store_true",
+        help=f"Store the results as the baseline in {BASELINE}",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="Slowdown relative to the baseline that counts as a regression",
+    )
+    parser.add_argument(
+        "--filter", type=str, help="Run only benchmarks whose names contain this"
+    )
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+
+    machine = f"{platform.machine()} {platform.python_implementation()} "
+    machine += platform.python_version()
+    results = run(args.filter, args.repeat)
+
+    if args.save:
+        baseline = {"machine": machine, "results": {}}
+        if os.path.exists(BASELINE):
+            with open(BASELINE, "r") as f:
+                baseline = json.load(f)
+        baseline["machine"] = machine
+        baseline["results"].update(results)
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nSaved {len(results)} results to {BASELINE}.")
+        return
+
+    if not os.path.exists(BASELINE):
+        print(f"\nNo baseline in {BASELINE}; run with --save to store one.")
+        return
+    with open(BASELINE, "r") as f:
+        baseline = json.load(f)
+    if baseline["machine"] != machine:
+        print(
+            f"\nWARNING: The baseline was measured on {baseline['machine']}, "
+            f"not {machine}."
+        )
+    regressions = compare(results, baseline["results"], args.threshold)
+    if regressions:
+        print(
+            f"\n{len(regressions)} benchmarks are more than {args.threshold:.0%} "
+            f"slower than the baseline: {', '.join(regressions)}",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
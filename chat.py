@@ -3,17 +3,31 @@
 import argparse
 import asyncio
 import logging
+import random
 import sqlite3
 import sys
 
 import aiofiles
 import aiosqlite
+import openai
 from aiolimiter import AsyncLimiter
+from pydantic import BaseModel
 from tqdm.asyncio import tqdm
 
 import _aws
+import _budgets
+import _compress
+import _deadletter
+import _hedging
+import _http
+import _loopmonitor
 import _openai
+import _queries
 import _ratelimiters
+import _schemas
+import _shards
+import _tokens
+import extract
 
 MODELS = [
     {
@@ -84,49 +98,342 @@ async def chat(
     token_limiter: AsyncLimiter,
     connection_limiter: AsyncLimiter,
     max_retries: int = 4,
+    n_tokens: int | None = None,
+    db_path: str = "data.db",
+    max_tokens: int = _budgets.DEFAULT_MAX_TOKENS,
+    stop: list[str] | None = None,
+    schema: type[BaseModel] | None = None,
+    kind: str | None = None,
+    cache: aiosqlite.Connection | None = None,
+    n: int = 1,
+    first_replicate: int = 0,
+    codec: _compress.Codec | None = None,
+    redrive: bool = False,
 ) -> str | None:
+    # Collect the hedges sent for this prompt's calls
+    hedges = []
+    _hedging.HEDGES.set(hedges)
+
+    # Re-driven prompts only use capacity that new prompts leave unused
+    if redrive:
+        await _deadletter.spare_capacity(
+            [(request_limiter, 1), (token_limiter, (n_tokens or 0) + max_tokens)]
+        )
+
+    failure = None
     try:
         async with connection_limiter:
-            raw_response = await chat_fn(
+            completions = await chat_fn(
                 model=model,
                 system_message=system_message,
                 prompt=prompt,
                 request_limiter=request_limiter,
                 token_limiter=token_limiter,
                 max_retries=max_retries,
+                n_tokens=n_tokens,
+                max_tokens=max_tokens,
+                stop=stop,
+                schema=schema,
+                n=n,
             )
             error = False
             error_message = None
+            error_type = None
     except Exception as e:
-        logging.error("Unsolvable error: %s", e)
-        raw_response = None
+        failure = _deadletter.classify(e)
+        logging.error("Unsolvable %s error: %s", failure, e)
+        completions = None
         error = True
         error_message = str(e)
+        error_type = type(e).__name__
 
-    async with aiosqlite.connect("data.db") as db:
-        await db.execute(
-            """
-            INSERT INTO requests (
-                prompt_id, model, raw_response, error, error_message
-            ) VALUES (
-                :prompt_id, :model, :raw_response, :error, :error_message)
-            """,
-            {
-                "prompt_id": prompt_id,
-                "model": model,
-                "raw_response": raw_response,
+    # The adapters give up without raising once their retries run out
+    if completions is None and not error:
+        failure = _deadletter.TRANSIENT
+        error = True
+        error_message = "Retries exhausted"
+        error_type = None
+    # A failed call is one attempt, however many samples it asked for, so it
+    # is recorded as a single failed request
+    if completions is None:
+        completions = [None]
+
+    # Parse the responses right away, rather than in a later extract.py pass
+    results = [None] * len(completions)
+    if kind is not None and not error:
+        for i, completion in enumerate(completions):
+            if completion is None:
+                continue
+            raw_response = completion.text
+            if not raw_response:
+                logging.error("Empty text for prompt_id: %s", prompt_id)
+            try:
+                results[i] = await extract.parse(kind, raw_response, cache)
+            except (openai.OpenAIError, TimeoutError) as e:
+                # Keep the paid-for response and leave it for a later extract.py
+                # run, which re-drives its own failures
+                logging.error("Failed extracting prompt_id %s: %s", prompt_id, e)
+
+    # Every sample is its own request, numbered by replicate. A sample missing
+    # from an otherwise successful call is a failed request of its own, and is
+    # left out of the numbering so that its re-drive takes its replicate.
+    replicate = first_replicate
+    async with aiosqlite.connect(db_path) as db:
+        for i, (completion, result) in enumerate(zip(completions, results)):
+            sample = {
                 "error": error,
                 "error_message": error_message,
-            },
-        )
+                "failure": failure,
+                "error_type": error_type,
+            }
+            if completion is None and not error:
+                logging.error("Missing sample for prompt_id: %s", prompt_id)
+                sample = {
+                    "error": True,
+                    "error_message": "Retries exhausted",
+                    "failure": _deadletter.TRANSIENT,
+                    "error_type": None,
+                }
+
+            raw_response = completion.text if completion is not None else None
+            if codec is not None:
+                raw_response = codec.compress("requests.raw_response", raw_response)
+            cursor = await db.execute(
+                """
+                INSERT INTO requests (
+                    prompt_id, model, raw_response, error, error_message
+                ) VALUES (
+                    :prompt_id, :model, :raw_response, :error, :error_message)
+                """,
+                {
+                    "prompt_id": prompt_id,
+                    "model": model,
+                    "raw_response": raw_response,
+                    "error": sample["error"],
+                    "error_message": sample["error_message"],
+                },
+            )
+
+            # Keep failed requests as dead letters, to re-drive or report
+            if sample["error"]:
+                await db.execute(
+                    """
+                    INSERT INTO dead_letters (
+                        request_id, stage, failure, error_type, error_message
+                    ) VALUES (?, 'chat', ?, ?, ?)
+                    """,
+                    (
+                        cursor.lastrowid,
+                        sample["failure"],
+                        sample["error_type"],
+                        sample["error_message"],
+                    ),
+                )
+
+            # Record the prompt's hedges with its first sample
+            if hedges and i == 0:
+                await db.execute(
+                    """
+                    INSERT INTO hedges (request_id, n_hedges, n_won, saved)
+                    VALUES (?, ?, ?, ?)
+                    """,
+                    (
+                        cursor.lastrowid,
+                        len(hedges),
+                        sum(hedge["winner"] == "hedge" for hedge in hedges),
+                        sum(hedge["saved"] for hedge in hedges),
+                    ),
+                )
+
+            # The first sample of every prompt is replicate 0 implicitly
+            if not sample["error"]:
+                if replicate > 0:
+                    await db.execute(
+                        "INSERT INTO replicates (request_id, replicate) VALUES (?, ?)",
+                        (cursor.lastrowid, replicate),
+                    )
+                replicate += 1
+
+            # Record the output length, to profile generation budgets
+            if completion is not None:
+                await db.execute(
+                    """
+                    INSERT INTO completions (
+                        request_id, output_tokens, truncated, max_tokens
+                    ) VALUES (?, ?, ?, ?)
+                    """,
+                    (
+                        cursor.lastrowid,
+                        completion.output_tokens,
+                        completion.truncated,
+                        max_tokens,
+                    ),
+                )
+
+            # Commit the result together with the request it belongs to
+            if result is not None:
+                await extract.insert(kind, [cursor.lastrowid], result, db)
         await db.commit()
 
 
+def balanced_order(prompts: list, n_max: int, seed: int = 7140466) -> list:
+    """Order prompts in complete, shuffled per-interview blocks of personas.
+
+    Interviews that already have some responses come first, so they are
+    completed before new ones are started. Within each block the personas are
+    rotated, Latin-square style, so that no race and gender is always sent
+    first. Only whole blocks are taken, up to n_max prompts.
+    """
+    blocks = {}
+    for prompt in prompts:
+        blocks.setdefault(prompt["interview_id"], []).append(prompt)
+
+    cells = sorted(
+        {(prompt["race"] or "", prompt["gender"] or "") for prompt in prompts}
+    )
+    rng = random.Random(seed)
+    interviews = sorted(blocks)
+    rng.shuffle(interviews)
+    interviews.sort(
+        key=lambda interview_id: len(blocks[interview_id])
+        == blocks[interview_id][0]["n_interview"]
+    )
+
+    ordered = []
+    for b, interview_id in enumerate(interviews):
+        block = sorted(
+            blocks[interview_id],
+            key=lambda prompt: (
+                cells.index((prompt["race"] or "", prompt["gender"] or "")) - b
+            )
+            % len(cells),
+        )
+        if ordered and len(ordered) + len(block) > n_max:
+            break
+        ordered.extend(block)
+    return ordered
+
+
+def pending_prompts(
+    model: str,
+    experiment: str,
+    db_path: str,
+    worker: int,
+    n_workers: int,
+    order: str,
+    n_max: int,
+    seed: int,
+    replicates: int = 1,
+    max_attempts: int = _deadletter.MAX_ATTEMPTS,
+) -> list:
+    """Fetch the prompts the model has yet to answer, in dispatch order.
+
+    A prompt is pending until it has the given number of replicates, unless it
+    has failed max_attempts times or failed permanently.
+    """
+    # Pull all of the prompts for the experiment from the database, skipping
+    # prompts already answered in the main database or in the shard. Balanced
+    # runs need every pending prompt to order them, and split work between
+    # workers by interview so that persona blocks stay together.
+    balanced = order == "balanced"
+    with sqlite3.connect("data.db") as conn:
+        conn.row_factory = sqlite3.Row
+        _compress.register(conn)
+        schema = _shards.attach(conn, db_path)
+        prompts = conn.execute(
+            _queries.pending_prompts(schema, balanced),
+            {
+                "experiment": experiment,
+                "model": model,
+                "family": _tokens.family(model),
+                "worker": worker,
+                "n_workers": n_workers,
+                "n_max": -1 if balanced else n_max,
+                "replicates": replicates,
+                "max_attempts": max_attempts,
+            },
+        ).fetchall()
+
+    if balanced:
+        prompts = balanced_order(prompts, n_max, seed)
+    return prompts
+
+
 async def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--log-level", type=str, default="INFO")
     parser.add_argument("--log-file", type=str, default="chat.log")
     parser.add_argument("--n_max", type=int, default=100)
+    parser.add_argument(
+        "--regions",
+        type=str,
+        default=None,
+        help="Comma-separated Bedrock regions to spread the model's traffic over",
+    )
+    parser.add_argument(
+        "--db",
+        type=str,
+        default="data.db",
+        help="Database to write responses to, e.g., a per-worker shard",
+    )
+    parser.add_argument(
+        "--worker",
+        type=str,
+        default="0/1",
+        help="Take only the prompts assigned to worker i of n, given as i/n",
+    )
+    parser.add_argument(
+        "--order",
+        type=str,
+        choices=["any", "balanced"],
+        default="any",
+        help="Send prompts in any order, or in complete, shuffled persona blocks",
+    )
+    parser.add_argument("--seed", type=int, default=7140466)
+    parser.add_argument(
+        "--structured",
+        action="store_true",
+        help="Have the provider enforce the response schema, to skip extraction",
+    )
+    parser.add_argument(
+        "--extract",
+        action="store_true",
+        help="Extract ratings or checks from each response as it arrives",
+    )
+    parser.add_argument(
+        "--replicates",
+        type=int,
+        default=1,
+        help="Number of samples to collect per prompt, requested together",
+    )
+    parser.add_argument(
+        "--monitor-loop",
+        action="store_true",
+        help="Report event loop lag and the slowest blocking callbacks",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=_deadletter.MAX_ATTEMPTS,
+        help="Failures of a prompt after which it is no longer re-driven",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=_hedging.DEADLINE,
+        help="Seconds a provider call may take before it is abandoned and retried",
+    )
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="Duplicate calls slower than the model's p95, keeping the first answer",
+    )
+    parser.add_argument(
+        "--budgets",
+        type=str,
+        default=_budgets.BUDGETS_PATH,
+        help="Per-experiment output budgets and stop sequences, from lengths.py",
+    )
     parser.add_argument("model", type=str)
     parser.add_argument("experiment", type=str)
     args = parser.parse_args()
@@ -154,6 +461,13 @@ async def main():
     else:
         chat_fn = _aws._chat_mistral
 
+    # Bound every provider call, and hedge the slow ones if asked to
+    _hedging.configure(args.deadline, args.hedge)
+
+    # Spread Bedrock traffic over the requested regions
+    if args.regions and chat_fn is not _openai._chat_gpt:
+        _aws.set_regions(model, args.regions.split(","))
+
     # Get the limiters for the model
     request_limiter = _ratelimiters.REQUEST_LIMITER[model]
     token_limiter = _ratelimiters.TOKEN_LIMITER[model]
@@ -166,24 +480,36 @@ async def main():
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     )
 
-    # Pull all of the prompts for the experiment from the database
+    # Fetch the pending prompts in a worker thread, so that the query does not
+    # block the event loop
+    worker, n_workers = map(int, args.worker.split("/"))
+    prompts = await asyncio.to_thread(
+        pending_prompts,
+        model,
+        args.experiment,
+        args.db,
+        worker,
+        n_workers,
+        args.order,
+        args.n_max,
+        args.seed,
+        args.replicates,
+        args.max_attempts,
+    )
+
+    # Cap the output length at the experiment's budget
+    max_tokens, stop = _budgets.budget(args.experiment, args.budgets)
+    response_schema = (
+        _schemas.for_experiment(args.experiment) if args.structured else None
+    )
+
+    # The extraction cache always lives in the main database
+    kind = _schemas.kind(args.experiment) if args.extract else None
+    cache = await aiosqlite.connect("data.db") if args.extract else None
+
+    # Compress responses with the dictionaries stored in the main database
     with sqlite3.connect("data.db") as conn:
-        conn.row_factory = sqlite3.Row
-        prompts = conn.execute(
-            """
-            SELECT prompts.prompt_id, prompts.system_message, prompts.prompt
-            FROM prompts
-            LEFT JOIN (
-                SELECT prompt_id
-                FROM requests
-                WHERE model = :model
-            ) AS model_requests ON prompts.prompt_id = model_requests.prompt_id
-            WHERE model_requests.prompt_id IS NULL
-            AND prompts.experiment_type = :experiment
-            LIMIT :n_max
-            """,
-            {"experiment": args.experiment, "model": model, "n_max": args.n_max},
-        ).fetchall()
+        codec = _compress.Codec(conn)
 
     # Create a list of chat coroutines
     tasks = [
@@ -196,12 +522,39 @@ async def main():
             request_limiter=request_limiter,
             token_limiter=token_limiter,
             connection_limiter=connection_limiter,
+            n_tokens=prompt["n_tokens"],
+            db_path=args.db,
+            max_tokens=max_tokens,
+            stop=stop,
+            schema=response_schema,
+            kind=kind,
+            cache=cache,
+            n=args.replicates - prompt["n_done"],
+            first_replicate=prompt["n_done"],
+            codec=codec,
+            redrive=prompt["n_failed"] > 0,
         )
         for prompt in prompts
     ]
 
+    # Open the API connections before the first calls need them
+    if tasks and chat_fn is _openai._chat_gpt:
+        await _http.prewarm(min(len(tasks), _ratelimiters.MAX_CONNECTIONS))
+
     # Run the chat coroutines
+    monitor = _loopmonitor.LoopMonitor() if args.monitor_loop else None
+    if monitor is not None:
+        monitor.start()
     await tqdm.gather(*tasks)
+    if monitor is not None:
+        await monitor.stop()
+        logging.info(monitor.report())
+        print(monitor.report())
+    logging.info(_http.TRANSPORT.report())
+    await _http.close()
+    await _aws.close()
+    if cache is not None:
+        await cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""Train compression dictionaries for the text columns and recompress them."""
+import argparse
+import os
+import sqlite3
+
+import zstandard
+
+import _compress
+import _shards
+
+################################################################################
+
+
+def train(
+    conn: sqlite3.Connection,
+    codec: _compress.Codec,
+    table: str,
+    column: str,
+    n_samples: int,
+    size: int,
+) -> None:
+    """Train a dictionary on a random sample of the column's values."""
+    samples = [
+        codec.decompress(value).encode()
+        for (value,) in conn.execute(
+            f"""
+            SELECT {column} FROM {table}
+            WHERE {column} IS NOT NULL
+            ORDER BY RANDOM()
+            LIMIT ?
+            """,
+            (n_samples,),
+        )
+    ]
+    dictionary = zstandard.train_dictionary(size, samples, level=_compress.LEVEL)
+    conn.execute(
+        """
+        INSERT INTO dictionaries (dictionary_id, column_name, dictionary)
+        VALUES (?, ?, ?)
+        """,
+        (dictionary.dict_id(), f"{table}.{column}", dictionary.as_bytes()),
+    )
+    conn.commit()
+
+
+def recompress(
+    conn: sqlite3.Connection,
+    codec: _compress.Codec,
+    table: str,
+    column: str,
+    batch_size: int,
+) -> int:
+    """Compress every value not yet compressed with the column's dictionary."""
+    dictionary_id = codec.active[f"{table}.{column}"]
+    n_updated, last_rowid = 0, 0
+    while True:
+        rows = conn.execute(
+            f"""
+            SELECT rowid, {column} FROM {table}
+            WHERE rowid > ? AND {column} IS NOT NULL
+            ORDER BY rowid
+            LIMIT ?
+            """,
+            (last_rowid, batch_size),
+        ).fetchall()
+        if not rows:
+            return n_updated
+        last_rowid = rows[-1][0]
+
+        updates = [
+            (codec.compress(f"{table}.{column}", codec.decompress(value)), rowid)
+            for rowid, value in rows
+            if not isinstance(value, bytes)
+            or zstandard.get_frame_parameters(value).dict_id != dictionary_id
+        ]
+        conn.executemany(f"UPDATE {table} SET {column} = ? WHERE rowid = ?", updates)
+        conn.commit()
+        n_updated += len(updates)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", type=str, default="data.db")
+    parser.add_argument(
+        "--retrain",
+        action="store_true",
+        help="Train new dictionaries even for columns that already have one",
+    )
+    parser.add_argument("--samples", type=int, default=10000)
+    parser.add_argument("--dictionary-size", type=int, default=112640)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    size = os.path.getsize(args.db)
+    with sqlite3.connect(args.db) as conn:
+        codec = _compress.Codec(conn)
+        for table, columns in _compress.COLUMNS.items():
+            # The public data omits the text columns
+            existing = _shards.columns(conn, "main", table)
+            for column in columns:
+                if column not in existing:
+                    continue
+                if args.retrain or f"{table}.{column}" not in codec.active:
+                    try:
+                        train(
+                            conn,
+                            codec,
+                            table,
+                            column,
+                            args.samples,
+                            args.dictionary_size,
+                        )
+                    except zstandard.ZstdError as e:
+                        print(f"Could not train a dictionary for {column}: {e}")
+                        continue
+                    codec = _compress.Codec(conn)
+
+                n_updated = recompress(conn, codec, table, column, args.batch_size)
+                print(f"Compressed {n_updated} values of {table}.{column}.")
+
+        # Return the freed pages to the file system
+        conn.execute("VACUUM")
+    print(
+        f"{args.db}: {size / 2**20:.1f} MiB -> {os.path.getsize(args.db) / 2**20:.1f} MiB."
+    )
+
+
+if __name__ == "__main__":
+    main()
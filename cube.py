@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""Summarize the ratings by group from the incrementally maintained ratings cube."""
+import argparse
+import math
+import sqlite3
+import sys
+
+import _shards
+
+DIMENSIONS = ["model", "experiment_type", "race", "gender", "interview_id"]
+MEASURES = ["hire", "experience", "fit", "professionalism"]
+
+# The cube as computed from scratch, to rebuild or check the one the triggers
+# maintain
+AGGREGATE = f"""
+SELECT
+    {", ".join(f"request_groups.{dimension}" for dimension in DIMENSIONS)},
+    COUNT(*) AS n,
+    {", ".join(
+        f"COUNT(ratings.{m}), COALESCE(SUM(ratings.{m}), 0), "
+        f"COALESCE(SUM(ratings.{m} * ratings.{m}), 0)"
+        for m in MEASURES
+    )}
+FROM ratings
+JOIN request_groups ON ratings.request_id = request_groups.request_id
+WHERE ratings.error = 0
+GROUP BY {", ".join(str(i + 1) for i in range(len(DIMENSIONS)))}
+"""
+
+################################################################################
+
+
+def summarize(
+    conn: sqlite3.Connection, by: list[str], measure: str, filters: dict
+) -> list[tuple]:
+    """Return the count, mean, and standard deviation of a measure by group."""
+    where = " AND ".join(f"{dimension} = :{dimension}" for dimension in filters)
+    rows = conn.execute(
+        f"""
+        SELECT
+            {"".join(f"{dimension}, " for dimension in by)}
+            SUM(n_{measure}),
+            SUM(sum_{measure}),
+            SUM(sumsq_{measure})
+        FROM ratings_cube
+        {f"WHERE {where}" if where else ""}
+        {f"GROUP BY {', '.join(by)} ORDER BY {', '.join(by)}" if by else ""}
+        """,
+        filters,
+    ).fetchall()
+
+    summaries = []
+    for *group, n, total, squares in rows:
+        if not n:
+            continue
+        mean = total / n
+        sd = math.sqrt(max(squares - n * mean**2, 0) / (n - 1)) if n > 1 else None
+        summaries.append((*group, n, mean, sd))
+    return summaries
+
+
+def rebuild(conn: sqlite3.Connection) -> int:
+    """Recompute the cube from every rating, returning the number of groups."""
+    conn.execute("DELETE FROM ratings_cube")
+    cursor = conn.execute(f"INSERT INTO ratings_cube {AGGREGATE}")
+    conn.commit()
+    return cursor.rowcount
+
+
+def verify(conn: sqlite3.Connection) -> int:
+    """Return the number of groups where the cube and a full scan disagree."""
+    # Compound operators apply left to right, so each difference needs its own
+    # subquery
+    (n,) = conn.execute(
+        f"""
+        SELECT COUNT(*) FROM (
+            SELECT * FROM ({AGGREGATE} EXCEPT SELECT * FROM ratings_cube)
+            UNION ALL
+            SELECT * FROM (SELECT * FROM ratings_cube EXCEPT {AGGREGATE})
+        )
+        """
+    ).fetchone()
+    return n
+
+
+def check(conn: sqlite3.Connection) -> list[str]:
+    """Return the ways verify() misses a cube that disagrees with the ratings.
+
+    The cube is tampered with inside a savepoint that is rolled back.
+    """
+    problems = []
+    conn.execute("SAVEPOINT check_cube")
+    try:
+        # A group the cube has but the ratings do not
+        conn.execute(
+            f"""
+            INSERT INTO ratings_cube
+            VALUES ('', '', '', '', -1, 1, {", ".join(["0"] * 3 * len(MEASURES))})
+            """
+        )
+        if not verify(conn):
+            problems.append("verify() misses a group with no ratings")
+        conn.execute("ROLLBACK TO check_cube")
+
+        # A group the ratings have but the cube does not
+        deleted = conn.execute(
+            f"""
+            DELETE FROM ratings_cube
+            WHERE ({", ".join(DIMENSIONS)}) = (
+                SELECT {", ".join(DIMENSIONS)} FROM ratings_cube LIMIT 1
+            )
+            """
+        ).rowcount
+        if deleted and not verify(conn):
+            problems.append("verify() misses a group missing from the cube")
+    finally:
+        conn.execute("ROLLBACK TO check_cube")
+        conn.execute("RELEASE check_cube")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", type=str, default="data.db")
+    parser.add_argument(
+        "--by",
+        type=str,
+        nargs="*",
+        default=["model", "experiment_type", "race", "gender"],
+        choices=DIMENSIONS,
+        help="Dimensions to group by",
+    )
+    parser.add_argument("--measure", type=str, default="hire", choices=MEASURES)
+    parser.add_argument("--model", type=str)
+    parser.add_argument("--experiment_type", type=str)
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Recompute the cube from the ratings, e.g., after writing with triggers off",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Fail if the cube disagrees with the ratings",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Fail if --verify would miss a cube that disagrees with the ratings",
+    )
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db) as conn:
+        if not _shards.columns(conn, "main", "ratings_cube"):
+            raise SystemExit(f"{args.db} has no ratings_cube table; run migrate.py")
+        if args.rebuild:
+            print(f"Rebuilt {rebuild(conn)} groups.")
+        if args.check:
+            problems = check(conn)
+            for problem in problems:
+                print(problem, file=sys.stderr)
+            if problems:
+                sys.exit(1)
+            print("The cube check catches missing and extra groups.")
+            return
+        if args.verify:
+            n = verify(conn)
+            if n:
+                print(f"{n} groups of the cube disagree with the ratings.")
+                sys.exit(1)
+            print("The cube agrees with the ratings.")
+            return
+
+        filters = {
+            dimension: getattr(args, dimension)
+            for dimension in ["model", "experiment_type"]
+            if getattr(args, dimension) is not None
+        }
+        summaries = summarize(conn, args.by, args.measure, filters)
+
+    widths = {"model": 45, "experiment_type": 20}
+    print(
+        "".join(f"{dimension:{widths.get(dimension, 12)}} " for dimension in args.by)
+        + f"{'n':>8} {'mean':>8} {'sd':>8}"
+    )
+    for *group, n, mean, sd in summaries:
+        print(
+            "".join(
+                f"{str(value):{widths.get(dimension, 12)}} "
+                for dimension, value in zip(args.by, group)
+            )
+            + f"{n:8} {mean:8.3f} {'' if sd is None else f'{sd:8.3f}':>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Report failed requests and extractions, or requeue failures from before them."""
+import argparse
+import sqlite3
+
+import _deadletter
+import _shards
+
+# Whether a dead letter's work has since succeeded: a later request for the
+# same prompt and model, or a result for the extraction
+RESOLVED = """
+CASE dead_letters.stage
+    WHEN 'chat' THEN EXISTS (
+        SELECT 1 FROM requests AS retries
+        WHERE retries.prompt_id = requests.prompt_id
+        AND retries.model = requests.model
+        AND NOT retries.error
+    )
+    WHEN 'ratings' THEN EXISTS (
+        SELECT 1 FROM ratings WHERE ratings.request_id = dead_letters.request_id
+    )
+    ELSE EXISTS (
+        SELECT 1 FROM checks WHERE checks.request_id = dead_letters.request_id
+    )
+END
+"""
+
+################################################################################
+
+
+def report(conn: sqlite3.Connection, limit: int) -> None:
+    """Print the dead letters by class, and the unresolved permanent ones."""
+    rows = conn.execute(
+        f"""
+        SELECT
+            requests.model,
+            dead_letters.stage,
+            dead_letters.failure,
+            COALESCE(dead_letters.error_type, '') AS error_type,
+            COUNT(*) AS n,
+            SUM({RESOLVED}) AS n_resolved
+        FROM dead_letters
+        JOIN requests ON dead_letters.request_id = requests.request_id
+        GROUP BY 1, 2, 3, 4
+        ORDER BY 1, 2, 3, 5 DESC
+        """
+    ).fetchall()
+    print(
+        f"{'model':45} {'stage':8} {'failure':10} {'error':28} {'n':>7} {'resolved':>8}"
+    )
+    for model, stage, failure, error_type, n, n_resolved in rows:
+        print(
+            f"{model:45} {stage:8} {failure:10} {error_type[:28]:28} {n:7} "
+            f"{n_resolved:8}"
+        )
+
+    permanent = conn.execute(
+        f"""
+        SELECT
+            dead_letters.request_id,
+            requests.prompt_id,
+            requests.model,
+            dead_letters.stage,
+            dead_letters.error_message
+        FROM dead_letters
+        JOIN requests ON dead_letters.request_id = requests.request_id
+        WHERE dead_letters.failure = :permanent
+        AND NOT {RESOLVED}
+        ORDER BY dead_letters.timestamp DESC
+        LIMIT :limit
+        """,
+        {"permanent": _deadletter.PERMANENT, "limit": limit},
+    ).fetchall()
+    if permanent:
+        print("\nMost recent unresolved permanent failures:")
+    for request_id, prompt_id, model, stage, error_message in permanent:
+        print(
+            f"request {request_id} (prompt {prompt_id}, {model}, {stage}): "
+            f"{(error_message or '')[:200]}"
+        )
+
+
+def requeue(conn: sqlite3.Connection) -> int:
+    """Dead-letter failed requests from before dead letters, as transient."""
+    cursor = conn.execute(
+        """
+        INSERT INTO dead_letters (
+            request_id, stage, failure, error_message
+        )
+        SELECT requests.request_id, 'chat', :transient, requests.error_message
+        FROM requests
+        LEFT JOIN dead_letters
+        ON requests.request_id = dead_letters.request_id
+        AND dead_letters.stage = 'chat'
+        WHERE requests.error
+        AND dead_letters.request_id IS NULL
+        """,
+        {"transient": _deadletter.TRANSIENT},
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--db",
+        type=str,
+        default="data.db",
+        help="Database to report on, e.g., a shard",
+    )
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument(
+        "--requeue-errors",
+        action="store_true",
+        help="Re-drive requests that failed before dead letters were recorded",
+    )
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db) as conn:
+        if not _shards.columns(conn, "main", "dead_letters"):
+            raise SystemExit(f"{args.db} has no dead_letters table; run migrate.py")
+        if args.requeue_errors:
+            print(f"Requeued {requeue(conn)} failed requests.")
+        report(conn, args.limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+"""Estimate race and gender disparities in hiring ratings for every group at once."""
+import argparse
+import csv
+import sqlite3
+
+import numpy as np
+
+RACES = ["White", "Black", "Hispanic", "Asian"]
+GENDERS = ["male", "female"]
+
+# Same terms as `felm(hire ~ gender + race | 1 | 0 | interview_id)` in analyze.R
+TERMS = ["(Intercept)", "genderfemale", "raceBlack", "raceHispanic", "raceAsian"]
+
+HIRE_LEVELS = np.arange(1, 6)
+
+QUERY = """
+    SELECT
+        ratings.parsed_id,
+        requests.model,
+        prompts.experiment_type,
+        prompts.interview_id,
+        prompts.persona_id IS NOT NULL AS persona,
+        COALESCE(personas.race, interviews.race) AS race,
+        COALESCE(personas.gender, interviews.gender) AS gender,
+        ratings.hire
+    FROM ratings
+    JOIN requests ON ratings.request_id = requests.request_id
+    JOIN prompts ON requests.prompt_id = prompts.prompt_id
+    JOIN interviews ON prompts.interview_id = interviews.interview_id
+    LEFT JOIN personas ON prompts.persona_id = personas.persona_id
+    WHERE ratings.error = 0
+    AND ratings.hire IS NOT NULL
+"""
+
+################################################################################
+# Data
+
+
+def load(conn: sqlite3.Connection, where: str = "", params: dict = {}) -> dict:
+    """Load every parsed rating, or those matching extra conditions, as arrays."""
+    rows = conn.execute(QUERY + where, params).fetchall()
+    parsed_id, model, experiment_type, interview_id, persona, race, gender, hire = (
+        zip(*rows) if rows else [()] * 8
+    )
+    return {
+        "parsed_id": np.array(parsed_id, dtype=np.int64),
+        "model": np.array(model, dtype=object),
+        "experiment_type": np.array(experiment_type, dtype=object),
+        "interview_id": np.array(interview_id, dtype=np.int64),
+        "persona": np.array(persona, dtype=bool),
+        "race": np.array(race, dtype=object),
+        "gender": np.array(gender, dtype=object),
+        "hire": np.array(hire, dtype=np.float64),
+    }
+
+
+def subset(data: dict, mask: np.ndarray) -> dict:
+    """Select the given rows of every array."""
+    return {key: values[mask] for key, values in data.items()}
+
+
+def group_index(data: dict, keys: list[str]) -> tuple[np.ndarray, list[tuple]]:
+    """Return each row's group number and the key values of every group."""
+    if len(data["hire"]) == 0:
+        return np.zeros(0, dtype=np.int64), []
+    combined = np.array(
+        ["\x1f".join(map(str, values)) for values in zip(*(data[k] for k in keys))]
+    )
+    labels, index = np.unique(combined, return_inverse=True)
+    return index, [tuple(label.split("\x1f")) for label in labels]
+
+
+def grouped_sum(index: np.ndarray, values: np.ndarray, n_groups: int) -> np.ndarray:
+    """Sum the rows of values (n x ...) within each group."""
+    flat = values.reshape(len(values), -1)
+    sums = np.stack(
+        [
+            np.bincount(index, weights=flat[:, j], minlength=n_groups)
+            for j in range(flat.shape[1])
+        ],
+        axis=1,
+    )
+    return sums.reshape((n_groups,) + values.shape[1:])
+
+
+def design(race: np.ndarray, gender: np.ndarray) -> np.ndarray:
+    """Build the shared design matrix with White and male as the baselines."""
+    return np.column_stack(
+        [np.ones(len(race)), gender == "female"]
+        + [race == value for value in RACES[1:]]
+    ).astype(np.float64)
+
+
+################################################################################
+# Estimation
+
+
+def clustered_ols(
+    X: np.ndarray, y: np.ndarray, group: np.ndarray, cluster: np.ndarray, n_groups: int
+) -> dict:
+    """Fit OLS separately within every group, clustering standard errors.
+
+    All groups are fit in one pass from grouped sums of the shared design
+    matrix. Standard errors use the same small-sample correction as `felm`,
+    G / (G - 1) * (N - 1) / (N - K), where G is the number of clusters.
+    """
+    K = X.shape[1]
+    outer = X[:, :, None] * X[:, None, :]
+    XtX = grouped_sum(group, outer, n_groups)
+    Xty = grouped_sum(group, X * y[:, None], n_groups)
+
+    # Terms with no variation in a group (e.g., a race absent from it) are not
+    # identified
+    present = grouped_sum(group, X, n_groups) > 0
+    bread = np.linalg.pinv(XtX)
+    beta = np.einsum("gij,gj->gi", bread, Xty)
+
+    # Sum the scores within each (group, cluster) pair
+    residuals = y - np.einsum("ni,ni->n", X, beta[group])
+    pairs, pair_index = np.unique(
+        np.column_stack([group, cluster]), axis=0, return_inverse=True
+    )
+    pair_index = pair_index.reshape(-1)
+    scores = grouped_sum(pair_index, X * residuals[:, None], len(pairs))
+    meat = grouped_sum(pairs[:, 0], scores[:, :, None] * scores[:, None, :], n_groups)
+
+    n = np.bincount(group, minlength=n_groups)
+    n_clusters = np.bincount(pairs[:, 0], minlength=n_groups)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        adjustment = n_clusters / (n_clusters - 1) * (n - 1) / (n - K)
+        vcov = adjustment[:, None, None] * (bread @ meat @ bread)
+        std_error = np.sqrt(np.einsum("gii->gi", vcov))
+
+    beta[~present] = np.nan
+    std_error[~present] = np.nan
+    return {
+        "estimate": beta,
+        "std_error": std_error,
+        "n": n,
+        "n_clusters": n_clusters,
+    }
+
+
+class Accumulator:
+    """Sufficient statistics for one clustered regression, updated as data arrive.
+
+    Each cluster keeps its own X'X and X'y, which is all the sandwich estimator
+    needs, so ratings can be added in any order and at any time (including more
+    ratings for a cluster already seen).
+    """
+
+    def __init__(self, n_terms: int = len(TERMS)):
+        self.n_terms = n_terms
+        self.n = 0
+        self.XtX = {}
+        self.Xty = {}
+
+    def update(self, X: np.ndarray, y: np.ndarray, cluster: np.ndarray) -> None:
+        """Add rows of the design matrix and outcome."""
+        clusters, index = np.unique(cluster, return_inverse=True)
+        index = index.reshape(-1)
+        XtX = grouped_sum(index, X[:, :, None] * X[:, None, :], len(clusters))
+        Xty = grouped_sum(index, X * y[:, None], len(clusters))
+        for c, key in enumerate(clusters):
+            self.XtX[key] = self.XtX.get(key, 0) + XtX[c]
+            self.Xty[key] = self.Xty.get(key, 0) + Xty[c]
+        self.n += len(y)
+
+    def fit(self) -> dict:
+        """Estimate the coefficients and clustered standard errors so far."""
+        K = self.n_terms
+        G = len(self.XtX)
+        if G == 0:
+            return {
+                "estimate": np.full(K, np.nan),
+                "std_error": np.full(K, np.nan),
+                "n": 0,
+                "n_clusters": 0,
+            }
+        XtX = np.stack(list(self.XtX.values()))
+        Xty = np.stack(list(self.Xty.values()))
+        bread = np.linalg.pinv(XtX.sum(axis=0))
+        beta = bread @ Xty.sum(axis=0)
+
+        # The score of each cluster is X_c'(y_c - X_c b) = X_c'y_c - X_c'X_c b
+        scores = Xty - XtX @ beta
+        meat = scores.T @ scores
+        with np.errstate(divide="ignore", invalid="ignore"):
+            adjustment = G / (G - 1) * (self.n - 1) / (self.n - K)
+            std_error = np.sqrt(np.diag(adjustment * (bread @ meat @ bread)))
+
+        present = np.diag(XtX.sum(axis=0)) > 0
+        beta[~present] = np.nan
+        std_error[~present] = np.nan
+        return {
+            "estimate": beta,
+            "std_error": std_error,
+            "n": self.n,
+            "n_clusters": G,
+        }
+
+
+def confidence_sequence(
+    std_error: np.ndarray, n: int, alpha: float = 0.05, n_opt: int = 100
+) -> np.ndarray:
+    """Half-width of an asymptotic confidence sequence after n clusters.
+
+    Unlike a fixed-sample interval, this covers the estimate at every n at
+    once, so it stays valid when it is used to decide when to stop (Waudby-Smith
+    et al., "Time-uniform central limit theory"). The width is tightest around
+    n_opt clusters.
+    """
+    rho2 = (-2 * np.log(alpha) + np.log(-2 * np.log(alpha) + 1)) / n_opt
+    n_rho2 = n * rho2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return std_error * np.sqrt(
+            2 * (n_rho2 + 1) / n_rho2 * np.log(np.sqrt(n_rho2 + 1) / alpha)
+        )
+
+
+def disparities(data: dict, keys: list[str] = ["model", "experiment_type"]) -> list:
+    """Estimate the hire disparities for every group of persona ratings."""
+    data = subset(data, data["persona"])
+    group, labels = group_index(data, keys)
+    if not labels:
+        return []
+
+    X = design(data["race"], data["gender"])
+    fit = clustered_ols(X, data["hire"], group, data["interview_id"], len(labels))
+
+    # Standardize by the sample standard deviation of hire in each group, as
+    # `sd_model`, `sd_framing`, and `sd_variant` do
+    n = fit["n"]
+    mean = grouped_sum(group, data["hire"], len(labels)) / n
+    squares = grouped_sum(group, data["hire"] ** 2, len(labels))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sd = np.sqrt((squares - n * mean**2) / (n - 1))
+
+    results = []
+    for g, label in enumerate(labels):
+        for k, term in enumerate(TERMS):
+            results.append(
+                {
+                    **dict(zip(keys, label)),
+                    "term": term,
+                    "estimate": fit["estimate"][g, k],
+                    "std_error": fit["std_error"][g, k],
+                    "estimate_sd": fit["estimate"][g, k] / sd[g],
+                    "std_error_sd": fit["std_error"][g, k] / sd[g],
+                    "n": fit["n"][g],
+                    "n_clusters": fit["n_clusters"][g],
+                }
+            )
+    return results
+
+
+################################################################################
+# Adverse impact ratios
+
+
+def selection_rates(counts: np.ndarray) -> np.ndarray:
+    """Share of each demographic rated at or above each hire level."""
+    at_least = np.cumsum(counts[..., ::-1], axis=-1)[..., ::-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return at_least / counts.sum(axis=-1, keepdims=True)
+
+
+def adverse_impact(
+    data: dict,
+    characteristic: str,
+    values: list[str],
+    reference: str,
+    n_boot: int = 1000,
+    seed: int = 7140466,
+    keys: list[str] = ["model", "experiment_type"],
+) -> list:
+    """Adverse impact ratios relative to the reference group, with bootstrap CIs.
+
+    Mirrors the `adverse_impact_*` computations in analyze.R for every group at
+    once. Race is resampled within race, and gender across the whole group, and
+    intervals are basic bootstrap intervals truncated at zero.
+    """
+    data = subset(
+        data, ~data["persona"] & np.isin(data[characteristic], values + [reference])
+    )
+    group, labels = group_index(data, keys)
+    if not labels:
+        return []
+
+    # Count ratings by (group, demographic, hire level)
+    demographics = values + [reference]
+    demographic = np.argmax(
+        data[characteristic][:, None] == np.array(demographics, dtype=object), axis=1
+    )
+    level = data["hire"].astype(np.int64) - 1
+    cells = (group * len(demographics) + demographic) * len(HIRE_LEVELS) + level
+    counts = np.bincount(
+        cells, minlength=len(labels) * len(demographics) * len(HIRE_LEVELS)
+    ).reshape(len(labels), len(demographics), len(HIRE_LEVELS))
+
+    def ratios(counts):
+        rates = selection_rates(counts)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return rates[..., :-1, :] / rates[..., -1:, :]
+
+    estimate = ratios(counts)
+
+    # Resample the counts directly from their multinomial distributions
+    rng = np.random.default_rng(seed)
+    if characteristic == "race":
+        totals = counts.sum(axis=-1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            p = np.nan_to_num(counts / totals[..., None])
+        boot = rng.multinomial(totals, p, size=(n_boot,) + totals.shape)
+    else:
+        totals = counts.sum(axis=(-1, -2))
+        flat = counts.reshape(len(labels), -1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            p = np.nan_to_num(flat / totals[:, None])
+        boot = rng.multinomial(totals, p, size=(n_boot, len(labels))).reshape(
+            (n_boot,) + counts.shape
+        )
+    boot_ratios = ratios(boot)
+    quantiles = np.nanquantile(boot_ratios, [0.025, 0.975, 0.16, 0.84], axis=0)
+
+    results = []
+    for g, label in enumerate(labels):
+        for d, value in enumerate(values):
+            # Everyone received at least a 2
+            for h in HIRE_LEVELS[2:]:
+                est = estimate[g, d, h - 1]
+                lwr0, upr0, lwr1, upr1 = quantiles[:, g, d, h - 1]
+                results.append(
+                    {
+                        **dict(zip(keys, label)),
+                        "characteristic": characteristic.capitalize(),
+                        "value": value,
+                        "hire": int(h),
+                        "est": est,
+                        "CI_lwr0": max(2 * est - upr0, 0),
+                        "CI_upr0": max(2 * est - lwr0, 0),
+                        "CI_lwr1": max(2 * est - upr1, 0),
+                        "CI_upr1": max(2 * est - lwr1, 0),
+                    }
+                )
+    return results
+
+
+def write_csv(path: str, rows: list) -> None:
+    """Write the result rows to a CSV file."""
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else [])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", type=str, default="data.db")
+    parser.add_argument("--out", type=str, default="disparities.csv")
+    parser.add_argument("--adverse-impact", type=str, default="adverse_impact.csv")
+    parser.add_argument("--n-boot", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=7140466)
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db) as conn:
+        data = load(conn)
+
+    write_csv(args.out, disparities(data))
+    write_csv(
+        args.adverse_impact,
+        adverse_impact(
+            data, "race", ["Black", "Hispanic"], "White", args.n_boot, args.seed
+        )
+        + adverse_impact(data, "gender", ["female"], "male", args.n_boot, args.seed),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,26 @@
 #!/usr/bin/env python3
 import argparse
 import asyncio
-import os
+import sqlite3
 
-import aiofiles
 import aiosqlite
-import openai
-import tiktoken
-from aiolimiter import AsyncLimiter
+import numpy as np
 from tqdm.asyncio import tqdm_asyncio as tqdm
 
-client = openai.AsyncOpenAI(
-    api_key=os.environ["OPENAI_API_KEY"],
-    organization=os.environ.get("OPENAI_API_ORG"),
-)
-encoding = tiktoken.get_encoding("cl100k_base")
-semaphore = asyncio.Semaphore(100)
-rate_limiter = AsyncLimiter(4000)
+import _corpus
+import _embeddings
+import _fingerprints
+import _http
+import _ratelimiters
+import _tokens
+
+client = _http.OPENAI
+encoding = _tokens.encoding("cl100k_base")
+semaphore = asyncio.Semaphore(_ratelimiters.MAX_CONNECTIONS)
+rate_limiter = _ratelimiters.limiter(f"requests:{_embeddings.MODEL}", 4000)
+
+# The embeddings table needs three columns besides the dimensions
+MAX_TABLE_DIMENSIONS = 1997
 
 
 async def get_ids(db):
@@ -28,96 +32,177 @@ async def get_ids(db):
 
 async def get_question_ids(interview_id: str, redacted: bool):
     folder = "redacted" if redacted else "unredacted"
-    ids = []
-    for filename in os.listdir(f"questions/{folder}/"):
-        if filename.startswith(f"{interview_id}_"):
-            ids.append(filename[:-4].split("_")[1])
-    return ids
+    return _corpus.question_ids(folder, interview_id)
 
 
 async def embed(
     interview_id: str, redacted: bool, use_resume: bool, db: aiosqlite.Connection
 ) -> None:
     async with semaphore:
-        text = ""
-        if use_resume:
-            folder = "redacted" if redacted else "unredacted"
-            async with aiofiles.open(
-                f"resumes/{folder}/{interview_id}.txt", "r"
-            ) as file:
-                text = await file.read()
-        else:
-            folder = "redacted" if redacted else "unredacted"
-            question_ids = await get_question_ids(interview_id, redacted)
-            for question_id in question_ids:
-                async with aiofiles.open(
-                    f"questions/{folder}/{interview_id}_{question_id}.txt", "r"
-                ) as file:
-                    text += "\n\n" + await file.read()
-
-        tokens = encoding.encode(text)[:8178]
-        text = encoding.decode(tokens)
+        text = _embeddings.document(interview_id, redacted, use_resume)
+        fingerprint = _fingerprints.digest(_embeddings.MODEL, text)
+
+        # Truncate to the model's input limit without blocking the event loop
+        tokens = await asyncio.to_thread(encoding.encode, text)
+        text = await asyncio.to_thread(encoding.decode, tokens[:8178])
 
+        # Fetch the full embedding once; smaller sizes are derived locally
         async with rate_limiter:
             response = await client.embeddings.create(
                 input=[
                     text
                     + "\n\nWhat race and gender is the person who wrote or said this?"
                 ],
-                model="text-embedding-3-large",
-                dimensions=256,
+                model=_embeddings.MODEL,
             )
 
-        values = [interview_id, int(redacted), int(use_resume)] + response.data[
-            0
-        ].embedding
-        placeholders = ",".join(["?"] * (3 + 256))
         await db.execute(
-            f"""
-            INSERT INTO embeddings
+            """
+            INSERT INTO embedding_vectors (
+                interview_id, redacted, resume, model, dimensions, vector
+            ) VALUES (?, ?, ?, ?, ?, ?)
+            """,
             (
                 interview_id,
-                redacted,
-                resume,
-                {','.join(f'X_{i}' for i in range(256))}
-            )
-            VALUES ({placeholders})
+                int(redacted),
+                int(use_resume),
+                _embeddings.MODEL,
+                len(response.data[0].embedding),
+                _embeddings.to_blob(response.data[0].embedding),
+            ),
+        )
+
+        # Record what was embedded, so that pipeline.py can tell when it changes
+        await db.execute(
+            """
+            INSERT OR REPLACE INTO fingerprints (kind, key, fingerprint)
+            VALUES ('embedding', ?, ?)
             """,
-            values,
+            (f"{interview_id}:{int(redacted)}:{int(use_resume)}", fingerprint),
         )
         await db.commit()
 
 
-async def main():
+async def fetch():
     async with aiosqlite.connect("data.db") as db:
         interview_ids = await get_ids(db)
-        tasks = []
-        for redacted in (False, True):
-            for resume in (False, True):
-                for id in interview_ids:
-                    # Check if this combination already exists
-                    async with db.execute(
-                        """SELECT 1 FROM embeddings 
-                        WHERE interview_id = ? AND redacted = ? AND resume = ?""",
-                        (id, int(redacted), int(resume)),
-                    ) as cursor:
-                        if not await cursor.fetchone():
-                            tasks.append(embed(id, redacted, resume, db))
-
-        if not tasks:
+        async with db.execute(
+            "SELECT interview_id, redacted, resume FROM embedding_vectors"
+        ) as cursor:
+            existing = {
+                (str(row[0]), bool(row[1]), bool(row[2]))
+                for row in await cursor.fetchall()
+            }
+
+        tasks = [
+            embed(id, redacted, resume, db)
+            for redacted in (False, True)
+            for resume in (False, True)
+            for id in interview_ids
+            if (id, redacted, resume) not in existing
+        ]
+        if tasks:
+            await _http.prewarm(min(len(tasks), _ratelimiters.MAX_CONNECTIONS))
+            await tqdm.gather(*tasks)
+            print(_http.TRANSPORT.report())
+    await _http.close()
+
+
+def missing(conn: sqlite3.Connection) -> int:
+    """Count the documents of interviews in the study that have no embedding."""
+    (n,) = conn.execute(
+        """
+        SELECT COUNT(*)
+        FROM interviews
+        CROSS JOIN (SELECT 0 AS redacted UNION ALL SELECT 1) AS redactions
+        CROSS JOIN (SELECT 0 AS resume UNION ALL SELECT 1) AS documents
+        LEFT JOIN embedding_vectors
+            ON embedding_vectors.interview_id = interviews.interview_id
+            AND embedding_vectors.redacted = redactions.redacted
+            AND embedding_vectors.resume = documents.resume
+        WHERE interviews.in_study = 1
+        AND embedding_vectors.interview_id IS NULL
+        """
+    ).fetchone()
+    return n
+
+
+def export(dimensions: int, out: str | None = None, force: bool = False) -> None:
+    with sqlite3.connect("data.db") as conn:
+        # Rebuilding the table from an incomplete fetch would lose embeddings
+        n_missing = missing(conn)
+        if n_missing and not force:
+            raise SystemExit(
+                f"{n_missing} documents have not been embedded; run embed.py fetch "
+                "first, or pass --force to export the embeddings there are"
+            )
+        data = _embeddings.load(conn, dimensions)
+        if out is not None:
+            np.savez(out, **data)
             return
 
-        results = await tqdm.gather(*tasks)
-        for interview_id, embedding, redacted, is_resume in results:
-            values = [interview_id, int(redacted), int(is_resume)] + embedding
-            placeholders = ",".join(["?"] * (3 + 256))
-            await db.execute(
-                f"INSERT INTO embeddings (interview_id, redacted, resume, {','.join(f'X_{i}' for i in range(256))}) "
-                f"VALUES ({placeholders})",
-                values,
+        # SQLite allows at most 2000 columns per table by default
+        if dimensions > MAX_TABLE_DIMENSIONS:
+            raise ValueError(
+                f"At most {MAX_TABLE_DIMENSIONS} dimensions fit in the embeddings "
+                "table; use --out to export a NumPy file instead"
             )
-            await db.commit()
+        columns = [f"X_{i}" for i in range(dimensions)]
+        conn.execute("DROP TABLE IF EXISTS embeddings")
+        conn.execute(
+            f"""
+            CREATE TABLE embeddings (
+                embedding_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                interview_id INTEGER NOT NULL,
+                redacted BOOLEAN NOT NULL,
+                resume BOOLEAN NOT NULL,
+                {", ".join(f"{column} REAL NOT NULL" for column in columns)}
+            )
+            """
+        )
+        conn.execute(
+            "CREATE INDEX idx_embeddings_interview_id ON embeddings(interview_id)"
+        )
+        conn.executemany(
+            f"""
+            INSERT INTO embeddings (interview_id, redacted, resume, {",".join(columns)})
+            VALUES ({",".join("?" * (3 + dimensions))})
+            """,
+            (
+                (int(interview_id), int(redacted), int(resume), *map(float, x))
+                for interview_id, redacted, resume, x in zip(
+                    data["interview_id"], data["redacted"], data["resume"], data["X"]
+                )
+            ),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("fetch", help="Embed every document at full size")
+    export_parser = subparsers.add_parser(
+        "export", help="Derive embeddings of a smaller size from the stored ones"
+    )
+    export_parser.add_argument("--dimensions", type=int, default=256)
+    export_parser.add_argument(
+        "--out",
+        type=str,
+        default=None,
+        help="Write a .npz file instead of rebuilding the embeddings table",
+    )
+    export_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Export even if some documents have not been embedded",
+    )
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.dimensions, args.out, args.force)
+    else:
+        asyncio.run(fetch())
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
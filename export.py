@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""Export an analysis-ready columnar snapshot of the ratings and checks."""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# Each snapshot joins one result table to the request, prompt, persona, and
+# interview it belongs to. Race and gender are the persona's where there is
+# one, and the interviewee's otherwise (i.e., for the redacted and unredacted
+# experiments).
+QUERIES = {
+    "ratings": """
+        SELECT
+            ratings.parsed_id,
+            ratings.request_id,
+            requests.model,
+            prompts.experiment_type,
+            prompts.prompt_id,
+            prompts.interview_id,
+            prompts.persona_id,
+            COALESCE(personas.race, interviews.race) AS race,
+            COALESCE(personas.gender, interviews.gender) AS gender,
+            personas.first_name AS name,
+            personas.college,
+            interviews.race AS interview_race,
+            interviews.gender AS interview_gender,
+            ratings.experience,
+            ratings.professionalism,
+            ratings.fit,
+            ratings.hire,
+            ratings.parsed,
+            ratings.error
+        FROM ratings
+        JOIN requests ON ratings.request_id = requests.request_id
+        JOIN prompts ON requests.prompt_id = prompts.prompt_id
+        JOIN interviews ON prompts.interview_id = interviews.interview_id
+        LEFT JOIN personas ON prompts.persona_id = personas.persona_id
+        WHERE ratings.parsed_id > :last_id
+        ORDER BY ratings.parsed_id
+    """,
+    "checks": """
+        SELECT
+            checks.parsed_id,
+            checks.request_id,
+            requests.model,
+            prompts.experiment_type,
+            prompts.prompt_id,
+            prompts.interview_id,
+            prompts.persona_id,
+            COALESCE(personas.race, interviews.race) AS race,
+            COALESCE(personas.gender, interviews.gender) AS gender,
+            personas.first_name AS name,
+            personas.college,
+            interviews.race AS interview_race,
+            interviews.gender AS interview_gender,
+            checks.race AS inferred_race,
+            checks.gender AS inferred_gender,
+            checks.parsed,
+            checks.error
+        FROM checks
+        JOIN requests ON checks.request_id = requests.request_id
+        JOIN prompts ON requests.prompt_id = prompts.prompt_id
+        JOIN interviews ON prompts.interview_id = interviews.interview_id
+        LEFT JOIN personas ON prompts.persona_id = personas.persona_id
+        WHERE checks.parsed_id > :last_id
+        ORDER BY checks.parsed_id
+    """,
+}
+
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+RATING = pa.int8()
+
+TYPES = {
+    "parsed_id": pa.int64(),
+    "request_id": pa.int64(),
+    # Partition columns are stored in the directory names
+    "model": pa.string(),
+    "experiment_type": pa.string(),
+    "prompt_id": pa.int64(),
+    "interview_id": pa.int64(),
+    "persona_id": pa.int64(),
+    "race": CATEGORY,
+    "gender": CATEGORY,
+    "name": CATEGORY,
+    "college": CATEGORY,
+    "interview_race": CATEGORY,
+    "interview_gender": CATEGORY,
+    "experience": RATING,
+    "professionalism": RATING,
+    "fit": RATING,
+    "hire": RATING,
+    "inferred_race": CATEGORY,
+    "inferred_gender": CATEGORY,
+    "parsed": pa.bool_(),
+    "error": pa.bool_(),
+}
+
+PARTITIONING = ds.partitioning(
+    pa.schema([("model", pa.string()), ("experiment_type", pa.string())]),
+    flavor="hive",
+)
+
+# Rows already exported are fingerprinted by their count and the sum of their
+# parsed_ids in each partition. Since parsed_ids are never reused, a deleted
+# (e.g., invalidated) or late-merged row changes its partition's fingerprint.
+FINGERPRINT = """
+SELECT model, experiment_type, COUNT(*), TOTAL(parsed_id)
+FROM ({query})
+WHERE parsed_id <= :upto
+GROUP BY model, experiment_type
+"""
+
+################################################################################
+
+
+def read_manifest(path: str) -> dict:
+    """Read the last exported parsed_id and partition fingerprints of each table."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def fingerprints(conn: sqlite3.Connection, table: str, upto: int) -> list:
+    """Return [model, experiment_type, count, total] for each partition."""
+    return [
+        list(row)
+        for row in conn.execute(
+            FINGERPRINT.format(query=QUERIES[table]), {"last_id": 0, "upto": upto}
+        )
+    ]
+
+
+def delete_partition(out_dir: str, table: str, model: str, experiment_type: str):
+    """Delete the snapshot files of one partition of a table."""
+    path = os.path.join(out_dir, table)
+    if not os.path.exists(path):
+        return
+    dataset = ds.dataset(path, format="parquet", partitioning=PARTITIONING)
+    for fragment in dataset.get_fragments():
+        keys = ds.get_partition_keys(fragment.partition_expression)
+        if keys == {"model": model, "experiment_type": experiment_type}:
+            os.remove(fragment.path)
+
+
+def to_arrow(cursor: sqlite3.Cursor, rows: list) -> pa.Table:
+    """Convert the rows of a snapshot query to a typed Arrow table."""
+    names = [column[0] for column in cursor.description]
+    arrays = []
+    for i, name in enumerate(names):
+        values = [row[i] for row in rows]
+        if TYPES[name] == pa.bool_():
+            values = [None if value is None else bool(value) for value in values]
+        if pa.types.is_dictionary(TYPES[name]):
+            arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type=TYPES[name]))
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def export_batch(
+    conn: sqlite3.Connection,
+    table: str,
+    out_dir: str,
+    last_id: int,
+    batch_size: int,
+    partition: tuple[str, str] | None = None,
+    upto: int | None = None,
+) -> int | None:
+    """Append the next batch of rows added since last_id to the table's snapshot.
+
+    With a partition, only its rows are exported, up to parsed_id upto.
+    """
+    query = QUERIES[table]
+    if partition is not None:
+        query = f"""
+            SELECT * FROM ({query})
+            WHERE model = :model
+            AND experiment_type = :experiment_type
+            AND parsed_id <= :upto
+            ORDER BY parsed_id
+        """
+    cursor = conn.execute(
+        query + " LIMIT :batch_size",
+        {
+            "last_id": last_id,
+            "batch_size": batch_size,
+            "model": partition and partition[0],
+            "experiment_type": partition and partition[1],
+            "upto": upto,
+        },
+    )
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+
+    first_id, last_id = rows[0][0], rows[-1][0]
+    print(f"Exporting {table} {first_id} to {last_id}.")
+    ds.write_dataset(
+        to_arrow(cursor, rows),
+        os.path.join(out_dir, table),
+        format="parquet",
+        partitioning=PARTITIONING,
+        basename_template=f"part-{first_id}-{last_id}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    return last_id
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", type=str, default="data.db")
+    parser.add_argument("--out", type=str, default="snapshot")
+    parser.add_argument("--batch-size", type=int, default=100_000)
+    parser.add_argument(
+        "--rebuild", action="store_true", help="Discard the snapshot and start over"
+    )
+    args = parser.parse_args()
+
+    if args.rebuild and os.path.exists(args.out):
+        shutil.rmtree(args.out)
+    os.makedirs(args.out, exist_ok=True)
+
+    manifest_path = os.path.join(args.out, "manifest.json")
+    manifest = read_manifest(manifest_path)
+
+    def save():
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+
+    with sqlite3.connect(args.db) as conn:
+        for table in QUERIES:
+            # Snapshots from before partitions were fingerprinted are redone
+            entry = manifest.get(table)
+            if not isinstance(entry, dict):
+                shutil.rmtree(os.path.join(args.out, table), ignore_errors=True)
+                entry = manifest[table] = {"last_id": 0, "partitions": []}
+
+            # Rewrite the partitions whose exported rows have since changed
+            stored = {(m, e): (n, total) for m, e, n, total in entry["partitions"]}
+            current = {
+                (m, e): (n, total)
+                for m, e, n, total in fingerprints(conn, table, entry["last_id"])
+            }
+            for partition in sorted(stored.keys() | current.keys()):
+                if stored.get(partition) == current.get(partition):
+                    continue
+                print(f"Rewriting {table} for {partition[0]}, {partition[1]}.")
+                delete_partition(args.out, table, *partition)
+                last_id = 0
+                while last_id is not None:
+                    last_id = export_batch(
+                        conn,
+                        table,
+                        args.out,
+                        last_id,
+                        args.batch_size,
+                        partition,
+                        entry["last_id"],
+                    )
+
+            # Then append the rows added since the last export, as new files
+            # in each partition
+            while True:
+                last_id = export_batch(
+                    conn, table, args.out, entry["last_id"], args.batch_size
+                )
+                if last_id is None:
+                    break
+                entry["last_id"] = last_id
+                save()
+            entry["partitions"] = fingerprints(conn, table, entry["last_id"])
+            save()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,30 +2,36 @@
 """Extract ratings and demographics from imperfectly structured data."""
 import argparse
 import asyncio
+import hashlib
+import json
 import logging
-import os
 import sqlite3
-from typing import Annotated, Optional
+from functools import partial
 
 import aiosqlite
 import openai
-import tiktoken
-from pydantic import BaseModel, Field, ValidationError, conint, field_validator
+from pydantic import BaseModel, ValidationError
 from tqdm.asyncio import tqdm
 
+import _compress
+import _deadletter
+import _hedging
+import _http
+import _loopmonitor
+import _queries
 import _ratelimiters
+import _shards
+import _tokens
+from _schemas import CheckResponse, Error, RatingResponse
 
-client = openai.AsyncOpenAI(
-    api_key=os.environ["OPENAI_API_KEY"],
-    organization=os.environ.get("OPENAI_API_ORG"),
-)
-encoding = tiktoken.encoding_for_model("gpt-4o-mini")
+client = _http.OPENAI
+MODEL = "gpt-4o-mini-2024-07-18"
 
-semaphore = asyncio.Semaphore(100)
+semaphore = asyncio.Semaphore(_ratelimiters.MAX_CONNECTIONS)
 
 # True limits are 1e4 requests per minute and 2e6 tokens per minute
-REQUEST_LIMITER = _ratelimiters.REQUEST_LIMITER["gpt-4o-mini-2024-07-18"]
-TOKEN_LIMITER = _ratelimiters.TOKEN_LIMITER["gpt-4o-mini-2024-07-18"]
+REQUEST_LIMITER = _ratelimiters.REQUEST_LIMITER[MODEL]
+TOKEN_LIMITER = _ratelimiters.TOKEN_LIMITER[MODEL]
 CONNECTION_LIMITER = _ratelimiters.CONNECTION_LIMITER
 
 ################################################################################
@@ -64,7 +70,7 @@ Errors you may encounter include (but are not limited to):
 ```
 """.strip()
 
-RATINGS_N = len(encoding.encode(SYSTEM_RATINGS))
+RATINGS_N = _tokens.count_tokens(MODEL, SYSTEM_RATINGS)
 
 SYSTEM_CHECKS = """
 You are a helpful JSON reformatting assistant. I give you potentially unstructed
@@ -97,272 +103,193 @@ encounter an error, please return an error message in the following JSON format:
 fields.)
 """
 
-CHECKS_N = len(encoding.encode(SYSTEM_CHECKS))
+CHECKS_N = _tokens.count_tokens(MODEL, SYSTEM_CHECKS)
 
 ################################################################################
 
 
-class RatingResponse(BaseModel):
-    """A rating response from the model."""
-
-    summary: Optional[str] = None
-    professionalism: conint(ge=1, le=5)
-    experience: conint(ge=1, le=5)
-    fit: conint(ge=1, le=5)
-    hire: conint(ge=1, le=5)
-
-
-class CheckResponse(BaseModel):
-    """A demographic response from the model."""
-
-    name: Optional[str] = None
-    race: Annotated[str, Field(pattern=r"(?i)^(Asian|Black|Hispanic|White|NA)$")]
-    gender: Annotated[str, Field(pattern=r"(?i)^(male|female|NA)$")]
-
-    @field_validator("race")
-    @classmethod
-    def upper_case_race(cls, value):
-        return value.capitalize()
-
-    @field_validator("gender")
-    @classmethod
-    def lower_case_gender(cls, value):
-        return value.lower()
-
-
-class Error(BaseModel):
-    """An error response from the model."""
-
-    error: bool = True
-    error_message: str
+# Columns each kind of extraction writes, besides request_id
+COLUMNS = {
+    "ratings": [
+        "professionalism",
+        "experience",
+        "fit",
+        "hire",
+        "parsed",
+        "error",
+        "error_message",
+    ],
+    "checks": ["race", "gender", "parsed", "error", "error_message"],
+}
 
 
-async def extract_rating(request_id: int, text: str, conn: aiosqlite.Connection):
-    """Extract the ratings from the text."""
+async def _parse(
+    text: str, schema: type[BaseModel], system_message: str, system_n: int
+) -> dict:
+    """Parse the text with the schema, asking the model to reformat it if needed."""
     # If there is no text, log an error, because there's a problem with the
     # request
     if not text:
-        logging.error("Empty text for request_id: %s", request_id)
-        async with conn.cursor() as cur:
-            await cur.execute(
-                """
-                INSERT INTO ratings (request_id, error, error_message)
-                VALUES (?, ?, ?);
-                """,
-                (request_id, True, "Empty text"),
-            )
-            await conn.commit()
-        return
+        return {"error": True, "error_message": "Empty text"}
 
-    # First, check if the text is already valid JSON
+    # First, check if the text is already valid JSON. Validation and token
+    # counting run in worker threads to keep the event loop responsive.
     try:
-        response = RatingResponse.model_validate_json(text)
+        response = await asyncio.to_thread(schema.model_validate_json, text)
         logging.debug("Validated JSON: %s", text)
-        async with CONNECTION_LIMITER:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    """
-                    INSERT INTO ratings (
-                        request_id, professionalism, experience, fit, hire, parsed,
-                        error
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?);
-                    """,
-                    (
-                        request_id,
-                        response.professionalism,
-                        response.experience,
-                        response.fit,
-                        response.hire,
-                        False,
-                        False,
-                    ),
-                )
-                await conn.commit()
-                return
+        return {**response.model_dump(), "parsed": False, "error": False}
 
     # If the text is not valid JSON, we need to send it to the model
     except ValidationError:
-        await TOKEN_LIMITER.acquire(
-            len(encoding.encode(text, disallowed_special=())) + RATINGS_N
-        )
-        async with CONNECTION_LIMITER, REQUEST_LIMITER:
-            try:
-                raw_response = await client.chat.completions.create(
-                    model="gpt-4o-mini-2024-07-18",
+        pass
+
+    n_tokens = await asyncio.to_thread(_tokens.count_tokens, MODEL, text)
+    await TOKEN_LIMITER.acquire(n_tokens + system_n)
+    async with CONNECTION_LIMITER, REQUEST_LIMITER:
+        try:
+            raw_response = await _hedging.call(
+                MODEL,
+                partial(
+                    client.chat.completions.create,
+                    model=MODEL,
                     messages=[
-                        {"role": "system", "content": SYSTEM_RATINGS},
+                        {"role": "system", "content": system_message},
                         {"role": "user", "content": text},
                     ],
                     response_format={"type": "json_object"},
-                )
-            except openai.BadRequestError as e:
-                logging.error("Bad request with text: %s, error: %s", text, e)
-                async with conn.cursor() as cur:
-                    await cur.execute(
-                        """
-                        INSERT INTO ratings (request_id, error, error_message)
-                        VALUES (?, ?, ?);
-                        """,
-                        (request_id, True, str(e)),
-                    )
-                    await conn.commit()
-                    return
-            str_response = raw_response.choices[0].message.content
-            logging.debug("Model response: %s", str_response)
+                ),
+                [(TOKEN_LIMITER, n_tokens + system_n), (REQUEST_LIMITER, 1)],
+            )
+        except openai.BadRequestError as e:
+            logging.error("Bad request with text: %s, error: %s", text, e)
+            return {"error": True, "error_message": str(e)}
+        str_response = raw_response.choices[0].message.content
+        logging.debug("Model response: %s", str_response)
 
+    try:
+        response = await asyncio.to_thread(schema.model_validate_json, str_response)
+        return {**response.model_dump(), "parsed": True, "error": False}
+    except ValidationError:
         try:
-            response = RatingResponse.model_validate_json(str_response)
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    """
-                    INSERT INTO ratings (
-                        request_id, professionalism, experience, fit, hire, parsed,
-                        error
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?);
-                    """,
-                    (
-                        request_id,
-                        response.professionalism,
-                        response.experience,
-                        response.fit,
-                        response.hire,
-                        True,
-                        False,
-                    ),
-                )
-                await conn.commit()
+            error = Error.model_validate_json(str_response)
+            return {"error": True, "error_message": error.error_message}
         except ValidationError:
-            try:
-                error = Error.model_validate_json(str_response)
-                async with conn.cursor() as cur:
-                    await cur.execute(
-                        """
-                        INSERT INTO ratings (request_id, error, error_message)
-                        VALUES (?, ?, ?);
-                        """,
-                        (request_id, True, error.error_message),
-                    )
-                    await conn.commit()
-
-            except ValidationError:
-                error_message = f"Unknown error parsing model response: {str_response}"
-                logging.error(error_message)
-                async with conn.cursor() as cur:
-                    await cur.execute(
-                        """
-                        INSERT INTO ratings (request_id, error, error_message)
-                        VALUES (?, ?, ?);
-                        """,
-                        (request_id, True, error_message),
-                    )
-                    await conn.commit()
-
-
-async def extract_checks(request_id: int, text: str, conn: aiosqlite.Connection):
+            error_message = f"Unknown error parsing model response: {str_response}"
+            logging.error(error_message)
+            return {"error": True, "error_message": error_message}
+
+
+async def parse_rating(text: str) -> dict:
+    """Extract the ratings from the text."""
+    return await _parse(text, RatingResponse, SYSTEM_RATINGS, RATINGS_N)
+
+
+async def parse_checks(text: str) -> dict:
     """Extract the manipulation check from the text."""
-    # If there is no text, log an error, because there's a problem with the
-    # request
-    if not text:
-        logging.error("Empty text for request_id: %s", request_id)
-        async with conn.cursor() as cur:
-            await cur.execute(
-                """
-                INSERT INTO ratings (request_id, error, error_message)
-                VALUES (?, ?, ?);
-                """,
-                (request_id, True, "Empty text"),
-            )
-            await conn.commit()
-        return
+    return await _parse(text, CheckResponse, SYSTEM_CHECKS, CHECKS_N)
 
-    # First, check if the text is already valid JSON
-    try:
-        response = CheckResponse.model_validate_json(text)
-        logging.debug("Validated JSON: %s", text)
-        async with CONNECTION_LIMITER:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    """
-                    INSERT INTO checks (request_id, race, gender, parsed, error)
-                    VALUES (?, ?, ?, ?, ?);
-                    """,
-                    (request_id, response.race, response.gender, False, False),
-                )
-                await conn.commit()
-                return
 
-    # If the text is not valid JSON, we need to send it to the model
-    except ValidationError:
-        await TOKEN_LIMITER.acquire(
-            len(encoding.encode(text, disallowed_special=())) + CHECKS_N
+PARSERS = {"ratings": parse_rating, "checks": parse_checks}
+
+################################################################################
+# Extraction cache
+
+
+def cache_key(text: str | None) -> str:
+    """Hash the text after collapsing whitespace."""
+    return hashlib.sha256(" ".join((text or "").split()).encode()).hexdigest()
+
+
+async def parse(kind: str, text: str, cache: aiosqlite.Connection) -> dict:
+    """Parse a response, reusing the result for any identical response."""
+    key = cache_key(text)
+    async with cache.execute(
+        "SELECT result FROM extraction_cache WHERE kind = ? AND text_hash = ?",
+        (kind, key),
+    ) as cur:
+        row = await cur.fetchone()
+    if row is not None:
+        result = json.loads(row[0])
+        # Caches from before only successes were kept may hold other failures
+        if not result["error"] or not text:
+            return result
+
+    result = await PARSERS[kind](text)
+
+    # Only empty text is sure to fail again; any other failure may be the
+    # model's, so it is left for the next attempt rather than cached
+    if not result["error"] or not text:
+        await cache.execute(
+            """
+            INSERT OR REPLACE INTO extraction_cache (kind, text_hash, result)
+            VALUES (?, ?, ?);
+            """,
+            (kind, key, json.dumps(result)),
         )
-        async with CONNECTION_LIMITER, REQUEST_LIMITER:
-            try:
-                raw_response = await client.chat.completions.create(
-                    model="gpt-4o-mini-2024-07-18",
-                    messages=[
-                        {"role": "system", "content": SYSTEM_CHECKS},
-                        {"role": "user", "content": text},
-                    ],
-                    response_format={"type": "json_object"},
-                )
-            except openai.BadRequestError as e:
-                logging.error("Bad request with text: %s, error: %s", text, e)
-                async with conn.cursor() as cur:
-                    await cur.execute(
-                        """
-                        INSERT INTO checks (request_id, error, error_message)
-                        VALUES (?, ?, ?);
-                        """,
-                        (request_id, True, str(e)),
-                    )
-                    await conn.commit()
-                return
-            str_response = raw_response.choices[0].message.content
-            logging.debug("Model response: %s", str_response)
+        await cache.commit()
+    return result
+
+
+async def insert(
+    kind: str, request_ids: list[int], result: dict, conn: aiosqlite.Connection
+):
+    """Write a parsed result for every given request, without committing."""
+    columns = COLUMNS[kind]
+    await conn.executemany(
+        f"""
+        INSERT INTO {kind} (request_id, {", ".join(columns)})
+        VALUES (?, {", ".join("?" * len(columns))});
+        """,
+        [
+            (request_id, *(result.get(column) for column in columns))
+            for request_id in request_ids
+        ],
+    )
 
-        try:
-            response = CheckResponse.model_validate_json(str_response)
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    """
-                    INSERT INTO checks (request_id, race, gender, parsed, error)
-                    VALUES (?, ?, ?, ?, ?);
-                    """,
-                    (
-                        request_id,
-                        response.race,
-                        response.gender,
-                        True,
-                        False,
-                    ),
-                )
-                await conn.commit()
-        except ValidationError:
-            try:
-                error = Error.model_validate_json(str_response)
-                async with conn.cursor() as cur:
-                    await cur.execute(
-                        """
-                        INSERT INTO checks (request_id, error, error_message)
-                        VALUES (?, ?, ?);
-                        """,
-                        (request_id, True, error.error_message),
-                    )
-                    await conn.commit()
-
-            except ValidationError:
-                error_message = f"Unknown error parsing model response: {str_response}"
-                logging.error(error_message)
-                async with conn.cursor() as cur:
-                    await cur.execute(
-                        """
-                        INSERT INTO checks (request_id, error, error_message)
-                        VALUES (?, ?, ?);
-                        """,
-                        (request_id, True, error_message),
-                    )
-                    await conn.commit()
+
+async def extract(
+    kind: str,
+    request_ids: list[int],
+    text: str,
+    conn: aiosqlite.Connection,
+    cache: aiosqlite.Connection,
+    redrive: bool = False,
+):
+    """Extract a response once and store the result for every request sharing it."""
+    if not text:
+        logging.error("Empty text for request_ids: %s", request_ids)
+
+    # Re-driven extractions only use capacity that new ones leave unused
+    if redrive:
+        await _deadletter.spare_capacity([(REQUEST_LIMITER, 1), (TOKEN_LIMITER, 1)])
+
+    try:
+        result = await parse(kind, text, cache)
+    except (openai.OpenAIError, TimeoutError) as e:
+        # Keep the requests as dead letters, to re-drive or report
+        failure = _deadletter.classify(e)
+        logging.error("%s error extracting %s: %s", failure, request_ids, e)
+        await conn.executemany(
+            """
+            INSERT INTO dead_letters (
+                request_id, stage, failure, error_type, error_message
+            ) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (request_id, stage) DO UPDATE SET
+                failure = excluded.failure,
+                attempts = attempts + 1,
+                error_type = excluded.error_type,
+                error_message = excluded.error_message,
+                timestamp = CURRENT_TIMESTAMP
+            """,
+            [
+                (request_id, kind, failure, type(e).__name__, str(e))
+                for request_id in request_ids
+            ],
+        )
+        await conn.commit()
+        return
+    await insert(kind, request_ids, result, conn)
+    await conn.commit()
 
 
 async def main():
@@ -370,6 +297,23 @@ async def main():
     parser.add_argument("--log-level", type=str, default="INFO")
     parser.add_argument("--log-file", type=str, default="extract.log")
     parser.add_argument("--n_max", type=int, default=100)
+    parser.add_argument(
+        "--db",
+        type=str,
+        default="data.db",
+        help="Database to read responses from and write results to, e.g., a shard",
+    )
+    parser.add_argument(
+        "--monitor-loop",
+        action="store_true",
+        help="Report event loop lag and the slowest blocking callbacks",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=_deadletter.MAX_ATTEMPTS,
+        help="Failures of an extraction after which it is no longer re-driven",
+    )
     parser.add_argument("kind", type=str, choices=["ratings", "checks"])
     args = parser.parse_args()
 
@@ -382,38 +326,51 @@ async def main():
 
     # Pull all the requests of the given kind from the database
     with sqlite3.connect("data.db") as conn:
-        operator = "" if args.kind == "checks" else "NOT"
         conn.row_factory = sqlite3.Row
+        _compress.register(conn)
+        schema = _shards.attach(conn, args.db)
         requests = conn.execute(
-            f"""
-            SELECT requests.*
-            FROM requests
-            LEFT JOIN prompts
-            ON requests.prompt_id = prompts.prompt_id
-            LEFT JOIN {args.kind}
-            ON requests.request_id = {args.kind}.request_id
-            WHERE {operator} prompts.experiment_type = 'manipulation_check'
-            AND {args.kind}.request_id IS NULL
-            AND NOT requests.error
-            LIMIT :n_max;
-            """,
-            {"n_max": args.n_max, "kind": args.kind},
+            _queries.pending_extractions(schema, args.kind),
+            {"n_max": args.n_max, "max_attempts": args.max_attempts},
         ).fetchall()
 
-    # Create an async connection to the database
-    conn = await aiosqlite.connect("data.db")
+    # Group requests whose responses are identical up to whitespace, so that each
+    # distinct response is only extracted once
+    responses = {}
+    for request in requests:
+        key = cache_key(request["raw_response"])
+        response = responses.setdefault(key, [request["raw_response"], [], False])
+        response[1].append(request["request_id"])
+        response[2] = response[2] or request["n_failed"] > 0
+
+    # Create async connections to the database and the shared extraction cache
+    conn = await aiosqlite.connect(args.db)
+    cache = await aiosqlite.connect("data.db")
 
     # Create a list of extraction coroutines
-    extract_ = extract_rating if args.kind == "ratings" else extract_checks
     tasks = [
-        extract_(request["request_id"], request["raw_response"], conn)
-        for request in requests
+        extract(args.kind, request_ids, text, conn, cache, redrive)
+        for text, request_ids, redrive in responses.values()
     ]
 
+    # Open the API connections before the first extraction needs them
+    if tasks:
+        await _http.prewarm(min(len(tasks), _ratelimiters.MAX_CONNECTIONS))
+
     # Run the extraction coroutines
+    monitor = _loopmonitor.LoopMonitor() if args.monitor_loop else None
+    if monitor is not None:
+        monitor.start()
     await tqdm.gather(*tasks)
-
-    # Close the connection
+    if monitor is not None:
+        await monitor.stop()
+        logging.info(monitor.report())
+        print(monitor.report())
+    logging.info(_http.TRANSPORT.report())
+
+    # Close the connections
+    await _http.close()
+    await cache.close()
     await conn.close()
 
 
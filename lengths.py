@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""Profile response lengths and derive per-experiment output budgets."""
+import argparse
+import json
+import math
+import sqlite3
+
+import numpy as np
+
+import _budgets
+import _compress
+import _shards
+import _tokens
+
+PERCENTILES = [50, 90, 95, 99]
+
+################################################################################
+
+
+def load(conn: sqlite3.Connection) -> dict:
+    """Load the output length and truncation of every response by group."""
+    # Older responses have no recorded length, so count their text instead
+    raw_response = (
+        "decompress(requests.raw_response)"
+        if "raw_response" in _shards.columns(conn, "main", "requests")
+        else "NULL"
+    )
+    _compress.register(conn)
+    rows = conn.execute(
+        f"""
+        SELECT
+            requests.model,
+            prompts.experiment_type,
+            completions.output_tokens,
+            completions.truncated,
+            completions.max_tokens,
+            {raw_response} AS raw_response
+        FROM requests
+        JOIN prompts ON requests.prompt_id = prompts.prompt_id
+        LEFT JOIN completions ON requests.request_id = completions.request_id
+        WHERE NOT requests.error
+        """
+    ).fetchall()
+
+    groups = {}
+    for model, experiment, output_tokens, truncated, max_tokens, text in rows:
+        if output_tokens is None:
+            if text is None:
+                continue
+            output_tokens = _tokens.count_tokens(model, text)
+        group = groups.setdefault(
+            (model, experiment), {"output_tokens": [], "truncated": [], "cap": 0}
+        )
+        group["output_tokens"].append(output_tokens)
+        if truncated is not None:
+            group["truncated"].append(bool(truncated))
+        group["cap"] = max(group["cap"], max_tokens or _budgets.DEFAULT_MAX_TOKENS)
+    return groups
+
+
+def profile(groups: dict) -> list:
+    """Summarize the length distribution and truncation rate of every group."""
+    results = []
+    for (model, experiment), group in sorted(groups.items()):
+        lengths = np.array(group["output_tokens"])
+        results.append(
+            {
+                "model": model,
+                "experiment_type": experiment,
+                "n": len(lengths),
+                **{f"p{p}": float(np.percentile(lengths, p)) for p in PERCENTILES},
+                "max": int(lengths.max()),
+                "truncation_rate": (
+                    float(np.mean(group["truncated"])) if group["truncated"] else None
+                ),
+                "cap": group["cap"],
+            }
+        )
+    return results
+
+
+def budgets(results: list, percentile: int, margin: float, existing: dict = {}) -> dict:
+    """Set each experiment's budget from the longest-running model's percentile.
+
+    An experiment whose responses were truncated keeps at least the cap it was
+    run with, since its true lengths are unknown. Stop sequences are kept.
+    """
+    budgets_ = {}
+    for result in results:
+        experiment = result["experiment_type"]
+        max_tokens = math.ceil(result[f"p{percentile}"] * (1 + margin))
+        if result["truncation_rate"]:
+            max_tokens = max(max_tokens, result["cap"])
+        budget = budgets_.setdefault(
+            experiment,
+            {"max_tokens": 0, "stop": existing.get(experiment, {}).get("stop", [])},
+        )
+        budget["max_tokens"] = max(budget["max_tokens"], max_tokens)
+    return {**existing, **budgets_}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", type=str, default="data.db")
+    parser.add_argument("--percentile", type=int, choices=PERCENTILES, default=99)
+    parser.add_argument(
+        "--margin",
+        type=float,
+        default=0.2,
+        help="Headroom to add to the percentile when setting budgets",
+    )
+    parser.add_argument(
+        "--write",
+        action="store_true",
+        help=f"Write the budgets to {_budgets.BUDGETS_PATH} for chat.py",
+    )
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db) as conn:
+        results = profile(load(conn))
+
+    columns = list(results[0]) if results else []
+    print("\t".join(columns))
+    for result in results:
+        print("\t".join(str(result[column]) for column in columns))
+
+    if args.write:
+        budgets_ = budgets(results, args.percentile, args.margin, _budgets.load())
+        with open(_budgets.BUDGETS_PATH, "w") as f:
+            json.dump(budgets_, f, indent=2)
+        print(f"Wrote budgets for {len(budgets_)} experiments.")
+
+
+if __name__ == "__main__":
+    main()
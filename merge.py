@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""Merge shard databases written by chat.py and extract.py into data.db."""
+import argparse
+import os
+import sqlite3
+
+import _shards
+
+################################################################################
+
+
+def merge_shard(conn: sqlite3.Connection, path: str) -> dict:
+    """Bulk-copy one shard into the main database, remapping its request ids."""
+    conn.execute("ATTACH DATABASE ? AS shard", (path,))
+    try:
+        with conn:
+            # Assign new request ids after every id the main database has ever
+            # used, keeping only the first successful request per prompt, model,
+            # and replicate. Failed requests are all kept, as the record of
+            # the attempts before a re-driven request succeeded.
+            conn.execute("DROP TABLE IF EXISTS temp.request_map")
+            conn.execute(
+                """
+                CREATE TEMP TABLE request_map (
+                    old_id INTEGER PRIMARY KEY,
+                    new_id INTEGER NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                INSERT INTO temp.request_map (old_id, new_id)
+                SELECT
+                    shard_requests.request_id,
+                    MAX(
+                        (SELECT COALESCE(MAX(request_id), 0) FROM main.requests),
+                        COALESCE(
+                            (
+                                SELECT seq FROM main.sqlite_sequence
+                                WHERE name = 'requests'
+                            ),
+                            0
+                        )
+                    ) + ROW_NUMBER() OVER (ORDER BY shard_requests.request_id)
+                FROM shard.requests AS shard_requests
+                LEFT JOIN shard.replicates AS shard_replicates
+                ON shard_requests.request_id = shard_replicates.request_id
+                WHERE shard_requests.error
+                OR shard_requests.request_id IN (
+                    SELECT MIN(requests.request_id)
+                    FROM shard.requests AS requests
+                    LEFT JOIN shard.replicates AS replicates
+                    ON requests.request_id = replicates.request_id
+                    WHERE NOT requests.error
+                    GROUP BY
+                        requests.prompt_id,
+                        requests.model,
+                        COALESCE(replicates.replicate, 0)
+                )
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM main.requests
+                    LEFT JOIN main.replicates
+                    ON main.requests.request_id = main.replicates.request_id
+                    WHERE main.requests.prompt_id = shard_requests.prompt_id
+                    AND main.requests.model = shard_requests.model
+                    AND NOT main.requests.error
+                    AND COALESCE(main.replicates.replicate, 0)
+                    = COALESCE(shard_replicates.replicate, 0)
+                )
+                """
+            )
+
+            counts = {}
+            for table in _shards.RESULT_TABLES:
+                key = "parsed_id" if table in ("ratings", "checks") else "request_id"
+
+                # Shards written before a table was added lack it
+                if not _shards.columns(conn, "shard", table):
+                    continue
+                main_columns = _shards.columns(conn, "main", table)
+                shard_columns = [
+                    column
+                    for column in _shards.columns(conn, "shard", table)
+                    if column in main_columns and column not in (key, "request_id")
+                ]
+                cursor = conn.execute(
+                    f"""
+                    INSERT INTO main.{table} (request_id, {",".join(shard_columns)})
+                    SELECT
+                        request_map.new_id,
+                        {",".join(f"shard_rows.{column}" for column in shard_columns)}
+                    FROM shard.{table} AS shard_rows
+                    JOIN temp.request_map AS request_map
+                    ON shard_rows.request_id = request_map.old_id
+                    ORDER BY shard_rows.{key}
+                    """
+                )
+                counts[table] = cursor.rowcount
+
+            (n_requests,) = conn.execute(
+                "SELECT COUNT(*) FROM shard.requests"
+            ).fetchone()
+            counts["duplicates"] = n_requests - counts["requests"]
+            conn.execute("DROP TABLE temp.request_map")
+    finally:
+        conn.execute("DETACH DATABASE shard")
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", type=str, default="data.db")
+    parser.add_argument(
+        "--delete", action="store_true", help="Delete each shard once merged"
+    )
+    parser.add_argument("shards", type=str, nargs="+")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    for path in args.shards:
+        counts = merge_shard(conn, path)
+        print(
+            f"Merged {path}: {counts['requests']} requests, {counts['ratings']} "
+            f"ratings, {counts['checks']} checks; skipped {counts['duplicates']} "
+            "duplicate requests."
+        )
+        if args.delete:
+            os.remove(path)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Bring a database up to date with the migrations and check the hot query plans."""
+import argparse
+import glob
+import os
+import sqlite3
+import sys
+import tempfile
+
+import _compress
+import _queries
+import _shards
+
+MIGRATIONS = "migrations"
+
+################################################################################
+
+
+def migrations() -> list[tuple[int, str]]:
+    """List the migrations as (version, path), in the order to apply them."""
+    return sorted(
+        (int(os.path.basename(path).split("_", 1)[0]), path)
+        for path in glob.glob(os.path.join(MIGRATIONS, "[0-9]*_*.sql"))
+    )
+
+
+def migrate(path: str) -> list[int]:
+    """Apply the migrations the database lacks, returning the versions applied."""
+    conn = sqlite3.connect(path, isolation_level=None)
+    applied = []
+    try:
+        (current,) = conn.execute("PRAGMA user_version").fetchone()
+        for version, migration in migrations():
+            if version <= current:
+                continue
+            with open(migration, "r") as f:
+                script = f.read()
+
+            # Apply each migration and record its version atomically
+            conn.execute("BEGIN")
+            try:
+                for statement in split(script):
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+            applied.append(version)
+    finally:
+        conn.close()
+    return applied
+
+
+def split(script: str) -> list[str]:
+    """Split a script into statements, since executescript() would commit."""
+    statements, statement = [], ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement)
+            statement = ""
+    return statements
+
+
+def check(path: str) -> list[str]:
+    """Return the unexpected table scans in the plans of the hot queries."""
+    problems = []
+    with tempfile.TemporaryDirectory() as directory:
+        shard = os.path.join(directory, "shard.db")
+        with sqlite3.connect(path) as conn:
+            _compress.register(conn)
+            for schema in ["main", "shard"]:
+                if schema == "shard":
+                    _shards.create(shard, source=path)
+                    conn.execute("ATTACH DATABASE ? AS shard", (shard,))
+                for name, query, parameters, allowed in _queries.cases(schema):
+                    for scan in _queries.scans(conn, query, parameters):
+                        if scan.split()[1] not in allowed:
+                            problems.append(f"{name}: {scan}")
+            conn.execute("DETACH DATABASE shard")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", type=str, default="data.db")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Fail if a hot query's plan scans a table it should search",
+    )
+    args = parser.parse_args()
+
+    applied = migrate(args.db)
+    if applied:
+        print(f"Applied migrations {', '.join(map(str, applied))} to {args.db}.")
+    else:
+        print(f"{args.db} is up to date.")
+
+    if args.check:
+        problems = check(args.db)
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        if problems:
+            sys.exit(1)
+        print("No unexpected table scans.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+-- Tables added alongside the original schema, for databases created before them
+
+CREATE TABLE IF NOT EXISTS prompt_tokens (
+    prompt_id INTEGER NOT NULL,
+    family TEXT NOT NULL,
+    n_tokens INTEGER NOT NULL,
+    PRIMARY KEY (prompt_id, family),
+    FOREIGN KEY (prompt_id) REFERENCES prompts(prompt_id)
+);
+
+CREATE TABLE IF NOT EXISTS completions (
+    request_id INTEGER PRIMARY KEY,
+    output_tokens INTEGER,
+    truncated BOOLEAN NOT NULL,
+    max_tokens INTEGER NOT NULL,
+    FOREIGN KEY (request_id) REFERENCES requests(request_id)
+);
+
+CREATE TABLE IF NOT EXISTS replicates (
+    request_id INTEGER PRIMARY KEY,
+    replicate INTEGER NOT NULL,
+    FOREIGN KEY (request_id) REFERENCES requests(request_id)
+);
+
+CREATE TABLE IF NOT EXISTS extraction_cache (
+    kind TEXT NOT NULL,
+    text_hash TEXT NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (kind, text_hash)
+);
+
+CREATE TABLE IF NOT EXISTS embedding_vectors (
+    interview_id INTEGER NOT NULL,
+    redacted BOOLEAN NOT NULL,
+    resume BOOLEAN NOT NULL,
+    model TEXT NOT NULL,
+    dimensions INTEGER NOT NULL,
+    vector BLOB NOT NULL,
+    PRIMARY KEY (interview_id, redacted, resume),
+    FOREIGN KEY (interview_id) REFERENCES interviews(interview_id)
+);
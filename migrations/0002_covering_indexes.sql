@@ -0,0 +1,15 @@
+-- Composite indexes matching the pending-work queries in _queries.py. Each
+-- replaces a single-column index that is a prefix of it.
+
+-- chat.py finds a model's answered prompts from the index alone
+CREATE INDEX IF NOT EXISTS idx_requests_model_prompt_id
+ON requests(model, prompt_id);
+DROP INDEX IF EXISTS idx_requests_model;
+
+-- chat.py filters prompts by experiment and counts each interview's prompts.
+-- Indexes already end in the rowid, so prompt_id need not be listed.
+CREATE INDEX IF NOT EXISTS idx_prompts_experiment_type_interview_id
+ON prompts(experiment_type, interview_id);
+DROP INDEX IF EXISTS idx_prompts_experiment_type;
+
+ANALYZE;
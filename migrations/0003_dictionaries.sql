@@ -0,0 +1,8 @@
+-- Compression dictionaries for the text columns listed in _compress.py
+
+CREATE TABLE IF NOT EXISTS dictionaries (
+    dictionary_id INTEGER PRIMARY KEY,
+    column_name TEXT NOT NULL,
+    dictionary BLOB NOT NULL,
+    timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,9 @@
+-- Hedged calls per prompt, recorded with the prompt's first request
+
+CREATE TABLE IF NOT EXISTS hedges (
+    request_id INTEGER PRIMARY KEY,
+    n_hedges INTEGER NOT NULL,
+    n_won INTEGER NOT NULL,
+    saved REAL NOT NULL,
+    FOREIGN KEY (request_id) REFERENCES requests(request_id)
+);
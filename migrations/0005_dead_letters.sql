@@ -0,0 +1,19 @@
+-- Failed requests and extractions, classified as transient or permanent, so
+-- that transient failures are re-driven and permanent ones reported
+
+CREATE TABLE IF NOT EXISTS dead_letters (
+    request_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    failure TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    error_type TEXT,
+    error_message TEXT,
+    timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (request_id, stage),
+    FOREIGN KEY (request_id) REFERENCES requests(request_id)
+);
+
+-- The pending prompts query tells failed requests apart from the index alone
+CREATE INDEX IF NOT EXISTS idx_requests_model_prompt_id_error
+ON requests(model, prompt_id, error);
+DROP INDEX IF EXISTS idx_requests_model_prompt_id;
@@ -0,0 +1,9 @@
+-- Content hashes of what each prompt, embedding, and pipeline stage was made
+-- from, so that pipeline.py can tell when they are stale
+
+CREATE TABLE IF NOT EXISTS fingerprints (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY (kind, key)
+);
@@ -0,0 +1,219 @@
+-- Counts, sums, and sums of squares of the ratings at the finest grain the
+-- analyses group by, kept current by triggers as ratings are written, so that
+-- grouped means and variances need not scan the joined tables
+
+-- The group of every request, with the demographics of its persona or, for
+-- the interview-based experiments, of its interview
+CREATE VIEW IF NOT EXISTS request_groups AS
+SELECT
+    requests.request_id,
+    requests.model,
+    prompts.experiment_type,
+    COALESCE(personas.race, interviews.race) AS race,
+    COALESCE(personas.gender, interviews.gender) AS gender,
+    prompts.interview_id
+FROM requests
+JOIN prompts ON requests.prompt_id = prompts.prompt_id
+JOIN interviews ON prompts.interview_id = interviews.interview_id
+LEFT JOIN personas ON prompts.persona_id = personas.persona_id;
+
+-- n counts the ratings without errors; n_<measure> those with the measure
+CREATE TABLE IF NOT EXISTS ratings_cube (
+    model TEXT NOT NULL,
+    experiment_type TEXT NOT NULL,
+    race TEXT NOT NULL,
+    gender TEXT NOT NULL,
+    interview_id INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    n_hire INTEGER NOT NULL,
+    sum_hire INTEGER NOT NULL,
+    sumsq_hire INTEGER NOT NULL,
+    n_experience INTEGER NOT NULL,
+    sum_experience INTEGER NOT NULL,
+    sumsq_experience INTEGER NOT NULL,
+    n_fit INTEGER NOT NULL,
+    sum_fit INTEGER NOT NULL,
+    sumsq_fit INTEGER NOT NULL,
+    n_professionalism INTEGER NOT NULL,
+    sum_professionalism INTEGER NOT NULL,
+    sumsq_professionalism INTEGER NOT NULL,
+    PRIMARY KEY (model, experiment_type, race, gender, interview_id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS ratings_cube_insert
+AFTER INSERT ON ratings
+WHEN NEW.error = 0
+BEGIN
+    INSERT INTO ratings_cube
+    SELECT
+        model,
+        experiment_type,
+        race,
+        gender,
+        interview_id,
+        1,
+        NEW.hire IS NOT NULL,
+        COALESCE(NEW.hire, 0),
+        COALESCE(NEW.hire * NEW.hire, 0),
+        NEW.experience IS NOT NULL,
+        COALESCE(NEW.experience, 0),
+        COALESCE(NEW.experience * NEW.experience, 0),
+        NEW.fit IS NOT NULL,
+        COALESCE(NEW.fit, 0),
+        COALESCE(NEW.fit * NEW.fit, 0),
+        NEW.professionalism IS NOT NULL,
+        COALESCE(NEW.professionalism, 0),
+        COALESCE(NEW.professionalism * NEW.professionalism, 0)
+    FROM request_groups
+    WHERE request_id = NEW.request_id
+    ON CONFLICT (model, experiment_type, race, gender, interview_id)
+    DO UPDATE SET
+        n = n + 1,
+        n_hire = n_hire + excluded.n_hire,
+        sum_hire = sum_hire + excluded.sum_hire,
+        sumsq_hire = sumsq_hire + excluded.sumsq_hire,
+        n_experience = n_experience + excluded.n_experience,
+        sum_experience = sum_experience + excluded.sum_experience,
+        sumsq_experience = sumsq_experience + excluded.sumsq_experience,
+        n_fit = n_fit + excluded.n_fit,
+        sum_fit = sum_fit + excluded.sum_fit,
+        sumsq_fit = sumsq_fit + excluded.sumsq_fit,
+        n_professionalism = n_professionalism + excluded.n_professionalism,
+        sum_professionalism = sum_professionalism + excluded.sum_professionalism,
+        sumsq_professionalism = sumsq_professionalism + excluded.sumsq_professionalism;
+END;
+
+CREATE TRIGGER IF NOT EXISTS ratings_cube_delete
+AFTER DELETE ON ratings
+WHEN OLD.error = 0
+BEGIN
+    UPDATE ratings_cube SET
+        n = n - 1,
+        n_hire = n_hire - (OLD.hire IS NOT NULL),
+        sum_hire = sum_hire - COALESCE(OLD.hire, 0),
+        sumsq_hire = sumsq_hire - COALESCE(OLD.hire * OLD.hire, 0),
+        n_experience = n_experience - (OLD.experience IS NOT NULL),
+        sum_experience = sum_experience - COALESCE(OLD.experience, 0),
+        sumsq_experience = sumsq_experience
+            - COALESCE(OLD.experience * OLD.experience, 0),
+        n_fit = n_fit - (OLD.fit IS NOT NULL),
+        sum_fit = sum_fit - COALESCE(OLD.fit, 0),
+        sumsq_fit = sumsq_fit - COALESCE(OLD.fit * OLD.fit, 0),
+        n_professionalism = n_professionalism - (OLD.professionalism IS NOT NULL),
+        sum_professionalism = sum_professionalism - COALESCE(OLD.professionalism, 0),
+        sumsq_professionalism = sumsq_professionalism
+            - COALESCE(OLD.professionalism * OLD.professionalism, 0)
+    WHERE (model, experiment_type, race, gender, interview_id) = (
+        SELECT model, experiment_type, race, gender, interview_id
+        FROM request_groups
+        WHERE request_id = OLD.request_id
+    );
+    DELETE FROM ratings_cube
+    WHERE n = 0
+    AND (model, experiment_type, race, gender, interview_id) = (
+        SELECT model, experiment_type, race, gender, interview_id
+        FROM request_groups
+        WHERE request_id = OLD.request_id
+    );
+END;
+
+-- An update is the deletion of the old rating and the insertion of the new
+CREATE TRIGGER IF NOT EXISTS ratings_cube_update
+AFTER UPDATE OF request_id, hire, experience, fit, professionalism, error
+ON ratings
+BEGIN
+    UPDATE ratings_cube SET
+        n = n - 1,
+        n_hire = n_hire - (OLD.hire IS NOT NULL),
+        sum_hire = sum_hire - COALESCE(OLD.hire, 0),
+        sumsq_hire = sumsq_hire - COALESCE(OLD.hire * OLD.hire, 0),
+        n_experience = n_experience - (OLD.experience IS NOT NULL),
+        sum_experience = sum_experience - COALESCE(OLD.experience, 0),
+        sumsq_experience = sumsq_experience
+            - COALESCE(OLD.experience * OLD.experience, 0),
+        n_fit = n_fit - (OLD.fit IS NOT NULL),
+        sum_fit = sum_fit - COALESCE(OLD.fit, 0),
+        sumsq_fit = sumsq_fit - COALESCE(OLD.fit * OLD.fit, 0),
+        n_professionalism = n_professionalism - (OLD.professionalism IS NOT NULL),
+        sum_professionalism = sum_professionalism - COALESCE(OLD.professionalism, 0),
+        sumsq_professionalism = sumsq_professionalism
+            - COALESCE(OLD.professionalism * OLD.professionalism, 0)
+    WHERE OLD.error = 0
+    AND (model, experiment_type, race, gender, interview_id) = (
+        SELECT model, experiment_type, race, gender, interview_id
+        FROM request_groups
+        WHERE request_id = OLD.request_id
+    );
+    DELETE FROM ratings_cube
+    WHERE n = 0
+    AND (model, experiment_type, race, gender, interview_id) = (
+        SELECT model, experiment_type, race, gender, interview_id
+        FROM request_groups
+        WHERE request_id = OLD.request_id
+    );
+    INSERT INTO ratings_cube
+    SELECT
+        model,
+        experiment_type,
+        race,
+        gender,
+        interview_id,
+        1,
+        NEW.hire IS NOT NULL,
+        COALESCE(NEW.hire, 0),
+        COALESCE(NEW.hire * NEW.hire, 0),
+        NEW.experience IS NOT NULL,
+        COALESCE(NEW.experience, 0),
+        COALESCE(NEW.experience * NEW.experience, 0),
+        NEW.fit IS NOT NULL,
+        COALESCE(NEW.fit, 0),
+        COALESCE(NEW.fit * NEW.fit, 0),
+        NEW.professionalism IS NOT NULL,
+        COALESCE(NEW.professionalism, 0),
+        COALESCE(NEW.professionalism * NEW.professionalism, 0)
+    FROM request_groups
+    WHERE request_id = NEW.request_id
+    AND NEW.error = 0
+    ON CONFLICT (model, experiment_type, race, gender, interview_id)
+    DO UPDATE SET
+        n = n + 1,
+        n_hire = n_hire + excluded.n_hire,
+        sum_hire = sum_hire + excluded.sum_hire,
+        sumsq_hire = sumsq_hire + excluded.sumsq_hire,
+        n_experience = n_experience + excluded.n_experience,
+        sum_experience = sum_experience + excluded.sum_experience,
+        sumsq_experience = sumsq_experience + excluded.sumsq_experience,
+        n_fit = n_fit + excluded.n_fit,
+        sum_fit = sum_fit + excluded.sum_fit,
+        sumsq_fit = sumsq_fit + excluded.sumsq_fit,
+        n_professionalism = n_professionalism + excluded.n_professionalism,
+        sum_professionalism = sum_professionalism + excluded.sum_professionalism,
+        sumsq_professionalism = sumsq_professionalism + excluded.sumsq_professionalism;
+END;
+
+-- Backfill the ratings written before the cube
+INSERT INTO ratings_cube
+SELECT
+    request_groups.model,
+    request_groups.experiment_type,
+    request_groups.race,
+    request_groups.gender,
+    request_groups.interview_id,
+    COUNT(*),
+    COUNT(ratings.hire),
+    COALESCE(SUM(ratings.hire), 0),
+    COALESCE(SUM(ratings.hire * ratings.hire), 0),
+    COUNT(ratings.experience),
+    COALESCE(SUM(ratings.experience), 0),
+    COALESCE(SUM(ratings.experience * ratings.experience), 0),
+    COUNT(ratings.fit),
+    COALESCE(SUM(ratings.fit), 0),
+    COALESCE(SUM(ratings.fit * ratings.fit), 0),
+    COUNT(ratings.professionalism),
+    COALESCE(SUM(ratings.professionalism), 0),
+    COALESCE(SUM(ratings.professionalism * ratings.professionalism), 0)
+FROM ratings
+JOIN request_groups ON ratings.request_id = request_groups.request_id
+WHERE ratings.error = 0
+GROUP BY 1, 2, 3, 4, 5
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Pack the resume and question corpora into indexed, memory-mapped archives."""
+import argparse
+import glob
+import json
+import os
+
+import _corpus
+
+################################################################################
+
+
+def pack(directory: str) -> int:
+    """Pack every document in the directory, returning the number packed."""
+    index = {}
+    offset = 0
+    with open(directory + ".pack.tmp", "wb") as out:
+        # Keep glob's order, which the prompts were generated in
+        for path in glob.glob(os.path.join(directory, "*.txt")):
+            stem = os.path.basename(path)[: -len(".txt")]
+            interview_id = stem.split("_", 1)[0]
+            with open(path, "r") as f:
+                data = f.read().encode()
+            out.write(data)
+            index.setdefault(interview_id, []).append(
+                [_corpus.name(path), offset, len(data)]
+            )
+            offset += len(data)
+
+    with open(directory + ".index.json.tmp", "w") as f:
+        json.dump(index, f)
+
+    # Swap in the new archive only once it is complete
+    os.replace(directory + ".pack.tmp", directory + ".pack")
+    os.replace(directory + ".index.json.tmp", directory + ".index.json")
+    return sum(len(documents) for documents in index.values())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "directories",
+        type=str,
+        nargs="*",
+        default=_corpus.CORPORA,
+        help="Corpus directories to pack (by default, every one that exists)",
+    )
+    args = parser.parse_args()
+
+    for directory in args.directories:
+        directory = directory.rstrip(os.sep)
+        if not os.path.isdir(directory):
+            continue
+        print(f"Packed {pack(directory)} documents from {directory}.")
+
+
+if __name__ == "__main__":
+    main()
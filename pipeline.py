@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+"""Run the pipeline as a DAG, redoing only the work whose inputs have changed."""
+import argparse
+import asyncio
+import contextlib
+import os
+import sqlite3
+import sys
+from typing import Callable, NamedTuple
+
+import _compress
+import _corpus
+import _embeddings
+import _fingerprints
+import _shards
+import migrate
+import prompts
+from chat import MODELS
+
+SHARDS = os.path.join("shards", "pipeline")
+
+TEMPLATES = [os.path.join("prompts", "*.txt"), os.path.join("system_messages", "*.txt")]
+CORPUS = [os.path.join(directory, "*.txt") for directory in _corpus.CORPORA]
+
+INTERVIEWS = "SELECT interview_id, in_study FROM interviews ORDER BY interview_id"
+PERSONAS = "SELECT * FROM personas ORDER BY persona_id"
+
+GENERATORS = {
+    **prompts.INTERVIEW_PROMPT_GENERATORS,
+    **prompts.PERSONA_PROMPT_GENERATORS,
+}
+
+################################################################################
+# Inputs
+
+
+def corpus_inputs(conn: sqlite3.Connection) -> str:
+    return _fingerprints.files(*CORPUS)
+
+
+def persona_inputs(conn: sqlite3.Connection) -> str:
+    return _fingerprints.rows(conn, INTERVIEWS)
+
+
+def prompt_inputs(conn: sqlite3.Connection) -> str:
+    return _fingerprints.digest(
+        _fingerprints.files(*TEMPLATES),
+        _fingerprints.files(*CORPUS),
+        _fingerprints.rows(conn, INTERVIEWS),
+        _fingerprints.rows(conn, PERSONAS),
+    )
+
+
+def embedding_inputs(conn: sqlite3.Connection) -> str:
+    return _fingerprints.digest(
+        _embeddings.MODEL,
+        _fingerprints.files(*CORPUS),
+        _fingerprints.rows(conn, INTERVIEWS),
+    )
+
+
+################################################################################
+# Invalidation
+
+
+def stale_prompts(conn: sqlite3.Connection) -> list[int]:
+    """Regenerate every prompt and return those whose text would change.
+
+    Prompts generated before fingerprints were recorded are fingerprinted from
+    their stored text, or, in the public data, which omits it, from the text
+    they would have now.
+    """
+    _compress.register(conn)
+    stored = _fingerprints.load(conn, "prompt")
+    has_text = "prompt" in _shards.columns(conn, "main", "prompts")
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    personas = {row["persona_id"]: dict(row) for row in cursor.execute(PERSONAS)}
+    rows = cursor.execute(
+        f"""
+        SELECT
+            prompt_id,
+            interview_id,
+            persona_id,
+            experiment_type
+            {", decompress(system_message), decompress(prompt)" if has_text else ""}
+        FROM prompts
+        """
+    ).fetchall()
+
+    stale, adopted = [], {}
+    for row in rows:
+        generator = GENERATORS.get(row["experiment_type"])
+        if generator is None:
+            continue
+        if row["persona_id"] is None:
+            current = _fingerprints.digest(*generator(row["interview_id"]))
+        elif row["persona_id"] in personas:
+            current = _fingerprints.digest(*generator(personas[row["persona_id"]]))
+        else:
+            # The persona was removed
+            current = None
+        previous = stored.get(str(row["prompt_id"]))
+        if previous is None:
+            previous = _fingerprints.digest(row[4], row[5]) if has_text else current
+            adopted[row["prompt_id"]] = previous
+        if previous != current:
+            stale.append(row["prompt_id"])
+    _fingerprints.store(conn, "prompt", adopted)
+    return stale
+
+
+def delete_prompts(conn: sqlite3.Connection, prompt_ids: list[int]) -> None:
+    """Delete the prompts with their requests, results, and token counts."""
+    conn.execute("CREATE TEMP TABLE stale_prompts (prompt_id INTEGER PRIMARY KEY)")
+    conn.executemany(
+        "INSERT INTO temp.stale_prompts VALUES (?)", [(id,) for id in prompt_ids]
+    )
+    for table in _shards.RESULT_TABLES[::-1]:
+        conn.execute(
+            f"""
+            DELETE FROM {table} WHERE request_id IN (
+                SELECT request_id FROM requests
+                WHERE prompt_id IN (SELECT prompt_id FROM temp.stale_prompts)
+            )
+            """
+        )
+    conn.execute(
+        """
+        DELETE FROM prompt_tokens
+        WHERE prompt_id IN (SELECT prompt_id FROM temp.stale_prompts)
+        """
+    )
+    conn.execute(
+        """
+        DELETE FROM fingerprints
+        WHERE kind = 'prompt'
+        AND key IN (SELECT CAST(prompt_id AS TEXT) FROM temp.stale_prompts)
+        """
+    )
+    conn.execute(
+        "DELETE FROM prompts WHERE prompt_id IN (SELECT prompt_id FROM temp.stale_prompts)"
+    )
+    conn.execute("DROP TABLE temp.stale_prompts")
+
+
+def stale_embeddings(conn: sqlite3.Connection) -> list[str]:
+    """Return the keys of the embeddings whose documents have changed."""
+    stored = _fingerprints.load(conn, "embedding")
+    stale, adopted = [], {}
+    for interview_id, redacted, resume in conn.execute(
+        "SELECT interview_id, redacted, resume FROM embedding_vectors"
+    ):
+        key = f"{interview_id}:{int(redacted)}:{int(resume)}"
+        current = _fingerprints.digest(
+            _embeddings.MODEL,
+            _embeddings.document(interview_id, bool(redacted), bool(resume)),
+        )
+        if key not in stored:
+            adopted[key] = current
+        elif stored[key] != current:
+            stale.append(key)
+    _fingerprints.store(conn, "embedding", adopted)
+    return stale
+
+
+def invalidate(delete: bool = False, dry_run: bool = False) -> bool:
+    """Report the prompts and embeddings made from inputs that have changed.
+
+    They are deleted, with every response to them, only if delete is set.
+    Otherwise, if any are stale, return False, so that no more work is done on
+    top of them.
+    """
+    # Read the corpus as it was packed by this run
+    _corpus.archive.cache_clear()
+    with sqlite3.connect("data.db") as conn:
+        prompt_ids = stale_prompts(conn)
+        keys = stale_embeddings(conn)
+        print(
+            f"{len(prompt_ids)} prompts and {len(keys)} embeddings are stale"
+            f"{' (dry run)' if dry_run else ''}."
+        )
+        if dry_run:
+            conn.rollback()
+            return True
+        if not delete and (prompt_ids or keys):
+            conn.rollback()
+            print(
+                "Their responses and embeddings are kept. Check why their inputs "
+                "changed, then re-run with --delete-stale to delete and redo them."
+            )
+            return False
+        delete_prompts(conn, prompt_ids)
+        conn.executemany(
+            """
+            DELETE FROM embedding_vectors
+            WHERE interview_id = ? AND redacted = ? AND resume = ?
+            """,
+            [tuple(map(int, key.split(":"))) for key in keys],
+        )
+        conn.executemany(
+            "DELETE FROM fingerprints WHERE kind = 'embedding' AND key = ?",
+            [(key,) for key in keys],
+        )
+    return True
+
+
+################################################################################
+# Stages
+
+
+class Stage(NamedTuple):
+    name: str
+    # A command, or a function that returns whether it succeeded
+    run: list[str] | Callable[[], bool]
+    after: list[str] = []
+    # Fingerprints the stage's inputs; stages without one always run
+    inputs: Callable[[sqlite3.Connection], str] | None = None
+    # Whether the stage writes to data.db, so must not overlap other writers
+    writes: bool = True
+
+
+def stages(models: list[str], experiments: list[str], args) -> list[Stage]:
+    """Build the DAG of stages for the given models and experiments."""
+    chat = [
+        Stage(
+            f"chat:{model}:{experiment}",
+            [
+                "chat.py",
+                "--db",
+                os.path.join(SHARDS, f"{model}-{experiment}.db"),
+                "--n_max",
+                str(args.n_max),
+                model,
+                experiment,
+            ],
+            ["prompts"],
+            writes=False,
+        )
+        for model in models
+        for experiment in experiments
+    ]
+    return [
+        Stage("pack", ["pack.py"], inputs=corpus_inputs, writes=False),
+        Stage("personas", ["personas.py"], inputs=persona_inputs),
+        Stage(
+            "invalidate",
+            lambda: invalidate(args.delete_stale, args.dry_run),
+            ["pack", "personas"],
+            inputs=prompt_inputs,
+        ),
+        Stage("prompts", ["prompts.py"], ["invalidate"], inputs=prompt_inputs),
+        *chat,
+        Stage(
+            "merge",
+            [
+                "merge.py",
+                "--delete",
+                *(
+                    os.path.join(SHARDS, f"{m}-{e}.db")
+                    for m in models
+                    for e in experiments
+                ),
+            ],
+            [stage.name for stage in chat],
+        ),
+        Stage(
+            "extract:ratings",
+            ["extract.py", "--n_max", str(args.n_max), "ratings"],
+            ["merge"],
+        ),
+        Stage(
+            "extract:checks",
+            ["extract.py", "--n_max", str(args.n_max), "checks"],
+            ["merge"],
+        ),
+        Stage("embed", ["embed.py", "fetch"], ["invalidate"], inputs=embedding_inputs),
+    ]
+
+
+def fingerprint(stage: Stage) -> tuple[str, str | None]:
+    """Return the fingerprint of a stage's inputs and the one it last ran with."""
+    with sqlite3.connect("data.db") as conn:
+        return (
+            stage.inputs(conn),
+            _fingerprints.load(conn, "stage").get(stage.name),
+        )
+
+
+async def execute(stage: Stage, lock: asyncio.Lock, dry_run: bool) -> bool:
+    """Run a stage unless its inputs are unchanged, returning whether it succeeded."""
+    inputs = None
+    if stage.inputs is not None:
+        inputs, previous = await asyncio.to_thread(fingerprint, stage)
+        if inputs == previous:
+            print(f"Skipping {stage.name}: its inputs are unchanged.")
+            return True
+
+    async with lock if stage.writes else contextlib.nullcontext():
+        print(f"Running {stage.name}{' (dry run)' if dry_run else ''}.")
+        if callable(stage.run):
+            if not await asyncio.to_thread(stage.run):
+                print(f"{stage.name} failed.")
+                return False
+        elif not dry_run:
+            process = await asyncio.create_subprocess_exec(sys.executable, *stage.run)
+            if await process.wait() != 0:
+                print(f"{stage.name} failed with exit code {process.returncode}.")
+                return False
+
+    if inputs is not None and not dry_run:
+        with sqlite3.connect("data.db") as conn:
+            _fingerprints.store(conn, "stage", {stage.name: inputs})
+    return True
+
+
+async def run(stages: list[Stage], jobs: int, dry_run: bool) -> list[str]:
+    """Run every stage once the stages it comes after succeed, returning failures."""
+    pending = {stage.name: stage for stage in stages}
+    done, failed = set(), []
+    running = {}
+    lock = asyncio.Lock()
+    while pending or running:
+        for name, stage in list(pending.items()):
+            if any(dependency in failed for dependency in stage.after):
+                print(f"Skipping {name}: a stage it comes after failed.")
+                del pending[name]
+                failed.append(name)
+            elif all(dependency in done for dependency in stage.after):
+                if len(running) < jobs:
+                    pending.pop(name)
+                    task = asyncio.create_task(execute(stage, lock, dry_run))
+                    running[task] = name
+        if not running:
+            break
+        finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in finished:
+            name = running.pop(task)
+            if task.result():
+                done.add(name)
+            else:
+                failed.append(name)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--models",
+        type=str,
+        nargs="+",
+        required=True,
+        choices=[model["short-name"] for model in MODELS],
+    )
+    parser.add_argument(
+        "--experiments",
+        type=str,
+        nargs="+",
+        default=list(GENERATORS),
+        choices=list(GENERATORS),
+    )
+    parser.add_argument("--n_max", type=int, default=100)
+    parser.add_argument(
+        "--jobs", type=int, default=4, help="Stages to run at the same time"
+    )
+    parser.add_argument(
+        "--delete-stale",
+        action="store_true",
+        help="Delete stale prompts and embeddings, with their responses, and redo them",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Report the stale work and the stages to run without changing anything",
+    )
+    args = parser.parse_args()
+
+    if args.dry_run:
+        with sqlite3.connect("data.db") as conn:
+            if not _shards.columns(conn, "main", "fingerprints"):
+                raise SystemExit("data.db has no fingerprints table; run migrate.py")
+    else:
+        migrate.migrate("data.db")
+        os.makedirs(SHARDS, exist_ok=True)
+    failed = asyncio.run(
+        run(stages(args.models, args.experiments, args), args.jobs, args.dry_run)
+    )
+    if failed:
+        print(f"Failed: {', '.join(failed)}.", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
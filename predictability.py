@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""Measure how predictable race and gender are from application embeddings."""
+import argparse
+import csv
+import sqlite3
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import numpy as np
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import accuracy_score, roc_auc_score
+from sklearn.model_selection import GroupKFold
+from sklearn.pipeline import Pipeline, make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+import _embeddings
+
+COMBINATIONS = list(product([True, False], [True, False]))
+
+TARGETS = ["race", "gender"]
+
+################################################################################
+# Data
+
+
+def load_embeddings(conn: sqlite3.Connection, dimensions: int | None = None) -> dict:
+    """Load the embedding matrix of each (redacted, resume) combination.
+
+    By default the embeddings table is used as is. Given dimensions, the stored
+    full-size embeddings are truncated to that size instead.
+    """
+    if dimensions is not None:
+        return load_vectors(conn, dimensions)
+
+    columns = [
+        row[1]
+        for row in conn.execute("PRAGMA table_info(embeddings)")
+        if row[1].startswith("X_")
+    ]
+    rows = conn.execute(
+        f"""
+        SELECT
+            embeddings.interview_id,
+            embeddings.redacted,
+            embeddings.resume,
+            interviews.race,
+            interviews.gender,
+            {",".join(f"embeddings.{column}" for column in columns)}
+        FROM embeddings
+        JOIN interviews ON embeddings.interview_id = interviews.interview_id
+        WHERE interviews.in_study
+        ORDER BY embeddings.interview_id
+        """
+    ).fetchall()
+
+    data = {}
+    for redacted, resume in COMBINATIONS:
+        subset = [
+            row for row in rows if (bool(row[1]), bool(row[2])) == (redacted, resume)
+        ]
+        data[(redacted, resume)] = {
+            "interview_id": np.array([row[0] for row in subset], dtype=np.int64),
+            "race": np.array([row[3] for row in subset], dtype=object),
+            "gender": np.array([row[4] for row in subset], dtype=object),
+            "X": np.array([row[5:] for row in subset], dtype=np.float64),
+        }
+    return data
+
+
+def load_vectors(conn: sqlite3.Connection, dimensions: int) -> dict:
+    """Load the stored full-size embeddings, truncated to the given size."""
+    vectors = _embeddings.load(conn, dimensions)
+    demographics = dict(
+        (row[0], row[1:])
+        for row in conn.execute(
+            "SELECT interview_id, race, gender FROM interviews WHERE in_study"
+        )
+    )
+    in_study = np.array([i in demographics for i in vectors["interview_id"]])
+
+    data = {}
+    for redacted, resume in COMBINATIONS:
+        mask = (
+            in_study & (vectors["redacted"] == redacted) & (vectors["resume"] == resume)
+        )
+        interview_ids = vectors["interview_id"][mask]
+        data[(redacted, resume)] = {
+            "interview_id": interview_ids,
+            "race": np.array([demographics[i][0] for i in interview_ids], dtype=object),
+            "gender": np.array(
+                [demographics[i][1] for i in interview_ids], dtype=object
+            ),
+            "X": vectors["X"][mask],
+        }
+    return data
+
+
+def outcome(data: dict, target: str, multinomial: bool) -> np.ndarray:
+    """Encode the target, as White vs. minority and female vs. male by default."""
+    if target == "gender":
+        return (data["gender"] == "male").astype(np.int64)
+    if multinomial:
+        return np.unique(data["race"], return_inverse=True)[1].reshape(-1)
+    return (data["race"] == "White").astype(np.int64)
+
+
+################################################################################
+# Estimation
+
+
+def score(model: Pipeline, X: np.ndarray, y: np.ndarray) -> tuple:
+    """Return the AUC (one-vs-rest for several classes) and accuracy."""
+    p = model.predict_proba(X)
+    if p.shape[1] == 2:
+        auc = roc_auc_score(y, p[:, 1])
+    else:
+        auc = roc_auc_score(y, p, multi_class="ovr", labels=model.classes_)
+    return auc, accuracy_score(y, model.predict(X))
+
+
+def path_scores(
+    X: np.ndarray,
+    y: np.ndarray,
+    groups: np.ndarray,
+    penalties: np.ndarray,
+    l1_ratio: float,
+    folds: int,
+) -> np.ndarray:
+    """Cross-validated AUC (folds x penalties) along a warm-started penalty path."""
+    scores = np.full((folds, len(penalties)), np.nan)
+    for f, (train, test) in enumerate(GroupKFold(n_splits=folds).split(X, y, groups)):
+        # Walk from the strongest penalty to the weakest, starting each fit from
+        # the previous solution. The features are standardized with the training
+        # fold's moments only.
+        model = make_pipeline(
+            StandardScaler(),
+            LogisticRegression(
+                penalty="elasticnet",
+                solver="saga",
+                l1_ratio=l1_ratio,
+                warm_start=True,
+                max_iter=1000,
+            ),
+        )
+        for p, penalty in enumerate(penalties):
+            model.set_params(logisticregression__C=1 / (penalty * len(train)))
+            model.fit(X[train], y[train])
+            scores[f, p] = score(model, X[test], y[test])[0]
+    return scores
+
+
+def analyze(
+    X: np.ndarray,
+    y: np.ndarray,
+    groups: np.ndarray,
+    penalties: np.ndarray,
+    l1_ratios: list[float],
+    folds: int,
+    seed: int,
+) -> dict:
+    """Tune on one half of the interviews and evaluate on the other, as analyze.R does."""
+    warnings.filterwarnings("ignore", category=ConvergenceWarning)
+
+    rng = np.random.default_rng(seed)
+    interviews = rng.permutation(np.unique(groups))
+    train = np.isin(groups, interviews[: len(interviews) // 2])
+    test = ~train
+
+    # Choose the penalty and mixture with the best cross-validated AUC
+    tuning = {
+        l1_ratio: path_scores(
+            X[train], y[train], groups[train], penalties, l1_ratio, folds
+        ).mean(axis=0)
+        for l1_ratio in l1_ratios
+    }
+    l1_ratio, p = max(
+        ((l1_ratio, p) for l1_ratio in l1_ratios for p in range(len(penalties))),
+        key=lambda choice: tuning[choice[0]][choice[1]],
+    )
+    penalty = penalties[p]
+
+    # Evaluate the tuned model with cross-validation on the held-out half
+    X, y, groups = X[test], y[test], groups[test]
+    aucs, accuracies = [], []
+    for fold_train, fold_test in GroupKFold(n_splits=folds).split(X, y, groups):
+        model = make_pipeline(
+            StandardScaler(),
+            LogisticRegression(
+                penalty="elasticnet",
+                solver="saga",
+                l1_ratio=l1_ratio,
+                C=1 / (penalty * len(fold_train)),
+                max_iter=1000,
+            ),
+        )
+        model.fit(X[fold_train], y[fold_train])
+        auc, accuracy = score(model, X[fold_test], y[fold_test])
+        aucs.append(auc)
+        accuracies.append(accuracy)
+
+    auc_se = np.std(aucs, ddof=1) / np.sqrt(folds)
+    accuracy_se = np.std(accuracies, ddof=1) / np.sqrt(folds)
+    return {
+        "auc": np.mean(aucs),
+        "auc_std_err": auc_se,
+        "auc_lwr": np.mean(aucs) - 1.96 * auc_se,
+        "auc_upr": np.mean(aucs) + 1.96 * auc_se,
+        "accuracy": np.mean(accuracies),
+        "accuracy_std_err": accuracy_se,
+        "accuracy_lwr": np.mean(accuracies) - 1.96 * accuracy_se,
+        "accuracy_upr": np.mean(accuracies) + 1.96 * accuracy_se,
+        "penalty": penalty,
+        "mixture": l1_ratio,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", type=str, default="data.db")
+    parser.add_argument("--out", type=str, default="predictability.csv")
+    parser.add_argument("--folds", type=int, default=10)
+    parser.add_argument("--l1-ratios", type=str, default="0,0.5,1")
+    parser.add_argument("--multinomial", action="store_true")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=7140466)
+    parser.add_argument(
+        "--dimensions",
+        type=int,
+        default=None,
+        help="Truncate the stored full-size embeddings to this size",
+    )
+    args = parser.parse_args()
+
+    # Same penalty range as the glmnet grid in analyze.R, largest first
+    penalties = np.logspace(1, -5, 10)
+    l1_ratios = [float(ratio) for ratio in args.l1_ratios.split(",")]
+
+    with sqlite3.connect(args.db) as conn:
+        data = load_embeddings(conn, args.dimensions)
+
+    # Every combination and target is fit in its own process
+    jobs = list(product(COMBINATIONS, TARGETS))
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [
+            executor.submit(
+                analyze,
+                data[combination]["X"],
+                outcome(data[combination], target, args.multinomial),
+                data[combination]["interview_id"],
+                penalties,
+                l1_ratios,
+                args.folds,
+                args.seed,
+            )
+            for combination, target in jobs
+        ]
+        results = [
+            {
+                "outcome": target,
+                "redacted": redacted,
+                "resume": resume,
+                **future.result(),
+            }
+            for ((redacted, resume), target), future in zip(jobs, futures)
+        ]
+
+    with open(args.out, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,22 @@
 #!/usr/bin/env python
 """Generate prompts for the audit study."""
-import glob
 import os
 import sqlite3
 from typing import Tuple
 
+import _compress
+import _corpus
+import _fingerprints
+import _tokens
+
 ################################################################################
 # Interview-based prompts
 
 
 def generate_redacted(interview_id: int) -> Tuple[str, str]:
     """Generate basic prompt for real redacted materials."""
-    with open(os.path.join("resumes", "redacted", f"{interview_id}.txt"), "r") as f:
-        resume = f.read()
-
-    questions = []
-    for question in glob.glob(
-        os.path.join("questions", "redacted", f"{interview_id}_*.txt")
-    ):
-        with open(question, "r") as f:
-            questions.append(f.read())
+    resume = _corpus.resume("redacted", interview_id)
+    questions = _corpus.questions("redacted", interview_id)
 
     # Get the system message
     with open(os.path.join("system_messages", "base.txt"), "r") as f:
@@ -37,15 +34,8 @@ def generate_redacted(interview_id: int) -> Tuple[str, str]:
 
 def generate_unredacted(interview_id: int) -> Tuple[str, str]:
     """Generate basic prompt for real unredacted materials."""
-    with open(os.path.join("resumes", "raw", f"{interview_id}.txt"), "r") as f:
-        resume = f.read()
-
-    questions = []
-    for question in glob.glob(
-        os.path.join("questions", "unredacted", f"{interview_id}_*.txt")
-    ):
-        with open(question, "r") as f:
-            questions.append(f.read())
+    resume = _corpus.resume("raw", interview_id)
+    questions = _corpus.questions("unredacted", interview_id)
 
     # Get the system message
     with open(os.path.join("system_messages", "base.txt"), "r") as f:
@@ -74,17 +64,8 @@ INTERVIEW_PROMPT_GENERATORS = {
 def generate_base(persona: dict) -> Tuple[str, str]:
     """Generate basic prompt."""
     # Get the resume and questions
-    with open(
-        os.path.join("resumes", "redacted", f"{persona['interview_id']}.txt"), "r"
-    ) as f:
-        resume = f.read()
-
-    questions = []
-    for question in glob.glob(
-        os.path.join("questions", "redacted", f"{persona['interview_id']}_*.txt")
-    ):
-        with open(question, "r") as f:
-            questions.append(f.read())
+    resume = _corpus.resume("redacted", persona["interview_id"])
+    questions = _corpus.questions("redacted", persona["interview_id"])
 
     # Get the system message
     with open(os.path.join("system_messages", "base.txt"), "r") as f:
@@ -108,17 +89,8 @@ def generate_base(persona: dict) -> Tuple[str, str]:
 def generate_no_scratch(persona: dict) -> Tuple[str, str]:
     """Generate prompt with no scratchpad."""
     # Get the resume and questions
-    with open(
-        os.path.join("resumes", "redacted", f"{persona['interview_id']}.txt"), "r"
-    ) as f:
-        resume = f.read()
-
-    questions = []
-    for question in glob.glob(
-        os.path.join("questions", "redacted", f"{persona['interview_id']}_*.txt")
-    ):
-        with open(question, "r") as f:
-            questions.append(f.read())
+    resume = _corpus.resume("redacted", persona["interview_id"])
+    questions = _corpus.questions("redacted", persona["interview_id"])
 
     # Get the system message
     with open(os.path.join("system_messages", "no_scratch.txt"), "r") as f:
@@ -142,10 +114,7 @@ def generate_no_scratch(persona: dict) -> Tuple[str, str]:
 def generate_no_trascripts(persona: dict) -> Tuple[str, str]:
     """Generate a prompt without transcripts."""
     # Get the resume
-    with open(
-        os.path.join("resumes", "redacted", f"{persona['interview_id']}.txt"), "r"
-    ) as f:
-        resume = f.read()
+    resume = _corpus.resume("redacted", persona["interview_id"])
 
     # Get the system message
     with open(os.path.join("system_messages", "base.txt"), "r") as f:
@@ -170,17 +139,8 @@ def generate_other_district(persona: dict) -> Tuple[str, str]:
     }
 
     # Get the resume and questions
-    with open(
-        os.path.join("resumes", "redacted", f"{persona['interview_id']}.txt"), "r"
-    ) as f:
-        resume = f.read()
-
-    questions = []
-    for question in glob.glob(
-        os.path.join("questions", "modified", f"{persona['interview_id']}_*.txt")
-    ):
-        with open(question, "r") as f:
-            questions.append(f.read())
+    resume = _corpus.resume("redacted", persona["interview_id"])
+    questions = _corpus.questions("modified", persona["interview_id"])
 
     # Get the system message
     with open(os.path.join("system_messages", "base.txt"), "r") as f:
@@ -204,17 +164,8 @@ def generate_other_district(persona: dict) -> Tuple[str, str]:
 def generate_eeoc_guidance(persona: dict) -> Tuple[str, str]:
     """Generate prompt with EEOC guidance."""
     # Get the resume and questions
-    with open(
-        os.path.join("resumes", "redacted", f"{persona['interview_id']}.txt"), "r"
-    ) as f:
-        resume = f.read()
-
-    questions = []
-    for question in glob.glob(
-        os.path.join("questions", "redacted", f"{persona['interview_id']}_*.txt")
-    ):
-        with open(question, "r") as f:
-            questions.append(f.read())
+    resume = _corpus.resume("redacted", persona["interview_id"])
+    questions = _corpus.questions("redacted", persona["interview_id"])
 
     # Get the system message
     with open(os.path.join("system_messages", "base.txt"), "r") as f:
@@ -238,17 +189,8 @@ def generate_eeoc_guidance(persona: dict) -> Tuple[str, str]:
 def generate_manipulation_check(persona: dict) -> Tuple[str, str]:
     """Generate prompt with manipulation check."""
     # Get the resume and questions
-    with open(
-        os.path.join("resumes", "redacted", f"{persona['interview_id']}.txt"), "r"
-    ) as f:
-        resume = f.read()
-
-    questions = []
-    for question in glob.glob(
-        os.path.join("questions", "redacted", f"{persona['interview_id']}_*.txt")
-    ):
-        with open(question, "r") as f:
-            questions.append(f.read())
+    resume = _corpus.resume("redacted", persona["interview_id"])
+    questions = _corpus.questions("redacted", persona["interview_id"])
 
     # Get the system message
     with open(os.path.join("system_messages", "manipulation_check.txt"), "r") as f:
@@ -274,17 +216,8 @@ def generate_variants(variant: int) -> callable:
 
     def generate_variant(persona: dict) -> Tuple[str, str]:
         # Get the resume and questions
-        with open(
-            os.path.join("resumes", "redacted", f"{persona['interview_id']}.txt"), "r"
-        ) as f:
-            resume = f.read()
-
-        questions = []
-        for question in glob.glob(
-            os.path.join("questions", "redacted", f"{persona['interview_id']}_*.txt")
-        ):
-            with open(question, "r") as f:
-                questions.append(f.read())
+        resume = _corpus.resume("redacted", persona["interview_id"])
+        questions = _corpus.questions("redacted", persona["interview_id"])
 
         # Get the system message
         with open(os.path.join("system_messages", f"variant_{variant}.txt"), "r") as f:
@@ -318,11 +251,68 @@ PERSONA_PROMPT_GENERATORS = {
 }
 
 
+################################################################################
+# Token counts
+
+
+def count_prompt_tokens(conn: sqlite3.Connection, batch_size: int = 1000) -> None:
+    """Store the token count of every uncounted prompt for each model family."""
+    cur = conn.cursor()
+    for family in _tokens.FAMILIES:
+        while True:
+            cur.execute(
+                """
+                SELECT
+                    prompts.prompt_id,
+                    decompress(prompts.system_message) AS system_message,
+                    decompress(prompts.prompt) AS prompt
+                FROM prompts
+                LEFT JOIN prompt_tokens
+                ON prompts.prompt_id = prompt_tokens.prompt_id
+                AND prompt_tokens.family = :family
+                WHERE prompt_tokens.prompt_id IS NULL
+                LIMIT :batch_size
+                """,
+                {"family": family, "batch_size": batch_size},
+            )
+            prompts = cur.fetchall()
+            if not prompts:
+                break
+
+            print(f"Counting {family} tokens for {len(prompts)} prompts.")
+            system_counts = _tokens.count_batch(
+                family, [prompt["system_message"] for prompt in prompts]
+            )
+            prompt_counts = _tokens.count_batch(
+                family, [prompt["prompt"] for prompt in prompts]
+            )
+            cur.executemany(
+                """
+                INSERT INTO prompt_tokens (prompt_id, family, n_tokens)
+                VALUES (:prompt_id, :family, :n_tokens)
+                """,
+                [
+                    {
+                        "prompt_id": prompt["prompt_id"],
+                        "family": family,
+                        "n_tokens": n_system + n_prompt,
+                    }
+                    for prompt, n_system, n_prompt in zip(
+                        prompts, system_counts, prompt_counts
+                    )
+                ],
+            )
+            conn.commit()
+
+
 if __name__ == "__main__":
     with sqlite3.connect("data.db") as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.cursor()
 
+        # Store the prompts compressed once compress.py has trained dictionaries
+        codec = _compress.register(conn)
+
         # For each experiment type, get the interview ids with no corresponding prompts
         for experiment_type, generator in INTERVIEW_PROMPT_GENERATORS.items():
             cur.execute(
@@ -355,11 +345,18 @@ if __name__ == "__main__":
                     """,
                     {
                         "interview_id": interview_id[0],
-                        "system_message": system_message,
-                        "prompt": prompt,
+                        "system_message": codec.compress(
+                            "prompts.system_message", system_message
+                        ),
+                        "prompt": codec.compress("prompts.prompt", prompt),
                         "experiment_type": experiment_type,
                     },
                 )
+                _fingerprints.store(
+                    conn,
+                    "prompt",
+                    {cur.lastrowid: _fingerprints.digest(system_message, prompt)},
+                )
                 conn.commit()
 
         # For each experiment type, get the persona ids with no corresponding prompts
@@ -396,9 +393,20 @@ if __name__ == "__main__":
                     {
                         "interview_id": persona["interview_id"],
                         "persona_id": persona["persona_id"],
-                        "system_message": system_message,
-                        "prompt": prompt,
+                        "system_message": codec.compress(
+                            "prompts.system_message", system_message
+                        ),
+                        "prompt": codec.compress("prompts.prompt", prompt),
                         "experiment_type": experiment_type,
                     },
                 )
+                _fingerprints.store(
+                    conn,
+                    "prompt",
+                    {cur.lastrowid: _fingerprints.digest(system_message, prompt)},
+                )
                 conn.commit()
+
+        # Count the tokens of the new prompts once, so that chat.py can charge the
+        # rate limiters without re-encoding them
+        count_prompt_tokens(conn)
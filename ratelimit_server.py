@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Serve shared rate limit buckets to chat.py, extract.py, and embed.py on any host."""
+import argparse
+import asyncio
+import json
+import logging
+
+import _ratelimiters
+
+################################################################################
+
+
+async def handle(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    ledger: _ratelimiters.Ledger,
+) -> None:
+    """Answer a client's reservations, one JSON object per line, until it leaves."""
+    try:
+        while line := await reader.readline():
+            request = json.loads(line)
+            wait, level = await asyncio.to_thread(
+                ledger.reserve,
+                request["name"],
+                request["amount"],
+                request["max_rate"],
+                request["time_period"],
+            )
+            writer.write(json.dumps({"wait": wait, "level": level}).encode() + b"\n")
+            await writer.drain()
+    except (ConnectionError, ValueError, KeyError) as e:
+        logging.error("Dropping client: %s", e)
+    finally:
+        writer.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--ledger",
+        type=str,
+        default=_ratelimiters.LEDGER,
+        help="SQLite file the bucket levels are kept in across restarts",
+    )
+    args = parser.parse_args()
+
+    ledger = _ratelimiters.Ledger(args.ledger)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle(reader, writer, ledger), args.host, args.port
+    )
+    print(f"Serving rate limits from {args.ledger} on {args.host}:{args.port}.")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
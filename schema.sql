@@ -39,7 +39,16 @@ CREATE TABLE IF NOT EXISTS prompts (
 );
 CREATE INDEX IF NOT EXISTS idx_prompts_interview_id ON prompts(interview_id);
 CREATE INDEX IF NOT EXISTS idx_prompts_persona_id ON prompts(persona_id);
-CREATE INDEX IF NOT EXISTS idx_prompts_experiment_type ON prompts(experiment_type);
+CREATE INDEX IF NOT EXISTS idx_prompts_experiment_type_interview_id
+ON prompts(experiment_type, interview_id);
+
+CREATE TABLE IF NOT EXISTS prompt_tokens (
+    prompt_id INTEGER NOT NULL,
+    family TEXT NOT NULL,
+    n_tokens INTEGER NOT NULL,
+    PRIMARY KEY (prompt_id, family),
+    FOREIGN KEY (prompt_id) REFERENCES prompts(prompt_id)
+);
 
 CREATE TABLE IF NOT EXISTS requests (
     request_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -53,7 +62,8 @@ CREATE TABLE IF NOT EXISTS requests (
     timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (prompt_id) REFERENCES prompts(prompt_id)
 );
-CREATE INDEX IF NOT EXISTS idx_requests_model ON requests(model);
+CREATE INDEX IF NOT EXISTS idx_requests_model_prompt_id_error
+ON requests(model, prompt_id, error);
 CREATE INDEX IF NOT EXISTS idx_requests_prompt_id ON requests(prompt_id);
 
 CREATE TABLE IF NOT EXISTS ratings (
@@ -84,6 +94,74 @@ CREATE TABLE IF NOT EXISTS checks (
 );
 CREATE INDEX IF NOT EXISTS idx_checks_request_id ON checks(request_id);
 
+CREATE TABLE IF NOT EXISTS completions (
+    request_id INTEGER PRIMARY KEY,
+    output_tokens INTEGER,
+    truncated BOOLEAN NOT NULL,
+    max_tokens INTEGER NOT NULL,
+    FOREIGN KEY (request_id) REFERENCES requests(request_id)
+);
+
+CREATE TABLE IF NOT EXISTS replicates (
+    request_id INTEGER PRIMARY KEY,
+    replicate INTEGER NOT NULL,
+    FOREIGN KEY (request_id) REFERENCES requests(request_id)
+);
+
+CREATE TABLE IF NOT EXISTS dead_letters (
+    request_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    failure TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    error_type TEXT,
+    error_message TEXT,
+    timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (request_id, stage),
+    FOREIGN KEY (request_id) REFERENCES requests(request_id)
+);
+
+CREATE TABLE IF NOT EXISTS hedges (
+    request_id INTEGER PRIMARY KEY,
+    n_hedges INTEGER NOT NULL,
+    n_won INTEGER NOT NULL,
+    saved REAL NOT NULL,
+    FOREIGN KEY (request_id) REFERENCES requests(request_id)
+);
+
+-- zstd dictionaries for compressing text columns; dictionary_id is the id
+-- the frame header of every value compressed with the dictionary names
+CREATE TABLE IF NOT EXISTS dictionaries (
+    dictionary_id INTEGER PRIMARY KEY,
+    column_name TEXT NOT NULL,
+    dictionary BLOB NOT NULL,
+    timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS fingerprints (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+
+CREATE TABLE IF NOT EXISTS extraction_cache (
+    kind TEXT NOT NULL,
+    text_hash TEXT NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (kind, text_hash)
+);
+
+CREATE TABLE IF NOT EXISTS embedding_vectors (
+    interview_id INTEGER NOT NULL,
+    redacted BOOLEAN NOT NULL,
+    resume BOOLEAN NOT NULL,
+    model TEXT NOT NULL,
+    dimensions INTEGER NOT NULL,
+    vector BLOB NOT NULL,
+    PRIMARY KEY (interview_id, redacted, resume),
+    FOREIGN KEY (interview_id) REFERENCES interviews(interview_id)
+);
+
 CREATE TABLE IF NOT EXISTS embeddings (
   embedding_id INTEGER PRIMARY KEY AUTOINCREMENT,
   interview_id INTEGER NOT NULL,
@@ -347,3 +425,196 @@ CREATE TABLE IF NOT EXISTS embeddings (
   X_255 REAL NOT NULL
 );
 CREATE INDEX IF NOT EXISTS idx_embeddings_interview_id ON embeddings(interview_id);
+
+-- Counts, sums, and sums of squares of the ratings, kept current by triggers
+-- The group of every request, with the demographics of its persona or, for
+-- the interview-based experiments, of its interview
+CREATE VIEW IF NOT EXISTS request_groups AS
+SELECT
+    requests.request_id,
+    requests.model,
+    prompts.experiment_type,
+    COALESCE(personas.race, interviews.race) AS race,
+    COALESCE(personas.gender, interviews.gender) AS gender,
+    prompts.interview_id
+FROM requests
+JOIN prompts ON requests.prompt_id = prompts.prompt_id
+JOIN interviews ON prompts.interview_id = interviews.interview_id
+LEFT JOIN personas ON prompts.persona_id = personas.persona_id;
+
+-- n counts the ratings without errors; n_<measure> those with the measure
+CREATE TABLE IF NOT EXISTS ratings_cube (
+    model TEXT NOT NULL,
+    experiment_type TEXT NOT NULL,
+    race TEXT NOT NULL,
+    gender TEXT NOT NULL,
+    interview_id INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    n_hire INTEGER NOT NULL,
+    sum_hire INTEGER NOT NULL,
+    sumsq_hire INTEGER NOT NULL,
+    n_experience INTEGER NOT NULL,
+    sum_experience INTEGER NOT NULL,
+    sumsq_experience INTEGER NOT NULL,
+    n_fit INTEGER NOT NULL,
+    sum_fit INTEGER NOT NULL,
+    sumsq_fit INTEGER NOT NULL,
+    n_professionalism INTEGER NOT NULL,
+    sum_professionalism INTEGER NOT NULL,
+    sumsq_professionalism INTEGER NOT NULL,
+    PRIMARY KEY (model, experiment_type, race, gender, interview_id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS ratings_cube_insert
+AFTER INSERT ON ratings
+WHEN NEW.error = 0
+BEGIN
+    INSERT INTO ratings_cube
+    SELECT
+        model,
+        experiment_type,
+        race,
+        gender,
+        interview_id,
+        1,
+        NEW.hire IS NOT NULL,
+        COALESCE(NEW.hire, 0),
+        COALESCE(NEW.hire * NEW.hire, 0),
+        NEW.experience IS NOT NULL,
+        COALESCE(NEW.experience, 0),
+        COALESCE(NEW.experience * NEW.experience, 0),
+        NEW.fit IS NOT NULL,
+        COALESCE(NEW.fit, 0),
+        COALESCE(NEW.fit * NEW.fit, 0),
+        NEW.professionalism IS NOT NULL,
+        COALESCE(NEW.professionalism, 0),
+        COALESCE(NEW.professionalism * NEW.professionalism, 0)
+    FROM request_groups
+    WHERE request_id = NEW.request_id
+    ON CONFLICT (model, experiment_type, race, gender, interview_id)
+    DO UPDATE SET
+        n = n + 1,
+        n_hire = n_hire + excluded.n_hire,
+        sum_hire = sum_hire + excluded.sum_hire,
+        sumsq_hire = sumsq_hire + excluded.sumsq_hire,
+        n_experience = n_experience + excluded.n_experience,
+        sum_experience = sum_experience + excluded.sum_experience,
+        sumsq_experience = sumsq_experience + excluded.sumsq_experience,
+        n_fit = n_fit + excluded.n_fit,
+        sum_fit = sum_fit + excluded.sum_fit,
+        sumsq_fit = sumsq_fit + excluded.sumsq_fit,
+        n_professionalism = n_professionalism + excluded.n_professionalism,
+        sum_professionalism = sum_professionalism + excluded.sum_professionalism,
+        sumsq_professionalism = sumsq_professionalism + excluded.sumsq_professionalism;
+END;
+
+CREATE TRIGGER IF NOT EXISTS ratings_cube_delete
+AFTER DELETE ON ratings
+WHEN OLD.error = 0
+BEGIN
+    UPDATE ratings_cube SET
+        n = n - 1,
+        n_hire = n_hire - (OLD.hire IS NOT NULL),
+        sum_hire = sum_hire - COALESCE(OLD.hire, 0),
+        sumsq_hire = sumsq_hire - COALESCE(OLD.hire * OLD.hire, 0),
+        n_experience = n_experience - (OLD.experience IS NOT NULL),
+        sum_experience = sum_experience - COALESCE(OLD.experience, 0),
+        sumsq_experience = sumsq_experience
+            - COALESCE(OLD.experience * OLD.experience, 0),
+        n_fit = n_fit - (OLD.fit IS NOT NULL),
+        sum_fit = sum_fit - COALESCE(OLD.fit, 0),
+        sumsq_fit = sumsq_fit - COALESCE(OLD.fit * OLD.fit, 0),
+        n_professionalism = n_professionalism - (OLD.professionalism IS NOT NULL),
+        sum_professionalism = sum_professionalism - COALESCE(OLD.professionalism, 0),
+        sumsq_professionalism = sumsq_professionalism
+            - COALESCE(OLD.professionalism * OLD.professionalism, 0)
+    WHERE (model, experiment_type, race, gender, interview_id) = (
+        SELECT model, experiment_type, race, gender, interview_id
+        FROM request_groups
+        WHERE request_id = OLD.request_id
+    );
+    DELETE FROM ratings_cube
+    WHERE n = 0
+    AND (model, experiment_type, race, gender, interview_id) = (
+        SELECT model, experiment_type, race, gender, interview_id
+        FROM request_groups
+        WHERE request_id = OLD.request_id
+    );
+END;
+
+-- An update is the deletion of the old rating and the insertion of the new
+CREATE TRIGGER IF NOT EXISTS ratings_cube_update
+AFTER UPDATE OF request_id, hire, experience, fit, professionalism, error
+ON ratings
+BEGIN
+    UPDATE ratings_cube SET
+        n = n - 1,
+        n_hire = n_hire - (OLD.hire IS NOT NULL),
+        sum_hire = sum_hire - COALESCE(OLD.hire, 0),
+        sumsq_hire = sumsq_hire - COALESCE(OLD.hire * OLD.hire, 0),
+        n_experience = n_experience - (OLD.experience IS NOT NULL),
+        sum_experience = sum_experience - COALESCE(OLD.experience, 0),
+        sumsq_experience = sumsq_experience
+            - COALESCE(OLD.experience * OLD.experience, 0),
+        n_fit = n_fit - (OLD.fit IS NOT NULL),
+        sum_fit = sum_fit - COALESCE(OLD.fit, 0),
+        sumsq_fit = sumsq_fit - COALESCE(OLD.fit * OLD.fit, 0),
+        n_professionalism = n_professionalism - (OLD.professionalism IS NOT NULL),
+        sum_professionalism = sum_professionalism - COALESCE(OLD.professionalism, 0),
+        sumsq_professionalism = sumsq_professionalism
+            - COALESCE(OLD.professionalism * OLD.professionalism, 0)
+    WHERE OLD.error = 0
+    AND (model, experiment_type, race, gender, interview_id) = (
+        SELECT model, experiment_type, race, gender, interview_id
+        FROM request_groups
+        WHERE request_id = OLD.request_id
+    );
+    DELETE FROM ratings_cube
+    WHERE n = 0
+    AND (model, experiment_type, race, gender, interview_id) = (
+        SELECT model, experiment_type, race, gender, interview_id
+        FROM request_groups
+        WHERE request_id = OLD.request_id
+    );
+    INSERT INTO ratings_cube
+    SELECT
+        model,
+        experiment_type,
+        race,
+        gender,
+        interview_id,
+        1,
+        NEW.hire IS NOT NULL,
+        COALESCE(NEW.hire, 0),
+        COALESCE(NEW.hire * NEW.hire, 0),
+        NEW.experience IS NOT NULL,
+        COALESCE(NEW.experience, 0),
+        COALESCE(NEW.experience * NEW.experience, 0),
+        NEW.fit IS NOT NULL,
+        COALESCE(NEW.fit, 0),
+        COALESCE(NEW.fit * NEW.fit, 0),
+        NEW.professionalism IS NOT NULL,
+        COALESCE(NEW.professionalism, 0),
+        COALESCE(NEW.professionalism * NEW.professionalism, 0)
+    FROM request_groups
+    WHERE request_id = NEW.request_id
+    AND NEW.error = 0
+    ON CONFLICT (model, experiment_type, race, gender, interview_id)
+    DO UPDATE SET
+        n = n + 1,
+        n_hire = n_hire + excluded.n_hire,
+        sum_hire = sum_hire + excluded.sum_hire,
+        sumsq_hire = sumsq_hire + excluded.sumsq_hire,
+        n_experience = n_experience + excluded.n_experience,
+        sum_experience = sum_experience + excluded.sum_experience,
+        sumsq_experience = sumsq_experience + excluded.sumsq_experience,
+        n_fit = n_fit + excluded.n_fit,
+        sum_fit = sum_fit + excluded.sum_fit,
+        sumsq_fit = sumsq_fit + excluded.sumsq_fit,
+        n_professionalism = n_professionalism + excluded.n_professionalism,
+        sum_professionalism = sum_professionalism + excluded.sum_professionalism,
+        sumsq_professionalism = sumsq_professionalism + excluded.sumsq_professionalism;
+END;
+
+-- The latest migration in migrations/ this schema already includes
+PRAGMA user_version = 7;